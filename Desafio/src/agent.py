@@ -1,6 +1,8 @@
-from src.class_agents import agents, llm
+from src.class_agents import obter_agentes, obter_llm
 from langchain_core.prompts import ChatPromptTemplate
 from src.prompt import new_prompt
+from src.catalog import descrever, selecionar
+from src import queries
 
 
 class call_ai:
@@ -27,24 +29,48 @@ class call_ai:
             return 'cabecalho'  
 
     @staticmethod
-    def analisar(pergunta):
+    def responder(pergunta):
+        """
+        (resposta em stream, caminho). Perguntas de um dos modelos de `queries` são
+        respondidas direto nos dados, sem LLM (caminho 'rapido:<consulta>'); as demais
+        vão para o agente (caminho 'agente:<cabecalho|itens>').
+        """
+        direta = queries.responder(pergunta)
+        if direta is not None:
+            print(f"⚡ Caminho rápido: {direta['consulta']} em {direta['segundos'] * 1000:.1f} ms")
+            return iter([direta['texto']]), f"rapido:{direta['consulta']}"
+        return call_ai.analisar(pergunta, caminho_rapido=False), f"agente:{call_ai.decidir_agente(pergunta)}"
+
+    @staticmethod
+    def analisar(pergunta, caminho_rapido=True):
         """Função principal que decide e executa"""
-        
+
+        if caminho_rapido:
+            direta = queries.responder(pergunta)
+            if direta is not None:
+                return iter([direta['texto']])
+
         agente_escolhido = call_ai.decidir_agente(pergunta)
+        # Só os meses e UFs citados na pergunta são carregados
+        periodos, ufs = selecionar(pergunta)
+        dados = descrever(periodos, ufs)
         print(f"🤖 Usando agente: {agente_escolhido.upper()}")
+        print(f"📁 Partições: meses {', '.join(periodos)}; UFs {', '.join(ufs) if ufs else 'todas'}")
         print("\n=== TESTE COM AGENT CUSTOMIZADO ===")
         
        
         prompt_template = ChatPromptTemplate.from_template(new_prompt)
+        agents = obter_agentes(periodos, ufs)
+        llm = obter_llm()
 
       
         if agente_escolhido == 'cabecalho':
             resultado = agents.agent_cabecalho.invoke(pergunta)
-            final_prompt = prompt_template.format_messages(question=f"{pergunta}: Resultado: {resultado}")
+            final_prompt = prompt_template.format_messages(question=f"{pergunta}: Resultado: {resultado}", dados=dados)
             final_response = llm.stream(final_prompt)
         else:
             resultado = agents.agent_itens.invoke(pergunta)
-            final_prompt = prompt_template.format_messages(question=f"Qual o valor da nota? O valor foi {resultado}")
+            final_prompt = prompt_template.format_messages(question=f"Qual o valor da nota? O valor foi {resultado}", dados=dados)
             final_response = llm.stream(final_prompt)
         
         return final_response
@@ -1,14 +1,33 @@
+import time
+
 import streamlit as st
-from src.dataframes import df_cabecalho, df_itens
+from src.catalog import descrever, periodos
+from src.dataframes import carregar_dados, tempos_de_carga
 from src.agent import call_ai
+from src.warmup import aquecer
 from langchain_core.messages import HumanMessage, AIMessage
 
+
+@st.cache_resource(show_spinner="Carregando as notas fiscais...")
+def carregar():
+    # Uma vez por processo (e não a cada rerun): lê o mês mais recente para o preview e
+    # começa a preparar os dados e agentes das perguntas em segundo plano
+    dados = carregar_dados(periodos()[-1:])
+    aquecer(em_segundo_plano=True)
+    return dados
+
+
 def main():
     st.set_page_config(page_title="ChatBot para Nfes", page_icon="🤖")
 
     st.title("Agente de IA para Análises de notas fiscais - Os Promptados")
     st.write("## **Preview dos Datasets 📚**")
 
+    df_cabecalho, df_itens = carregar()
+    tempos = tempos_de_carga()
+    st.caption(descrever().replace('\n', '  \n'))
+    st.caption("Inicialização: " + ", ".join(f"{etapa} {segundos:.2f} s" for etapa, segundos in tempos.items()))
+
     col1, col2 = st.columns([3, 3])  
     no_key_acess_cabecalho = df_cabecalho.drop('CHAVE DE ACESSO', axis=1)
     no_key_acess_itens = df_itens.drop('CHAVE DE ACESSO', axis=1)
@@ -38,6 +57,12 @@ def main():
 
         with st.chat_message("assistant"):
             with st.spinner("🤔 Analisando sua pergunta"):
-                answer = call_ai.analisar(question)
+                inicio = time.perf_counter()
+                answer, caminho = call_ai.responder(question)
             resposta = st.write_stream(answer)
+            segundos = time.perf_counter() - inicio
+            if caminho.startswith('rapido:'):
+                st.caption(f"⚡ Resposta direta nos dados, sem LLM ({caminho[7:]}), em {segundos * 1000:.0f} ms")
+            else:
+                st.caption(f"🤖 Resposta do agente de {caminho[7:]} em {segundos:.1f} s")
             st.session_state.messages.append({"role": "assistant", "content": resposta})
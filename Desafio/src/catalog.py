@@ -0,0 +1,176 @@
+import os
+import re
+import threading
+import unicodedata
+
+from src.ingestion import TABELAS, ZIP_NFS, ingerir, ler_particoes
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+data_dir = os.path.join(base_dir, 'data')
+# Sem mês na pergunta, quantos meses (os mais recentes) carregar: por padrão só o último,
+# para que memória e latência não cresçam com o histórico; 0 carrega todos
+NFE_DEFAULT_MONTHS = int(os.environ.get('NFE_DEFAULT_MONTHS', '1'))
+
+MESES = ['janeiro', 'fevereiro', 'março', 'abril', 'maio', 'junho', 'julho', 'agosto',
+         'setembro', 'outubro', 'novembro', 'dezembro']
+
+UFS = {
+    'AC': 'acre', 'AL': 'alagoas', 'AP': 'amapá', 'AM': 'amazonas', 'BA': 'bahia',
+    'CE': 'ceará', 'DF': 'distrito federal', 'ES': 'espírito santo', 'GO': 'goiás',
+    'MA': 'maranhão', 'MT': 'mato grosso', 'MS': 'mato grosso do sul', 'MG': 'minas gerais',
+    'PA': 'pará', 'PB': 'paraíba', 'PR': 'paraná', 'PE': 'pernambuco', 'PI': 'piauí',
+    'RJ': 'rio de janeiro', 'RN': 'rio grande do norte', 'RS': 'rio grande do sul',
+    'RO': 'rondônia', 'RR': 'roraima', 'SC': 'santa catarina', 'SP': 'são paulo',
+    'SE': 'sergipe', 'TO': 'tocantins',
+}
+
+_lock = threading.RLock()
+_manifestos = None
+_zips = None  # {'AAAAMM': (caminho, tamanho, modificado)} da última varredura da pasta
+
+
+def _normalizar(texto):
+    return unicodedata.normalize('NFC', texto).lower()
+
+
+def descobrir(pasta=None):
+    """{'AAAAMM': caminho} de todos os arquivos AAAAMM_NFs.zip da pasta de dados."""
+    pasta = pasta or data_dir
+    return {ZIP_NFS.match(nome).group(1): os.path.join(pasta, nome)
+            for nome in sorted(os.listdir(pasta)) if ZIP_NFS.match(nome)}
+
+
+def _estado_dos_zips():
+    estado = {}
+    for periodo, zip_path in descobrir().items():
+        try:
+            info = os.stat(zip_path)
+        except OSError:
+            continue  # removido durante a varredura
+        estado[periodo] = (zip_path, info.st_size, info.st_mtime_ns)
+    return estado
+
+
+def manifestos():
+    """
+    {'AAAAMM': manifesto} de todos os meses da pasta de dados. A pasta é varrida a cada
+    chamada (só a listagem e o tamanho e a data de cada zip): um zip novo ou alterado é
+    ingerido (ver `ingestion.ingerir`) sem reiniciar o processo e um zip removido sai
+    do catálogo. Os dados em si não são lidos aqui.
+    """
+    global _manifestos, _zips
+    zips = _estado_dos_zips()
+    with _lock:
+        if zips != _zips:
+            _manifestos = {periodo: ingerir(zip_path) for periodo, (zip_path, _, _) in zips.items()}
+            _zips = zips
+        return _manifestos
+
+
+def periodos():
+    return sorted(manifestos())
+
+
+def ufs_do_periodo(periodo):
+    return sorted(manifestos()[periodo]['particoes'])
+
+
+def versao(periodos):
+    """Identifica o conteúdo dos meses `periodos` (a origem de cada zip no cache)."""
+    atuais = manifestos()
+    return tuple((periodo, atuais[periodo]['origem']['tamanho'], atuais[periodo]['origem']['modificado'])
+                 for periodo in periodos if periodo in atuais)
+
+
+def _periodos_citados(pergunta, disponiveis):
+    texto = _normalizar(pergunta)
+    citados = set()
+    # 01/2024, 15/01/2024, 2024-01 e 2024-01-15
+    for mes, ano in re.findall(r'\b(\d{1,2})/(\d{4})\b', texto):
+        citados.add(f"{ano}{int(mes):02d}")
+    for ano, mes in re.findall(r'\b(\d{4})-(\d{2})\b', texto):
+        citados.add(f"{ano}{mes}")
+    # "janeiro", "janeiro de 2024", "jan/2024": sem ano vale o mês em todos os anos
+    for numero, nome in enumerate(MESES, start=1):
+        for encontrado in re.finditer(rf'\b(?:{nome}\b|{nome[:3]}(?=/))(?:\s+de|/)?\s*(\d{{4}})?', texto):
+            ano = encontrado.group(1)
+            citados.update(p for p in disponiveis if p[4:] == f"{numero:02d}" and (ano is None or p[:4] == ano))
+    if not citados:
+        # Só o ano ("em 2024")
+        for ano in re.findall(r'\b(?:de|em|ano)\s+(20\d{2})\b', texto):
+            citados.update(p for p in disponiveis if p[:4] == ano)
+    return citados
+
+
+def _ufs_citadas(pergunta):
+    # Siglas só em maiúsculas ("SP"; "se", "pa", "to" são palavras comuns) e nomes por extenso
+    citadas = set(re.findall(rf"\b({'|'.join(UFS)})\b", pergunta))
+    texto = _normalizar(pergunta)
+    for sigla, nome in sorted(UFS.items(), key=lambda item: -len(item[1])):
+        if re.search(rf'\b{nome}\b', texto):
+            citadas.add(sigla)
+            texto = re.sub(rf'\b{nome}\b', ' ', texto)
+    return citadas
+
+
+def _sobre_destinatario(pergunta):
+    """
+    Se a pergunta fala do destinatário: "destinatário", "notas para o CNPJ ...",
+    "vendas para o cliente ...", "enviadas para SP", "para a Bahia".
+    """
+    texto = _normalizar(pergunta)
+    if 'destin' in texto:
+        return True
+    artigo = r'(?:(?:o|a|os|as)\s+)?'
+    if re.search(rf'\bpara\s+{artigo}(?:cnpj|cpf|empresa|cliente|comprador)', texto):
+        return True
+    if re.search(rf"\b[Pp]ara\s+{artigo}({'|'.join(UFS)})\b", pergunta):
+        return True
+    nomes = '|'.join(sorted(UFS.values(), key=len, reverse=True))
+    return bool(re.search(rf'\bpara\s+{artigo}(?:{nomes})\b', texto))
+
+
+def selecionar(pergunta):
+    """
+    (periodos, ufs) que a pergunta toca: os meses citados ("janeiro", "01/2024",
+    "março de 2024"...) e as UFs citadas ("SP", "Paraná"). A partição por UF é a do
+    emitente, então perguntas sobre o destinatário ("destinatário", "para o CNPJ ...",
+    "para SP"; ver `_sobre_destinatario`) não filtram por UF. Sem mês citado
+    (ou citando só meses que não existem) ficam os NFE_DEFAULT_MONTHS mais recentes
+    (padrão: só o último; 0, todos); ufs=None significa todas.
+    """
+    disponiveis = periodos()
+    escolhidos = sorted(_periodos_citados(pergunta, disponiveis) & set(disponiveis))
+    if not escolhidos:
+        escolhidos = disponiveis[-NFE_DEFAULT_MONTHS:] if NFE_DEFAULT_MONTHS > 0 else disponiveis
+    ufs = None
+    if not _sobre_destinatario(pergunta):
+        existentes = {uf for periodo in escolhidos for uf in ufs_do_periodo(periodo)}
+        ufs = sorted(_ufs_citadas(pergunta) & existentes) or None
+    return tuple(escolhidos), (tuple(ufs) if ufs else None)
+
+
+def carregar(periodos=None, ufs=None, dinheiro=None):
+    """
+    (df_cabecalho, df_itens) só com as partições dos meses `periodos` (todos se None)
+    e das UFs do emitente `ufs` (todas se None).
+    """
+    escolhidos = list(periodos) if periodos is not None else list(manifestos())
+    return tuple(ler_particoes(tabela, escolhidos, ufs, dinheiro=dinheiro) for tabela in TABELAS)
+
+
+def _nome_periodo(periodo):
+    return f"{MESES[int(periodo[4:]) - 1]}/{periodo[:4]}"
+
+
+def descrever(periodos=None, ufs=None):
+    """Texto para o prompt: meses, UFs e número de notas e itens dos dados selecionados."""
+    linhas = []
+    for periodo in (periodos if periodos is not None else sorted(manifestos())):
+        particoes = manifestos()[periodo]['particoes']
+        selecionadas = [uf for uf in sorted(particoes) if ufs is None or uf in ufs]
+        notas = sum(particoes[uf].get('Cabecalho', 0) for uf in selecionadas)
+        itens = sum(particoes[uf].get('Itens', 0) for uf in selecionadas)
+        linhas.append(f"{_nome_periodo(periodo)} ({periodo}_NFs.zip): {notas} notas fiscais e {itens} itens, "
+                      f"emitentes de {', '.join(selecionadas) or 'nenhuma UF'}")
+    return '\n'.join(linhas) or 'Nenhuma nota fiscal disponível.'
@@ -1,31 +1,77 @@
+import threading
+from collections import OrderedDict
+
 from dotenv import load_dotenv
-from langchain_experimental.agents.agent_toolkits import create_pandas_dataframe_agent
-from langchain_openai import ChatOpenAI
 from src.prompt import prefix_cabecalho, prefix_itens
-from langchain_groq import ChatGroq
-from src.dataframes import df_cabecalho, df_itens
+from src.dataframes import NFE_CACHED_SELECTIONS, carregar_modelo, chave_da_selecao, medir_carga
 # Instância para carregar o modelo e criar a conexão com a provedora do modelo
 load_dotenv()
 
-llm = ChatOpenAI(model="gpt-4o", temperature=0.7)
+# O modelo e os agentes são criados no primeiro uso (ou em `aquecer`) e reaproveitados
+# até o fim do processo; importar este módulo não lê os dados nem importa o langchain
+_lock = threading.RLock()
+_llm = None
+_agentes = OrderedDict()  # chave_da_selecao -> agents
+
+
+def obter_llm():
+    global _llm
+    if _llm is None:
+        with _lock:
+            if _llm is None:
+                with medir_carga('llm'):
+                    from langchain_openai import ChatOpenAI
+                    _llm = ChatOpenAI(model="gpt-4o", temperature=0.7)
+    return _llm
+
 
 # Classe para configurar os agentes
+# O agente de cabeçalho consulta uma linha por nota (com os agregados dos itens) e o de
+# itens uma linha por item já com as colunas do cabeçalho (ver facts.modelo_notas)
 class agents:
-    agent_cabecalho = create_pandas_dataframe_agent(
-            llm=llm,
-            df=df_cabecalho,  
-            verbose=True,
+    def __init__(self, llm, df_cabecalho, df_itens):
+        from langchain_experimental.agents.agent_toolkits import create_pandas_dataframe_agent
+        self.agent_cabecalho = create_pandas_dataframe_agent(
+                llm=llm,
+                df=df_cabecalho,
+                verbose=True,
+                allow_dangerous_code=True,
+                max_iterations=5,
+                return_intermediate_steps=True,
+                prefix=prefix_cabecalho,
+            )
+        self.agent_itens = create_pandas_dataframe_agent(
+            llm = llm,
+            df= df_itens,
+            verbose= True,
             allow_dangerous_code=True,
             max_iterations=5,
             return_intermediate_steps=True,
-            prefix=prefix_cabecalho,
+            prefix=prefix_itens,
         )
-    agent_itens = create_pandas_dataframe_agent(
-        llm = llm,
-        df= df_itens,
-        verbose= True,
-        allow_dangerous_code=True,
-        max_iterations=5,
-        return_intermediate_steps=True,
-        prefix=prefix_itens,
-    )
\ No newline at end of file
+
+
+def obter_agentes(periodos=None, ufs=None):
+    """
+    Agentes de cabeçalho e itens sobre o modelo das partições selecionadas (ver
+    `dataframes.carregar_modelo`), criados uma vez por seleção e mantidos, como os
+    dados, para as NFE_CACHED_SELECTIONS seleções usadas mais recentemente.
+    """
+    chave = chave_da_selecao(periodos, ufs)
+    with _lock:
+        if chave not in _agentes:
+            llm = obter_llm()
+            modelo = carregar_modelo(chave[0], chave[1])
+            with medir_carga('agentes'):
+                _agentes[chave] = agents(llm, modelo.notas, modelo.itens)
+            while len(_agentes) > max(1, NFE_CACHED_SELECTIONS):
+                _agentes.popitem(last=False)
+        _agentes.move_to_end(chave)
+        return _agentes[chave]
+
+
+def __getattr__(nome):
+    # Compatibilidade com `from src.class_agents import agents, llm`
+    if nome == 'llm':
+        return obter_llm()
+    raise AttributeError(f"module {__name__!r} has no attribute {nome!r}")
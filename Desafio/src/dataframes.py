@@ -1,13 +1,93 @@
+import logging
 import os
-import zipfile
-import pandas as pd
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 
-base_dir = os.path.dirname(os.path.abspath(__file__))
-file_path = os.path.join(base_dir, 'data', '202401_NFs.zip')
+logger = logging.getLogger("dataframes")
 
+# Quantas seleções de partições (meses e UFs) ficam em memória ao mesmo tempo
+NFE_CACHED_SELECTIONS = int(os.environ.get('NFE_CACHED_SELECTIONS', '4'))
 
-with zipfile.ZipFile(file_path, 'r') as zip_ref:
-    with zip_ref.open('202401_NFs_Cabecalho.csv') as Cabecalho:
-        df_cabecalho = pd.read_csv(Cabecalho)
-    with zip_ref.open('202401_NFs_Itens.csv') as Itens:
-        df_itens = pd.read_csv(Itens)
\ No newline at end of file
+# Os dados são lidos na primeira vez que alguém precisa deles (e não ao importar o
+# módulo) e ficam em memória, por seleção de partições, até o fim do processo
+_lock = threading.RLock()
+_dados = OrderedDict()  # chave_da_selecao -> (df_cabecalho, df_itens)
+_modelos = OrderedDict()  # chave_da_selecao -> facts.modelo_notas
+_tempos = {}  # etapa da inicialização -> segundos (a primeira medida de cada etapa)
+
+
+@contextmanager
+def medir_carga(etapa):
+    """
+    Mede uma etapa da inicialização (leitura dos dados, criação dos agentes...). Toda
+    medida vai para o log, mas só a primeira de cada etapa fica em `tempos_de_carga`:
+    cargas de outras seleções, depois da partida, não a sobrescrevem.
+    """
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        segundos = time.perf_counter() - inicio
+        _tempos.setdefault(etapa, segundos)
+        logger.info(f"Carga: {etapa} em {segundos:.3f} s")
+
+
+def tempos_de_carga():
+    """Segundos gastos na primeira vez de cada etapa da inicialização neste processo."""
+    return dict(_tempos)
+
+
+def carregar_dados(periodos=None, ufs=None):
+    """
+    (df_cabecalho, df_itens) das notas fiscais, tipados (ver `ingestion`), só com as
+    partições dos meses `periodos` ('AAAAMM') e das UFs do emitente `ufs` (todos e
+    todas se None; ver `catalog.selecionar`). Cada seleção é lida uma única vez
+    (chamadas simultâneas esperam a primeira terminar) do cache colunar, criado na
+    primeira vez; as NFE_CACHED_SELECTIONS usadas mais recentemente ficam em memória.
+    """
+    from src import catalog
+    chave = chave_da_selecao(periodos, ufs)
+    return _em_cache(_dados, chave, lambda: catalog.carregar(chave[0], chave[1]), 'dados')
+
+
+def carregar_modelo(periodos=None, ufs=None):
+    """
+    `facts.modelo_notas` (cabeçalho e itens já relacionados pela chave de acesso, com os
+    agregados por nota) da mesma seleção de `carregar_dados`, montado uma vez por seleção.
+    """
+    from src.facts import modelo_notas
+    chave = chave_da_selecao(periodos, ufs)
+    return _em_cache(_modelos, chave, lambda: modelo_notas(*carregar_dados(chave[0], chave[1])), 'modelo')
+
+
+def chave_da_selecao(periodos, ufs):
+    """
+    (periodos, ufs, versao) de uma seleção: a versão (`catalog.versao`) muda quando o
+    zip de um dos meses é substituído, e a seleção é lida de novo.
+    """
+    from src import catalog
+    periodos = tuple(periodos) if periodos is not None else tuple(catalog.periodos())
+    return periodos, tuple(sorted(ufs)) if ufs is not None else None, catalog.versao(periodos)
+
+
+def _em_cache(cache, chave, criar, etapa):
+    with _lock:
+        if chave not in cache:
+            with medir_carga(etapa):
+                cache[chave] = criar()
+            while len(cache) > max(1, NFE_CACHED_SELECTIONS):
+                cache.popitem(last=False)
+        cache.move_to_end(chave)
+        return cache[chave]
+
+
+def __getattr__(nome):
+    # Compatibilidade com `from src.dataframes import df_cabecalho, df_itens`: o acesso
+    # carrega os dados (uma vez) em vez de a importação do módulo
+    if nome == 'df_cabecalho':
+        return carregar_dados()[0]
+    if nome == 'df_itens':
+        return carregar_dados()[1]
+    raise AttributeError(f"module {__name__!r} has no attribute {nome!r}")
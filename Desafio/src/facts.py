@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+
+CHAVE = 'CHAVE DE ACESSO'
+# Agregados por nota, calculados uma vez na carga
+QTD_ITENS = 'QTD ITENS'
+VALOR_ITENS = 'VALOR TOTAL ITENS'
+DIFERENCA = 'DIFERENÇA ITENS - NOTA'
+DIVERGENTE = 'ITENS DIVERGEM DA NOTA'
+AGREGADOS = [QTD_ITENS, VALOR_ITENS, DIFERENCA, DIVERGENTE]
+
+
+def _centavos(valores):
+    # Soma exata: valores com duas casas viram centavos inteiros (float ou decimal)
+    return (pd.to_numeric(valores.astype('float64'), errors='coerce') * 100).round().astype('Int64')
+
+
+class modelo_notas:
+    """
+    Cabeçalho e itens já relacionados pela CHAVE DE ACESSO, montados uma vez na carga:
+
+    - `notas`: o cabeçalho indexado pela chave (uma linha por nota; a chave continua
+      também como coluna), com os agregados
+      QTD ITENS, VALOR TOTAL ITENS (soma exata do VALOR TOTAL dos itens), DIFERENÇA
+      ITENS - NOTA (em relação ao VALOR NOTA FISCAL) e ITENS DIVERGEM DA NOTA;
+    - `itens`: os itens agrupados por nota (na ordem de `notas`), com as colunas do
+      cabeçalho que os itens não têm e os agregados da nota, para perguntas que cruzam
+      as duas tabelas sem nenhum merge.
+
+    `nota(chave)` e `itens_da_nota(chave)` são buscas O(1).
+    """
+
+    def __init__(self, df_cabecalho, df_itens):
+        # A chave fica como índice (busca por hash) e também como coluna, para o código
+        # dos agentes; o índice sem nome evita ambiguidade entre os dois
+        notas = df_cabecalho.drop_duplicates(CHAVE, keep='last').set_index(CHAVE, drop=False)
+        notas.index.name = None
+        posicao = notas.index.get_indexer(df_itens[CHAVE])
+        # Itens sem cabeçalho (posição -1) ficam no fim, fora de qualquer nota
+        posicao = np.where(posicao < 0, len(notas), posicao)
+        ordem = np.argsort(posicao, kind='stable')
+        posicao = posicao[ordem]
+        itens = df_itens.iloc[ordem].reset_index(drop=True)
+
+        limites = np.searchsorted(posicao, np.arange(len(notas) + 1))
+        quantidade = np.diff(limites)
+        centavos = _centavos(itens['VALOR TOTAL'])
+        soma = np.bincount(posicao, weights=centavos.fillna(0).to_numpy(dtype='float64'), minlength=len(notas) + 1)[:len(notas)]
+        notas[QTD_ITENS] = quantidade
+        notas[VALOR_ITENS] = soma / 100
+        diferenca = soma - _centavos(notas['VALOR NOTA FISCAL']).to_numpy(dtype='float64', na_value=np.nan)
+        notas[DIFERENCA] = diferenca / 100
+        notas[DIVERGENTE] = (diferenca != 0) & ~np.isnan(diferenca)
+        self._inicio = dict(zip(notas.index, limites[:-1]))
+        self._fim = dict(zip(notas.index, limites[1:]))
+
+        # Colunas do cabeçalho que não estão nos itens, mais os agregados, repetidas por item
+        extras = [col for col in notas.columns if col not in itens.columns]
+        da_nota = np.where(posicao < len(notas), posicao, -1)
+        juntar = notas[extras].reset_index(drop=True).reindex(da_nota).reset_index(drop=True)
+        self.itens = pd.concat([itens, juntar], axis=1)
+        self.notas = notas
+
+    def nota(self, chave):
+        """Linha do cabeçalho (com os agregados) da nota; KeyError se não existir."""
+        return self.notas.loc[chave]
+
+    def itens_da_nota(self, chave):
+        """Itens da nota (com as colunas do cabeçalho); vazio se a nota não tiver itens."""
+        inicio = self._inicio.get(chave)
+        if inicio is None:
+            return self.itens.iloc[0:0]
+        return self.itens.iloc[inicio:self._fim[chave]]
+
+    def divergentes(self):
+        """Notas cuja soma dos itens difere do VALOR NOTA FISCAL."""
+        return self.notas[self.notas[DIVERGENTE]]
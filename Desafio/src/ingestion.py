@@ -0,0 +1,281 @@
+import csv
+import io
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+import zipfile
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.feather as feather
+
+from src.dataframes import medir_carga
+
+logger = logging.getLogger("ingestion")
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+# Cache colunar (Feather/Arrow IPC) dos zips de notas, criado na primeira leitura de cada
+# mês e particionado por mês e UF do emitente
+NFE_CACHE_DIR = os.environ.get('NFE_CACHE_DIR', os.path.join(base_dir, 'data', 'cache'))
+# lz4 ou zstd (menor em disco) ou uncompressed (~4x maior em disco, carrega em cerca de
+# metade do tempo). O cache economiza a interpretação do CSV, não memória: os DataFrames
+# são sempre cópias completas, com qualquer compressão
+NFE_CACHE_COMPRESSION = os.environ.get('NFE_CACHE_COMPRESSION', 'lz4').strip().lower()
+# Colunas de dinheiro nos DataFrames: float (float64, compatível com todo o pandas que
+# os agentes escrevem) ou decimal (decimal exato do pyarrow). No cache são sempre decimais
+NFE_MONEY_DTYPE = os.environ.get('NFE_MONEY_DTYPE', 'float').strip().lower()
+# Muda quando a conversão muda: caches de outra versão são recriados
+VERSAO_CACHE = '2'
+
+TABELAS = ('Cabecalho', 'Itens')
+ZIP_NFS = re.compile(r'^(\d{6})_NFs\.zip$')
+# Coluna que define a partição por UF (notas sem UF ficam em uf=XX)
+COLUNA_UF = 'UF EMITENTE'
+UF_DESCONHECIDA = 'XX'
+
+# Tipo de cada coluna conhecida; as demais ficam como texto
+CHAVE = 'chave'            # texto só de dígitos, com os zeros à esquerda refeitos
+DATA = 'data'              # timestamp
+CATEGORIA = 'categoria'    # dicionário (categorical no pandas)
+INTEIRO = 'inteiro'
+NUMERO = 'numero'          # float64
+DINHEIRO = 'dinheiro'      # decimal exato
+
+ESQUEMA = {
+    'CHAVE DE ACESSO': (CHAVE, 44),
+    'CPF/CNPJ Emitente': (CHAVE, 14),
+    # CNPJs do destinatário chegam sem os zeros à esquerda (12 ou 13 dígitos); com 11
+    # ou menos pode ser um CPF, que fica como veio
+    'CNPJ DESTINATÁRIO': (CHAVE, 14),
+    'CÓDIGO NCM/SH': (CHAVE, 8),
+    'MODELO': (CATEGORIA,),
+    'SÉRIE': (INTEIRO,),
+    'NÚMERO': (INTEIRO,),
+    'NATUREZA DA OPERAÇÃO': (CATEGORIA,),
+    'DATA EMISSÃO': (DATA,),
+    'EVENTO MAIS RECENTE': (CATEGORIA,),
+    'DATA/HORA EVENTO MAIS RECENTE': (DATA,),
+    # Nomes e UFs se repetem em todas as notas (e itens) do mesmo emitente/destinatário
+    'RAZÃO SOCIAL EMITENTE': (CATEGORIA,),
+    'UF EMITENTE': (CATEGORIA,),
+    'MUNICÍPIO EMITENTE': (CATEGORIA,),
+    'NOME DESTINATÁRIO': (CATEGORIA,),
+    'UF DESTINATÁRIO': (CATEGORIA,),
+    'INDICADOR IE DESTINATÁRIO': (CATEGORIA,),
+    'DESTINO DA OPERAÇÃO': (CATEGORIA,),
+    'CONSUMIDOR FINAL': (CATEGORIA,),
+    'PRESENÇA DO COMPRADOR': (CATEGORIA,),
+    'NÚMERO PRODUTO': (INTEIRO,),
+    'NCM/SH (TIPO DE PRODUTO)': (CATEGORIA,),
+    'CFOP': (CATEGORIA,),
+    'QUANTIDADE': (NUMERO,),
+    'UNIDADE': (CATEGORIA,),
+    'VALOR NOTA FISCAL': (DINHEIRO, pa.decimal128(18, 2)),
+    # O valor unitário da NF-e admite até 10 casas decimais
+    'VALOR UNITÁRIO': (DINHEIRO, pa.decimal128(28, 10)),
+    'VALOR TOTAL': (DINHEIRO, pa.decimal128(18, 2)),
+}
+
+
+def _so_digitos(coluna):
+    return pc.fill_null(pc.match_substring_regex(coluna, r'^[0-9]+$'), False)
+
+
+def _refazer_zeros(coluna, digitos):
+    # Só completa quem perdeu até dois zeros (ou é o NCM); outros valores ficam como vieram
+    tamanho = pc.utf8_length(coluna)
+    minimo = 1 if digitos == 8 else digitos - 2
+    completar = pc.and_(_so_digitos(coluna), pc.and_(pc.greater_equal(tamanho, minimo), pc.less(tamanho, digitos)))
+    return pc.if_else(completar, pc.utf8_lpad(coluna, width=digitos, padding='0'), coluna)
+
+
+def _converter_coluna(nome, coluna):
+    tipo = ESQUEMA.get(nome)
+    if tipo is None:
+        return coluna
+    if tipo[0] == CHAVE:
+        return _refazer_zeros(coluna, tipo[1])
+    if tipo[0] == DATA:
+        return pc.strptime(coluna, format='%Y-%m-%d %H:%M:%S', unit='s', error_is_null=True)
+    if tipo[0] == CATEGORIA:
+        return pc.dictionary_encode(coluna)
+    if tipo[0] == INTEIRO:
+        return coluna.cast(pa.int64())
+    if tipo[0] == NUMERO:
+        return coluna.cast(pa.float64())
+    return coluna.cast(tipo[1])
+
+
+def _colunas(zip_ref, membro):
+    with zip_ref.open(membro) as arquivo:
+        return next(csv.reader(io.TextIOWrapper(arquivo, encoding='utf-8-sig', newline='')))
+
+
+def ler_csv_tipado(zip_ref, membro):
+    """CSV de notas dentro do zip como tabela Arrow, com os tipos de ESQUEMA."""
+    # Tudo é lido como texto e convertido depois: a inferência transformaria a chave de
+    # acesso, CNPJs e NCM em números e perderia os zeros à esquerda
+    colunas = _colunas(zip_ref, membro)
+    with zip_ref.open(membro) as arquivo:
+        tabela = pacsv.read_csv(arquivo, convert_options=pacsv.ConvertOptions(
+            column_types={nome: pa.string() for nome in colunas}, strings_can_be_null=True))
+    return pa.table({nome: _converter_coluna(nome, tabela.column(nome)) for nome in tabela.column_names})
+
+
+def _origem(zip_path):
+    """O que identifica o conteúdo do zip no cache: nome, tamanho e data de modificação."""
+    info = os.stat(zip_path)
+    return {'origem': os.path.basename(zip_path), 'tamanho': info.st_size,
+            'modificado': info.st_mtime_ns, 'versao': VERSAO_CACHE}
+
+
+def periodo_do_zip(zip_path):
+    """'AAAAMM' de um arquivo AAAAMM_NFs.zip; ValueError para outros nomes."""
+    encontrado = ZIP_NFS.match(os.path.basename(zip_path))
+    if not encontrado:
+        raise ValueError(f"Nome de arquivo de notas inválido: {os.path.basename(zip_path)!r} (esperado AAAAMM_NFs.zip)")
+    return encontrado.group(1)
+
+
+def diretorio_particao(tabela, periodo, uf=None, cache_dir=None):
+    """<cache_dir>/<Cabecalho|Itens>/mes=AAAAMM[/uf=UF]"""
+    partes = [cache_dir or NFE_CACHE_DIR, tabela, f"mes={periodo}"]
+    if uf is not None:
+        partes.append(f"uf={uf}")
+    return os.path.join(*partes)
+
+
+def caminho_manifesto(periodo, cache_dir=None):
+    return os.path.join(cache_dir or NFE_CACHE_DIR, '_manifestos', f"{periodo}.json")
+
+
+def ler_manifesto(periodo, cache_dir=None):
+    """Manifesto de um mês já ingerido (origem e linhas por UF e tabela), ou None."""
+    try:
+        with open(caminho_manifesto(periodo, cache_dir), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _gravar_particoes(dados, tabela, periodo, cache_dir):
+    """Grava a tabela do mês, uma partição por UF do emitente; devolve {uf: linhas}."""
+    destino = diretorio_particao(tabela, periodo, cache_dir=cache_dir)
+    # Diretórios começando com '_' não fazem parte do cache até a troca no fim
+    tmp = os.path.join(os.path.dirname(destino), f"_tmp_{periodo}_{os.getpid()}")
+    shutil.rmtree(tmp, ignore_errors=True)
+    ufs = pc.fill_null(dados.column(COLUNA_UF).cast(pa.string()), UF_DESCONHECIDA)
+    linhas = {}
+    for uf in sorted(pc.unique(ufs).to_pylist()):
+        particao = dados.filter(pc.equal(ufs, uf))
+        os.makedirs(os.path.join(tmp, f"uf={uf}"))
+        feather.write_feather(particao, os.path.join(tmp, f"uf={uf}", 'dados.feather'), compression=NFE_CACHE_COMPRESSION)
+        linhas[uf] = particao.num_rows
+    shutil.rmtree(destino, ignore_errors=True)
+    os.replace(tmp, destino)
+    return linhas
+
+
+def ingerir(zip_path, cache_dir=None, forcar=False):
+    """
+    Converte (uma vez) os CSVs de cabeçalho e itens do zip `AAAAMM_NFs.zip` em arquivos
+    Feather tipados e comprimidos, particionados por mês e UF do emitente (ver
+    `diretorio_particao`). O mês só é refeito se o zip mudar (tamanho ou data de
+    modificação), se a conversão mudar de versão ou com `forcar`. Devolve o manifesto
+    do mês: a origem e {uf: {tabela: linhas}}.
+    """
+    periodo = periodo_do_zip(zip_path)
+    origem = _origem(zip_path)
+    manifesto = ler_manifesto(periodo, cache_dir)
+    if not forcar and manifesto is not None and manifesto.get('origem') == origem:
+        return manifesto
+    nome = os.path.splitext(os.path.basename(zip_path))[0]
+    particoes = {}
+    with medir_carga(f'ingestao {nome}'), zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        for tabela in TABELAS:
+            dados = ler_csv_tipado(zip_ref, f"{nome}_{tabela}.csv")
+            for uf, linhas in _gravar_particoes(dados, tabela, periodo, cache_dir).items():
+                particoes.setdefault(uf, {})[tabela] = linhas
+            logger.info(f"Cache criado: {diretorio_particao(tabela, periodo, cache_dir=cache_dir)} ({dados.num_rows} linhas)")
+    manifesto = {'periodo': periodo, 'origem': origem, 'particoes': particoes}
+    # O manifesto é gravado por último: sem ele (ou com outra origem) o mês é refeito
+    path = caminho_manifesto(periodo, cache_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+        json.dump(manifesto, f, ensure_ascii=False)
+    os.replace(f"{path}.tmp", path)
+    return manifesto
+
+
+def _para_pandas(tabela, dinheiro):
+    dinheiro = (dinheiro or NFE_MONEY_DTYPE).strip().lower()
+    if dinheiro not in ('float', 'decimal'):
+        raise ValueError(f"Tipo de dinheiro inválido: {dinheiro!r} (use float ou decimal)")
+    if dinheiro == 'float':
+        for posicao, campo in enumerate(tabela.schema):
+            if pa.types.is_decimal(campo.type):
+                tabela = tabela.set_column(posicao, campo.name, tabela.column(posicao).cast(pa.float64()))
+        return tabela.to_pandas()
+    return tabela.to_pandas(types_mapper=lambda tipo: pd.ArrowDtype(tipo) if pa.types.is_decimal(tipo) else None)
+
+
+def ler_particoes(tabela, periodos, ufs=None, cache_dir=None, dinheiro=None):
+    """
+    DataFrame com as partições de `tabela` dos meses `periodos` e, se dadas, só das UFs
+    `ufs` (as demais nem são abertas). Os dados são copiados para o pandas (com os
+    arquivos comprimidos, também descompactados antes). Categorias viram categoricals, datas datetime64 e as colunas de dinheiro float64
+    ou, com dinheiro='decimal', decimais exatos (pd.ArrowDtype).
+    """
+    arquivos = []
+    for periodo in periodos:
+        pasta = diretorio_particao(tabela, periodo, cache_dir=cache_dir)
+        if not os.path.isdir(pasta):
+            continue
+        for particao in sorted(os.listdir(pasta)):
+            if particao.startswith('uf=') and (ufs is None or particao[3:] in ufs):
+                arquivos.append(os.path.join(pasta, particao, 'dados.feather'))
+    if arquivos:
+        dados = pa.concat_tables(feather.read_table(path, memory_map=True) for path in arquivos).unify_dictionaries()
+    else:
+        # Nenhuma partição selecionada: tabela vazia com as colunas de qualquer partição
+        dados = _esquema_vazio(tabela, cache_dir)
+    return _para_pandas(dados, dinheiro)
+
+
+def _esquema_vazio(tabela, cache_dir):
+    raiz = os.path.join(cache_dir or NFE_CACHE_DIR, tabela)
+    for pasta, _, nomes in os.walk(raiz):
+        if 'dados.feather' in nomes and not os.path.basename(os.path.dirname(pasta)).startswith('_'):
+            with pa.memory_map(os.path.join(pasta, 'dados.feather')) as arquivo:
+                return pa.ipc.open_file(arquivo).schema.empty_table()
+    raise FileNotFoundError(f"Nenhum mês de notas no cache ({raiz})")
+
+
+def carregar_nfs(zip_path, cache_dir=None, dinheiro=None):
+    """(df_cabecalho, df_itens) tipados de um zip de notas, pelo cache (criado se preciso)."""
+    periodo = ingerir(zip_path, cache_dir)['periodo']
+    return tuple(ler_particoes(tabela, [periodo], cache_dir=cache_dir, dinheiro=dinheiro) for tabela in TABELAS)
+
+
+def main():
+    # Conversão antecipada: python -m src.ingestion [--forcar] [zips...]
+    argumentos = sys.argv[1:]
+    forcar = '--forcar' in argumentos
+    zips = [arg for arg in argumentos if arg != '--forcar']
+    if not zips:
+        pasta = os.path.join(base_dir, 'data')
+        zips = sorted(os.path.join(pasta, nome) for nome in os.listdir(pasta) if ZIP_NFS.match(nome))
+    for zip_path in zips:
+        manifesto = ingerir(zip_path, forcar=forcar)
+        for uf, linhas in sorted(manifesto['particoes'].items()):
+            print(f"{manifesto['periodo']} {uf}: " + ", ".join(f"{tabela} {n}" for tabela, n in linhas.items()))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,240 @@
+import os
+import re
+import time
+import unicodedata
+import weakref
+
+import numpy as np
+import pandas as pd
+
+from src.catalog import MESES, selecionar
+from src.dataframes import carregar_modelo
+
+# Responde direto (sem LLM) as perguntas que casam com um dos modelos abaixo
+NFE_FAST_PATH = os.environ.get('NFE_FAST_PATH', '1').lower() in ('1', 'true', 'sim')
+
+NAO_ENCONTRADO = "Não encontrei nenhuma informação correspondente nos arquivos."
+# Quantas notas uma resposta lista, no máximo
+LIMITE_LISTA = 20
+
+_indices = weakref.WeakKeyDictionary()  # modelo -> {nome: {valor: posições em modelo.notas}}
+
+
+def _normalizar(texto):
+    # Minúsculas, sem acentos, espaços simples e sem a pontuação final
+    texto = unicodedata.normalize('NFKD', texto)
+    texto = ''.join(c for c in texto if not unicodedata.combining(c)).lower()
+    return re.sub(r'\s+', ' ', texto).strip().rstrip('?.!').strip()
+
+
+def _moeda(valor):
+    """R$ 12.345,67"""
+    return 'R$ ' + f"{valor:,.2f}".replace(',', '_').replace('.', ',').replace('_', '.')
+
+
+def _digitos(texto):
+    return re.sub(r'\D', '', texto)
+
+
+def _indice(modelo, nome, chaves):
+    """{valor: posições em modelo.notas} de `chaves(modelo.notas)`, montado uma vez por modelo."""
+    por_modelo = _indices.setdefault(modelo, {})
+    if nome not in por_modelo:
+        valores = pd.Series(np.asarray(chaves(modelo.notas), dtype=object))
+        por_modelo[nome] = valores.groupby(valores, sort=False).indices
+    return por_modelo[nome]
+
+
+def _notas(modelo, nome, chaves, valor):
+    posicoes = _indice(modelo, nome, chaves).get(valor)
+    return modelo.notas.iloc[posicoes if posicoes is not None else []]
+
+
+def _data(texto):
+    """
+    ((ano, mes, dia), None) ou (None, (ano, mes)) de '15 de janeiro de 2024', '15/01/2024',
+    '2024-01-15' ou 'janeiro de 2024' (o ano pode faltar nos formatos por extenso).
+    """
+    meses = '|'.join(_normalizar(mes) for mes in MESES)
+    encontrado = re.fullmatch(rf'(?:o dia )?(\d{{1,2}}) de ({meses})(?: de (\d{{4}}))?', texto)
+    if encontrado:
+        dia, mes, ano = encontrado.groups()
+        return (int(ano) if ano else None, [_normalizar(m) for m in MESES].index(mes) + 1, int(dia)), None
+    encontrado = re.fullmatch(r'(?:o dia )?(\d{1,2})/(\d{1,2})/(\d{4})', texto)
+    if encontrado:
+        dia, mes, ano = map(int, encontrado.groups())
+        return (ano, mes, dia), None
+    encontrado = re.fullmatch(r'(\d{4})-(\d{2})-(\d{2})', texto)
+    if encontrado:
+        return tuple(map(int, encontrado.groups())), None
+    encontrado = re.fullmatch(rf'({meses})(?: de (\d{{4}}))?', texto)
+    if encontrado:
+        mes, ano = encontrado.groups()
+        return None, (int(ano) if ano else None, [_normalizar(m) for m in MESES].index(mes) + 1)
+    return None, None
+
+
+def _por_dia(notas):
+    return notas['DATA EMISSÃO'].dt.strftime('%Y-%m-%d')
+
+
+def _por_mes(notas):
+    return notas['DATA EMISSÃO'].dt.strftime('%Y-%m')
+
+
+def _ano_unico(modelo):
+    # Data sem ano: vale o ano dos dados, se só houver um
+    anos = modelo.notas['DATA EMISSÃO'].dt.year.dropna().unique()
+    return int(anos[0]) if len(anos) == 1 else None
+
+
+def _lista_notas(notas, contraparte):
+    """Quantidade e soma das notas e a lista delas (até LIMITE_LISTA), com a contraparte."""
+    encontradas = 'Foi encontrada' if len(notas) == 1 else 'Foram encontradas'
+    linhas = [f"{encontradas} **{_quantas(len(notas), 'nota', 'notas')}**, somando "
+              f"{_moeda(notas['VALOR NOTA FISCAL'].sum())}:", ""]
+    for _, nota in notas.head(LIMITE_LISTA).iterrows():
+        linhas.append(f"- Nota {nota['NÚMERO']} (série {nota['SÉRIE']}), {nota['DATA EMISSÃO']:%d/%m/%Y}, "
+                      f"{nota[contraparte]}: {_moeda(nota['VALOR NOTA FISCAL'])}")
+    if len(notas) > LIMITE_LISTA:
+        linhas.append(f"- ... e mais {len(notas) - LIMITE_LISTA} notas")
+    return '\n'.join(linhas)
+
+
+def _quantas(n, singular, plural):
+    return f"{n} {singular if n == 1 else plural}"
+
+
+def _resposta(explicacao, resultado):
+    return f"🧠 **Explicação do Resultado**\n\n{explicacao}\n\n💰 **Resultado Final**\n\n{resultado}"
+
+
+def _total_por_data(modelo, grupos):
+    dia, mes = _data(grupos['data'])
+    if dia is None and mes is None:
+        return None
+    if dia is not None:
+        ano, numero_mes, numero_dia = dia
+        ano = ano or _ano_unico(modelo)
+        if ano is None:
+            return None
+        rotulo = f"{numero_dia:02d}/{numero_mes:02d}/{ano}"
+        notas = _notas(modelo, 'dia', _por_dia, f"{ano}-{numero_mes:02d}-{numero_dia:02d}")
+    else:
+        ano, numero_mes = mes
+        ano = ano or _ano_unico(modelo)
+        if ano is None:
+            return None
+        rotulo = f"{MESES[numero_mes - 1]} de {ano}"
+        notas = _notas(modelo, 'mes', _por_mes, f"{ano}-{numero_mes:02d}")
+    if notas.empty:
+        return _resposta(f"Filtrei as notas com DATA EMISSÃO em {rotulo}.", NAO_ENCONTRADO)
+    total = notas['VALOR NOTA FISCAL'].sum()
+    return _resposta(
+        f"Filtrei as notas com DATA EMISSÃO em {rotulo} ({_quantas(len(notas), 'nota', 'notas')}) e somei a coluna VALOR NOTA FISCAL.",
+        f"O valor total das notas emitidas em {rotulo} foi de **{_moeda(total)}**.")
+
+
+def _notas_por_emitente(modelo, grupos):
+    nome = grupos['nome'].strip('"\'“” ')
+    if not nome or re.fullmatch(r'[\d./-]+', nome):
+        return None
+    razao = modelo.notas['RAZÃO SOCIAL EMITENTE'].astype('category')
+    # A busca é feita nas razões sociais distintas (poucas) e não nas notas
+    categorias = pd.Series([_normalizar(str(c)) for c in razao.cat.categories])
+    encontradas = np.flatnonzero(categorias.str.contains(nome, regex=False).to_numpy())
+    notas = modelo.notas[razao.cat.codes.isin(encontradas).to_numpy()]
+    if notas.empty:
+        # Nome não encontrado: pode ser uma pergunta com outros filtros; fica com o agente
+        return None
+    explicacao = f"Filtrei as notas cuja RAZÃO SOCIAL EMITENTE contém \"{nome.upper()}\"."
+    empresas = ', '.join(sorted(notas['RAZÃO SOCIAL EMITENTE'].astype(str).unique()))
+    return _resposta(f"{explicacao} Emitente(s): {empresas}.", _lista_notas(notas, 'NOME DESTINATÁRIO'))
+
+
+def _notas_por_numero(modelo, numero):
+    return _notas(modelo, 'numero', lambda notas: notas['NÚMERO'].astype('int64'), int(numero))
+
+
+def _itens_da_nota(modelo, grupos):
+    notas = _notas_por_numero(modelo, grupos['numero'])
+    explicacao = f"Localizei a nota de NÚMERO {grupos['numero']} e contei os itens ligados a ela pela CHAVE DE ACESSO."
+    if notas.empty:
+        return _resposta(explicacao, NAO_ENCONTRADO)
+    if len(notas) == 1:
+        quantidade = _quantas(int(notas['QTD ITENS'].iloc[0]), 'item registrado', 'itens registrados')
+        return _resposta(explicacao, f"Essa nota possui **{quantidade}**.")
+    linhas = [f"- {nota['RAZÃO SOCIAL EMITENTE']} (série {nota['SÉRIE']}): {_quantas(int(nota['QTD ITENS']), 'item', 'itens')}"
+              for _, nota in notas.iterrows()]
+    return _resposta(explicacao + f" Há {len(notas)} notas com esse número, de emitentes ou séries diferentes.",
+                     '\n'.join(linhas))
+
+
+def _media_itens_da_nota(modelo, grupos):
+    notas = _notas_por_numero(modelo, grupos['numero'])
+    explicacao = (f"Localizei a nota de NÚMERO {grupos['numero']} e dividi a soma do VALOR TOTAL dos seus itens "
+                  "pela quantidade de itens.")
+    notas = notas[notas['QTD ITENS'] > 0]
+    if notas.empty:
+        return _resposta(explicacao, NAO_ENCONTRADO)
+    medias = notas['VALOR TOTAL ITENS'] / notas['QTD ITENS']
+    if len(notas) == 1:
+        return _resposta(explicacao + f" A nota tem {_quantas(int(notas['QTD ITENS'].iloc[0]), 'item', 'itens')}.",
+                         f"Portanto, o valor médio dos itens é de **{_moeda(medias.iloc[0])}**.")
+    linhas = [f"- {nota['RAZÃO SOCIAL EMITENTE']} (série {nota['SÉRIE']}): {_moeda(media)}"
+              for (_, nota), media in zip(notas.iterrows(), medias)]
+    return _resposta(explicacao + f" Há {len(notas)} notas com esse número.", '\n'.join(linhas))
+
+
+def _notas_por_cnpj(modelo, grupos):
+    digitos = _digitos(grupos['cnpj'])
+    if len(digitos) not in (11, 14):
+        return None
+    destinatario = grupos['sentido'] == 'para'
+    coluna = 'CNPJ DESTINATÁRIO' if destinatario else 'CPF/CNPJ Emitente'
+    notas = _notas(modelo, coluna, lambda notas: notas[coluna].astype(str), digitos)
+    explicacao = f"Filtrei as notas com {coluna} igual a {grupos['cnpj']}."
+    if notas.empty:
+        return _resposta(explicacao, NAO_ENCONTRADO)
+    return _resposta(explicacao, _lista_notas(notas, 'RAZÃO SOCIAL EMITENTE' if destinatario else 'NOME DESTINATÁRIO'))
+
+
+_NOTA = r'(?:a )?nota(?: fiscal)?(?: (?:numero|n[o°º]?\.?|no))? ?(?P<numero>\d+)'
+
+# Modelos de pergunta (texto normalizado por inteiro) e a consulta de cada um. Uma
+# consulta pode devolver None quando os valores extraídos não servem; aí vale o agente
+CONSULTAS = [
+    ('notas_por_cnpj', re.compile(
+        r'(?:liste|listar|mostre|quais sao|quais)(?: todas)?(?: as)? notas(?: fiscais)?(?: que foram| foram)? emitidas '
+        r'(?P<sentido>para|pelo|por)(?: o)? (?:cnpj|cpf|cpf/cnpj) (?P<cnpj>[\d./-]+)'), _notas_por_cnpj),
+    ('total_por_data', re.compile(
+        r'(?:qual (?:foi |e )?)?o valor total das notas(?: fiscais)? emitidas (?:em|no dia|no mes de) (?P<data>.+)'),
+     _total_por_data),
+    ('notas_por_emitente', re.compile(
+        r'quais(?: as)? notas(?: fiscais)?(?: que)?(?: foram)? emitidas pel[ao] (?:empresa |emitente |fornecedor )?(?P<nome>.+)'),
+     _notas_por_emitente),
+    ('itens_da_nota', re.compile(rf'quantos itens (?:tem|possui|ha na|existem na) {_NOTA}'), _itens_da_nota),
+    ('media_itens_da_nota', re.compile(
+        rf'qual (?:e |foi )?o valor medio dos itens(?: comprados)? (?:na|da) {_NOTA}'), _media_itens_da_nota),
+]
+
+
+def responder(pergunta):
+    """
+    Resposta direta, sem LLM, para as perguntas de um dos modelos de CONSULTAS (total
+    por data, notas por emitente, itens e valor médio por número de nota, notas por
+    CNPJ), calculada no modelo das notas das partições da pergunta. Devolve
+    {'consulta', 'texto', 'segundos'} ou None quando nenhum modelo casa.
+    """
+    if not NFE_FAST_PATH:
+        return None
+    inicio = time.perf_counter()
+    texto = _normalizar(pergunta)
+    for nome, padrao, consulta in CONSULTAS:
+        encontrado = padrao.fullmatch(texto)
+        if not encontrado:
+            continue
+        resposta = consulta(carregar_modelo(*selecionar(pergunta)), encontrado.groupdict())
+        if resposta is not None:
+            return {'consulta': nome, 'texto': resposta, 'segundos': time.perf_counter() - inicio}
+    return None
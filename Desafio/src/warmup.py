@@ -0,0 +1,58 @@
+import logging
+import sys
+import threading
+import time
+
+from src.catalog import selecionar
+from src.dataframes import carregar_dados, carregar_modelo, tempos_de_carga
+
+logger = logging.getLogger("warmup")
+
+
+def aquecer(agentes=True, em_segundo_plano=False):
+    """
+    Carrega os dados (dos meses usados quando a pergunta não cita mês) e, com `agentes`,
+    cria o modelo e os agentes antes da primeira pergunta. Com `em_segundo_plano` o trabalho roda numa thread (a interface aparece
+    sem esperar; quem chegar primeiro aos dados ou agentes espera a carga em andamento)
+    e a thread é devolvida. Sem ela, devolve os tempos de cada etapa.
+    """
+    def carregar():
+        # A seleção de uma pergunta que não cita mês nem UF (ver catalog.selecionar)
+        periodos, ufs = selecionar('')
+        carregar_dados(periodos, ufs)
+        carregar_modelo(periodos, ufs)
+        if agentes:
+            from src.class_agents import obter_agentes
+            obter_agentes(periodos, ufs)
+        return tempos_de_carga()
+
+    def carregar_sem_falhar():
+        # Uma falha aqui (ex.: sem chave da API) reaparece no primeiro uso real
+        try:
+            carregar()
+        except Exception as e:
+            logger.warning(f"Aquecimento em segundo plano falhou: {e}")
+
+    if em_segundo_plano:
+        thread = threading.Thread(target=carregar_sem_falhar, name='aquecimento', daemon=True)
+        thread.start()
+        return thread
+    return carregar()
+
+
+def main():
+    # Relatório da partida a frio: python -m src.warmup [--sem-agentes]
+    agentes = '--sem-agentes' not in sys.argv[1:]
+    inicio = time.perf_counter()
+    import src.agent  # noqa: F401 (só a importação, como faz o app)
+    importacao = time.perf_counter() - inicio
+    tempos = aquecer(agentes=agentes)
+    total = time.perf_counter() - inicio
+    print(f"{'importação':<12} {importacao:8.3f} s")
+    for etapa, segundos in tempos.items():
+        print(f"{etapa:<12} {segundos:8.3f} s")
+    print(f"{'total':<12} {total:8.3f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# Os módulos do app ficam em web/ e se importam pelo nome (como em `python app.py`)
+WEB_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'web')
+if WEB_DIR not in sys.path:
+    sys.path.insert(0, WEB_DIR)
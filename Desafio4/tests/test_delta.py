@@ -0,0 +1,205 @@
+"""
+Cálculo por diferença (delta.py) contra o cálculo completo.
+
+Cada caso parte de um job já calculado, faz um reenvio com edições nas planilhas e na
+base e confere que o resultado do reenvio, calculado por diferença a partir do job
+anterior, é idêntico ao de um cálculo completo com as mesmas entradas, e que o
+ALTERACOES_VR_MENSAL_*.csv lista exatamente as matrículas cujas linhas mudaram.
+"""
+import logging
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import app as app_module
+import calculation
+from calculation import executar_pipeline_calculo
+from delta import RELATORIO_PREFIX
+from intermediates import gravar_intermediario, ler_intermediario
+from jobs import CONCLUIDO, ERRO, JobManager
+
+FILES_DIR = os.path.join(os.path.dirname(calculation.__file__), os.pardir, 'files')
+COMPETENCIA = '05/2025'
+# Planilhas editadas pelos casos; são regravadas pelo pandas já no primeiro job, para que
+# a edição mude só as linhas (e não os tipos das colunas, o que desliga o cálculo por diferença)
+EDITADAS = ['DESLIGADOS.xlsx', 'FÉRIAS.xlsx', 'AFASTAMENTOS.xlsx']
+
+
+def _resultado(workspace):
+    return workspace.caminho(f"RESULTADO_VR_MENSAL_{COMPETENCIA.replace('/', '_')}.csv")
+
+
+def _relatorio(workspace):
+    return workspace.caminho(f"{RELATORIO_PREFIX}{COMPETENCIA.replace('/', '_')}.csv")
+
+
+def _copiar_entradas(destino, origem_dir):
+    for nome in app_module.EXPECTED_FILENAMES:
+        if nome in EDITADAS:
+            pd.read_excel(os.path.join(origem_dir, nome)).to_excel(destino.entrada(nome), index=False)
+        else:
+            shutil.copy2(os.path.join(origem_dir, nome), destino.entrada(nome))
+
+
+def _linhas_por_matricula(path):
+    df = pd.read_csv(path, sep=';', dtype=str, keep_default_na=False, encoding='utf-8-sig')
+    return {m: sorted(map(tuple, g.to_numpy().tolist())) for m, g in df.groupby('Matricula')}
+
+
+def _matriculas_alteradas(antes, depois):
+    anteriores, atuais = _linhas_por_matricula(antes), _linhas_por_matricula(depois)
+    return {m for m in set(anteriores) | set(atuais) if anteriores.get(m) != atuais.get(m)}
+
+
+def _editar(workspace, rng):
+    """Edições aleatórias em poucas matrículas: férias, desligamentos, afastamentos e base."""
+    ferias = pd.read_excel(workspace.entrada('FÉRIAS.xlsx'))
+    linhas = rng.choice(len(ferias), 3, replace=False)
+    ferias.loc[linhas, 'DIAS DE FÉRIAS'] = rng.integers(1, 30, 3)
+    ferias.to_excel(workspace.entrada('FÉRIAS.xlsx'), index=False)
+
+    desligados = pd.read_excel(workspace.entrada('DESLIGADOS.xlsx'))
+    desligados = desligados.drop(index=rng.choice(len(desligados), 2, replace=False)).reset_index(drop=True)
+    linha = int(rng.integers(len(desligados)))
+    desligados.loc[linha, 'DATA DEMISSÃO'] = pd.Timestamp('2025-05-01') + pd.Timedelta(days=int(rng.integers(0, 30)))
+    desligados.loc[linha, 'COMUNICADO DE DESLIGAMENTO'] = 'OK'
+    desligados.to_excel(workspace.entrada('DESLIGADOS.xlsx'), index=False)
+
+    afastamentos = pd.read_excel(workspace.entrada('AFASTAMENTOS.xlsx'))
+    afastamentos = afastamentos.drop(index=int(rng.integers(len(afastamentos)))).reset_index(drop=True)
+    afastamentos.to_excel(workspace.entrada('AFASTAMENTOS.xlsx'), index=False)
+
+    base = ler_intermediario(workspace.base_unificada)
+    base = base.drop(index=rng.choice(len(base), 2, replace=False))
+    linhas = rng.choice(base.index.to_numpy(), 3, replace=False)
+    base.loc[linhas, 'Sindicato'] = base['Sindicato'].dropna().sample(3, random_state=int(rng.integers(1 << 31))).to_numpy()
+    base = pd.concat([base, base.sample(1, random_state=int(rng.integers(1 << 31)))], ignore_index=True)
+    gravar_intermediario(base, workspace.base_unificada)
+
+
+@pytest.fixture
+def jobs(tmp_path):
+    output_dir = str(tmp_path / 'output')
+    manager = JobManager(output_dir, cache_dir=os.path.join(output_dir, '.cache'), max_workers=2)
+    yield manager
+    manager._executor.shutdown(wait=True)
+
+
+@pytest.mark.parametrize('semente', range(5))
+def test_edicoes_aleatorias_iguais_ao_calculo_completo(jobs, monkeypatch, caplog, semente):
+    caplog.set_level(logging.INFO)
+    rng = np.random.default_rng(semente)
+
+    anterior = jobs.criar(COMPETENCIA)
+    _copiar_entradas(anterior.workspace, FILES_DIR)
+    anterior.workspace.salvar_competencia(COMPETENCIA)
+    app_module.process_files(anterior.workspace)
+    executar_pipeline_calculo(anterior.workspace, salvar_intermediarios=False)
+
+    reenvio = jobs.criar(COMPETENCIA, base_job_id=anterior.id)
+    completo = jobs.criar(COMPETENCIA)
+    _copiar_entradas(reenvio.workspace, anterior.workspace.input_dir)
+    reenvio.workspace.salvar_competencia(COMPETENCIA)
+    shutil.copy2(anterior.workspace.base_unificada, reenvio.workspace.base_unificada)
+    _editar(reenvio.workspace, rng)
+    for nome in os.listdir(reenvio.workspace.input_dir):
+        shutil.copy2(reenvio.workspace.entrada(nome), completo.workspace.entrada(nome))
+    shutil.copy2(reenvio.workspace.base_unificada, completo.workspace.base_unificada)
+    completo.workspace.salvar_competencia(COMPETENCIA)
+
+    caplog.clear()
+    executar_pipeline_calculo(reenvio.workspace)
+    assert 'Cálculo por diferença' in caplog.text
+
+    # Cálculo completo: sem cache de etapas nem cálculo por diferença
+    monkeypatch.setattr(calculation, 'INCREMENTAL_RECALCULATION', False)
+    executar_pipeline_calculo(completo.workspace)
+
+    with open(_resultado(reenvio.workspace), 'rb') as a, open(_resultado(completo.workspace), 'rb') as b:
+        assert a.read() == b.read()
+    relatorio = pd.read_csv(_relatorio(reenvio.workspace), sep=';', dtype=str, encoding='utf-8-sig')
+    esperadas = _matriculas_alteradas(_resultado(anterior.workspace), _resultado(completo.workspace))
+    assert esperadas
+    assert set(relatorio['Matricula']) == esperadas
+    assert not os.path.exists(_relatorio(completo.workspace))
+
+
+def _aguardar(client, job_id, timeout=120):
+    limite = time.monotonic() + timeout
+    while time.monotonic() < limite:
+        estado = client.get(f'/jobs/{job_id}').get_json()
+        if estado['status'] in (CONCLUIDO, ERRO):
+            return estado
+        time.sleep(0.2)
+    raise AssertionError(f"Job {job_id} não terminou")
+
+
+def test_reenvio_por_dois_jobs_calcula_por_diferenca(jobs, monkeypatch, tmp_path, caplog):
+    caplog.set_level(logging.INFO)
+    monkeypatch.setattr(app_module, 'job_manager', jobs)
+    client = app_module.app.test_client()
+    chamadas = threading.Lock()
+
+    # Faz o papel do workflow do n8n: validação, cálculo e conversão do job
+    def webhook(url, json, timeout):
+        with chamadas:
+            n8n = app_module.app.test_client()
+            for rota in ('/validation', '/calculation', '/convert'):
+                resposta = n8n.post(f"{rota}?job_id={json['job_id']}")
+                assert resposta.status_code == 200, resposta.get_data(as_text=True)
+        return type('Resposta', (), {'status_code': 200})()
+    monkeypatch.setattr(app_module.requests, 'post', webhook)
+
+    def enviar(pasta, nomes, **campos):
+        dados = dict(campos, competencia='2025-05',
+                     **{'planilhas[]': [(open(os.path.join(pasta, n), 'rb'), n) for n in nomes]})
+        resposta = client.post('/', data=dados, headers={'Accept': 'application/json'},
+                               content_type='multipart/form-data')
+        assert resposta.status_code == 202, resposta.get_json()
+        return resposta.get_json()
+
+    primeiro = enviar(FILES_DIR, app_module.EXPECTED_FILENAMES)
+    assert _aguardar(client, primeiro['job_id'])['status'] == CONCLUIDO
+
+    # Segundo envio: só a DESLIGADOS.xlsx editada, com as demais planilhas do primeiro job
+    editadas = tmp_path / 'editadas'
+    editadas.mkdir()
+    desligados = pd.read_excel(os.path.join(FILES_DIR, 'DESLIGADOS.xlsx'))
+    removida = str(desligados.iloc[0, 0])
+    desligados.iloc[1:].to_excel(editadas / 'DESLIGADOS.xlsx', index=False)
+    caplog.clear()
+    segundo = enviar(str(editadas), ['DESLIGADOS.xlsx'], base_job_id=primeiro['job_id'])
+    assert sorted(segundo['planilhas_herdadas']) == sorted(set(app_module.EXPECTED_FILENAMES) - {'DESLIGADOS.xlsx'})
+    estado = _aguardar(client, segundo['job_id'])
+    assert estado['status'] == CONCLUIDO
+    assert estado['base_job_id'] == primeiro['job_id']
+    assert 'Cálculo por diferença' in caplog.text
+
+    workspace = jobs.workspace(segundo['job_id'])
+    relatorio = pd.read_csv(_relatorio(workspace), sep=';', dtype=str, encoding='utf-8-sig')
+    assert removida in set(relatorio['Matricula'])
+
+    # O mesmo conjunto, enviado completo e calculado sem cache, dá o mesmo resultado
+    for nome in app_module.EXPECTED_FILENAMES:
+        if nome != 'DESLIGADOS.xlsx':
+            shutil.copy2(os.path.join(FILES_DIR, nome), editadas / nome)
+    monkeypatch.setattr(calculation, 'INCREMENTAL_RECALCULATION', False)
+    terceiro = enviar(str(editadas), app_module.EXPECTED_FILENAMES)
+    assert _aguardar(client, terceiro['job_id'])['status'] == CONCLUIDO
+    with open(_resultado(workspace), 'rb') as a, open(_resultado(jobs.workspace(terceiro['job_id'])), 'rb') as b:
+        assert a.read() == b.read()
+
+
+def test_upload_sem_planilha_obrigatoria(jobs, monkeypatch):
+    monkeypatch.setattr(app_module, 'job_manager', jobs)
+    resposta = app_module.app.test_client().post(
+        '/', data={'competencia': '2025-05', 'planilhas[]': [(open(os.path.join(FILES_DIR, 'ATIVOS.xlsx'), 'rb'), 'ATIVOS.xlsx')]},
+        headers={'Accept': 'application/json'}, content_type='multipart/form-data')
+    assert resposta.status_code == 400
+    assert 'DESLIGADOS.xlsx' in resposta.get_json()['faltando']
+    assert not os.path.isdir(jobs.base_dir) or not os.listdir(jobs.base_dir)
@@ -1,12 +1,20 @@
-from flask import Flask, render_template, send_file, request
+from flask import Flask, Response, render_template, send_file, request, stream_with_context, url_for
+import json
 import pandas as pd
 import os
 import logging
 import requests
-import time
+import shutil
 from validation import run_validation
-from converter import convert_latest_result_to_xlsx
-from calculation import calcular_dias_uteis_por_colaborador, aplicar_regra_desligamento, calcular_valor_total_vr, gerar_planilha_final
+from converter import convert_latest_result_to_xlsx, find_latest_result_csv
+from excel_cache import cache_dir_for, cache_stats, read_excel_many
+from incremental import INCREMENTAL_RECALCULATION, CacheDeEtapas, impressao_digital
+from intermediates import gravar_intermediario
+from unification import unificar_por_chave
+from calculation import executar_pipeline_calculo
+from jobs import JobManager, CONCLUIDO, ERRO
+from profiling import anotar_linhas, medido, metricas, metricas_prometheus
+from workspace import Workspace
 from io import BytesIO
 
 app = Flask(__name__)
@@ -18,13 +26,62 @@ logging.basicConfig(level=logging.DEBUG)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 INPUT_DIR = os.path.join(BASE_DIR, 'files')
 OUTPUT_DIR = os.path.join(BASE_DIR, 'output')
-OUTPUT_FILENAME = os.path.join(OUTPUT_DIR, 'base_unificada.csv')
-OUTPUT_VALID_FILENAME = os.path.join(OUTPUT_DIR, 'base_unificada_validada.csv')
-COMPETENCIA_FILE = os.path.join(OUTPUT_DIR, 'competencia.txt')
+# Cache de planilhas compartilhado por todos os workspaces (endereçado por conteúdo)
+CACHE_DIR = cache_dir_for(OUTPUT_DIR)
 
 # Ensure the output directory exists
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+# Workspace usado pelas rotas chamadas sem job_id (files/ e output/)
+DEFAULT_WORKSPACE = Workspace(OUTPUT_DIR, INPUT_DIR, CACHE_DIR)
+
+N8N_WEBHOOK_URL = os.environ.get(
+    'N8N_WEBHOOK_URL', "http://localhost:5678/webhook/038b55dc-fc6d-4253-8b24-acdf648216eb"
+)
+
+EXPECTED_FILENAMES = [
+    'ATIVOS.xlsx',
+    'FÉRIAS.xlsx',
+    'DESLIGADOS.xlsx',
+    'ADMISSÃO ABRIL.xlsx',
+    'Base dias uteis.xlsx',
+    'Base sindicato x valor.xlsx',
+    'AFASTAMENTOS.xlsx',
+    'APRENDIZ.xlsx',
+    'ESTÁGIO.xlsx',
+    'EXTERIOR.xlsx',
+    'VR MENSAL 05.2025.xlsx',
+]
+
+# Planilhas sem as quais a unificação ou o cálculo não rodam. Sem as demais (APRENDIZ,
+# ESTÁGIO, EXTERIOR...) a regra de validação correspondente é ignorada.
+PLANILHAS_OBRIGATORIAS = [
+    'ATIVOS.xlsx',
+    'FÉRIAS.xlsx',
+    'DESLIGADOS.xlsx',
+    'ADMISSÃO ABRIL.xlsx',
+    'Base dias uteis.xlsx',
+    'Base sindicato x valor.xlsx',
+    'AFASTAMENTOS.xlsx',
+]
+
+# Planilhas lidas pelas etapas (unificação, validação e cálculo) com seus parâmetros de
+# leitura. São convertidas juntas, em paralelo, no início do processamento; as etapas
+# seguintes as encontram no cache de planilhas.
+PLANILHAS_UNIFICACAO = ['ATIVOS.xlsx', 'FÉRIAS.xlsx', 'DESLIGADOS.xlsx', 'ADMISSÃO ABRIL.xlsx']
+PLANILHAS_AUXILIARES = [
+    ('AFASTAMENTOS.xlsx', {}),
+    ('Base sindicato x valor.xlsx', {}),
+    ('Base dias uteis.xlsx', {}),
+    ('Base dias uteis.xlsx', {'header': 1}),
+    ('APRENDIZ.xlsx', {}),
+    ('ESTÁGIO.xlsx', {}),
+    ('EXTERIOR.xlsx', {}),
+]
+
+# Cada envio vira um job com diretório próprio em output/<job_id>/, processado em segundo plano
+job_manager = JobManager(OUTPUT_DIR, cache_dir=CACHE_DIR)
+
 def _normalize_competencia(raw: str) -> str:
     """Normaliza entradas como '2025-09', '2025/09', '09/2025' para 'MM/YYYY'."""
     import re
@@ -53,22 +110,64 @@ def _normalize_competencia(raw: str) -> str:
     return datetime.now().strftime('%m/%Y')
 
 
-def process_files():
+def _job_id_da_requisicao():
+    """`job_id` informado na query string, no formulário ou no corpo JSON (ou None)."""
+    payload = request.get_json(silent=True)
+    return (
+        request.args.get('job_id')
+        or request.form.get('job_id')
+        or (payload.get('job_id') if isinstance(payload, dict) else None)
+    )
+
+
+def _workspace_da_requisicao():
+    """
+    Retorna o Workspace da requisição atual.
+
+    Com `job_id` usa o workspace do job (output/<job_id>/ e output/<job_id>/files/);
+    sem ele, DEFAULT_WORKSPACE. Retorna None se o job informado não existir.
+    """
+    job_id = _job_id_da_requisicao()
+    if not job_id:
+        return DEFAULT_WORKSPACE
+    return job_manager.workspace(job_id)
+
+
+def _job_nao_encontrado():
+    return {"status": "error", "message": "Job não encontrado."}, 404
+
+
+@medido('unificacao')
+def process_files(workspace=DEFAULT_WORKSPACE):
     """
     Unifica as planilhas recebidas em uma única, mantendo apenas os campos desejados.
+
+    Lê as planilhas de `workspace.input_dir` e grava `workspace.base_unificada`.
     """
+    output_filename = workspace.base_unificada
     app.logger.info("Iniciando o processamento dos arquivos...")
     try:
-        def read_and_prepare(path, col_map):
-            app.logger.info(f"Lendo o arquivo: {path}")
-            df = pd.read_excel(path)
+        # Reaproveita a unificação anterior se nenhuma das planilhas unificadas mudou
+        etapas = CacheDeEtapas(workspace) if INCREMENTAL_RECALCULATION else None
+        if etapas:
+            dependencias = {
+                'planilhas': {f: impressao_digital(workspace.entrada(f)) for f in PLANILHAS_UNIFICACAO},
+                'formato': workspace.formato,
+            }
+            chave = etapas.chave('unificacao', **dependencias)
+            if None not in dependencias['planilhas'].values() and etapas.obter_arquivos(chave, [output_filename]):
+                etapas.registrar('unificacao', chave, dependencias, reaproveitada=True)
+                app.logger.info("Planilhas da unificação sem alterações; base unificada anterior reaproveitada.")
+                return f"Arquivo '{os.path.basename(output_filename)}' gerado com sucesso em '{workspace.output_dir}'"
+
+        def read_and_prepare(df, col_map):
             df.columns = df.columns.str.strip()
             # Remove colunas Unnamed
             df = df.loc[:, ~df.columns.str.startswith('Unnamed')]
             df = df.rename(columns=col_map)
-            # Seleciona apenas as colunas de interesse que existem no arquivo
-            cols = [c for c in col_map.values() if c in df.columns]
-            # Remove duplicatas de MATRICULA se houver
+            # Seleciona apenas as colunas de interesse que existem no arquivo (uma vez cada)
+            cols = list(dict.fromkeys(c for c in col_map.values() if c in df.columns))
+            # Se duas colunas viraram a mesma após o rename, mantém a primeira
             df = df.loc[:,~df.columns.duplicated()]
             return df[cols]
 
@@ -88,74 +187,34 @@ def process_files():
             'COMUNICADO DE DESLIGAMENTO': 'COMUNICADO DE DESLIGAMENTO'
         }
 
-        ativos_path = os.path.join(INPUT_DIR, 'ATIVOS.xlsx')
-        ferias_path = os.path.join(INPUT_DIR, 'FÉRIAS.xlsx')
-        desligados_path = os.path.join(INPUT_DIR, 'DESLIGADOS.xlsx')
-        admissao_path = os.path.join(INPUT_DIR, 'ADMISSÃO ABRIL.xlsx')
-
-        df_ativos = read_and_prepare(ativos_path, col_map)
-        df_ferias = read_and_prepare(ferias_path, col_map)
-        df_desligados = read_and_prepare(desligados_path, col_map)
-        df_admissao = read_and_prepare(admissao_path, col_map)
-
-        # Remove duplicatas de MATRICULA antes do merge
-        for df in [df_ativos, df_ferias, df_desligados, df_admissao]:
-            if df.columns.duplicated().any():
-                df = df.loc[:,~df.columns.duplicated()]
-
-        # Faz o merge sequencialmente, sempre removendo duplicatas de MATRICULA
-        dfs = [df_ativos, df_ferias, df_desligados, df_admissao]
-        merged_df = dfs[0]
-        for df in dfs[1:]:
-            # Garante que só existe uma coluna 'MATRICULA' em cada DataFrame antes do merge
-            if merged_df.columns.duplicated().any():
-                merged_df = merged_df.loc[:, ~merged_df.columns.duplicated()]
-            if df.columns.duplicated().any():
-                df = df.loc[:, ~df.columns.duplicated()]
-            # Remove colunas extras 'MATRICULA' se houver
-            merged_df = merged_df.loc[:, ~((merged_df.columns == 'MATRICULA') & (merged_df.columns.duplicated(keep='first')))]
-            df = df.loc[:, ~((df.columns == 'MATRICULA') & (df.columns.duplicated(keep='first')))]
-            merged_df = pd.merge(merged_df, df, on='MATRICULA', how='outer', suffixes=('', '_dup'))
-            # Remove colunas duplicadas de MATRICULA se aparecerem após o merge
-            matricula_cols = [col for col in merged_df.columns if col == 'MATRICULA']
-            if len(matricula_cols) > 1:
-                # Mantém apenas a primeira ocorrência
-                first = True
-                cols_to_keep = []
-                for col in merged_df.columns:
-                    if col == 'MATRICULA':
-                        if first:
-                            cols_to_keep.append(True)
-                            first = False
-                        else:
-                            cols_to_keep.append(False)
-                    else:
-                        cols_to_keep.append(True)
-                merged_df = merged_df.loc[:, cols_to_keep]
-
-        # Coalesce de colunas duplicadas ("*_dup"): preenche valores faltantes e remove sufixos
-        dup_cols = [c for c in merged_df.columns if c.endswith('_dup')]
-        for dup_col in dup_cols:
-            base_col = dup_col[:-4]
-            if base_col in merged_df.columns:
-                # Preenche valores faltantes do base_col com os do dup_col
-                merged_df[base_col] = merged_df[base_col].combine_first(merged_df[dup_col])
-                merged_df.drop(columns=[dup_col], inplace=True)
-            else:
-                # Se a coluna base não existe, apenas renomeia
-                merged_df.rename(columns={dup_col: base_col}, inplace=True)
+        # Lê de uma vez as planilhas da unificação e as auxiliares das etapas seguintes
+        leituras = [(workspace.entrada(f), {}) for f in PLANILHAS_UNIFICACAO]
+        leituras += [(workspace.entrada(f), kw) for f, kw in PLANILHAS_AUXILIARES if os.path.exists(workspace.entrada(f))]
+        app.logger.info(f"Lendo {len(leituras)} planilhas de {workspace.input_dir}")
+        df_ativos, df_ferias, df_desligados, df_admissao = [
+            read_and_prepare(df, col_map) for df in read_excel_many(leituras, workspace.cache_dir)[:len(PLANILHAS_UNIFICACAO)]
+        ]
+
+        # Junção externa única por MATRICULA; em campos repetidos vale a primeira planilha
+        merged_df, estatisticas = unificar_por_chave([
+            ('ATIVOS', df_ativos),
+            ('FÉRIAS', df_ferias),
+            ('DESLIGADOS', df_desligados),
+            ('ADMISSÃO', df_admissao),
+        ])
+        for nome, est in estatisticas.items():
+            app.logger.info(
+                f"{nome}: {est['linhas']} linhas, {est['novas']} matrículas novas, "
+                f"{est['colisoes']} já presentes, {est['duplicadas']} repetidas, "
+                f"{est['valores_ignorados']} valores ignorados."
+            )
 
         campos = [
             'MATRICULA', 'Admissão', 'Cargo', 'DESC. SITUACAO',
             'DIAS DE FÉRIAS', 'Sindicato', 'DATA DEMISSÃO', 'COMUNICADO DE DESLIGAMENTO'
         ]
-        # Remove colunas duplicadas de 'Cargo' se existirem
-        cargo_cols = [col for col in merged_df.columns if col.lower() == 'cargo']
-        if len(cargo_cols) > 1:
-            # Mantém apenas a primeira ocorrência
-            merged_df = merged_df.loc[:, ~((merged_df.columns.str.lower() == 'cargo') & (merged_df.columns.duplicated(keep='first')))]
-
         merged_df = merged_df[campos]
+        anotar_linhas(len(merged_df))
 
         # Normaliza/formatta a coluna de Admissão para dd/mm/aaaa se existir
         if 'Admissão' in merged_df.columns:
@@ -175,11 +234,14 @@ def process_files():
                 # Se não for possível formatar, mantém como está
                 pass
 
-        app.logger.info(f"Salvando arquivo unificado em: {OUTPUT_FILENAME}")
-        merged_df.to_csv(OUTPUT_FILENAME, index=False, sep=';', encoding='utf-8-sig')
+        app.logger.info(f"Salvando arquivo unificado em: {output_filename}")
+        gravar_intermediario(merged_df, output_filename)
+        if etapas:
+            etapas.guardar_arquivos(chave, [output_filename])
+            etapas.registrar('unificacao', chave, dependencias, reaproveitada=False)
 
         app.logger.info("Processamento concluído com sucesso.")
-        return f"Arquivo '{os.path.basename(OUTPUT_FILENAME)}' gerado com sucesso em '{OUTPUT_DIR}'"
+        return f"Arquivo '{os.path.basename(output_filename)}' gerado com sucesso em '{workspace.output_dir}'"
     except FileNotFoundError as e:
         app.logger.error(f"Erro de arquivo não encontrado: {e.filename}")
         return f"Erro: Arquivo não encontrado - {e.filename}"
@@ -187,127 +249,182 @@ def process_files():
         app.logger.error(f"Ocorreu um erro inesperado: {e}", exc_info=True)
         return f"Ocorreu um erro inesperado: {e}"
 
+def _localizar_xlsx(workspace):
+    """Retorna o arquivo VR MENSAL *.xlsx mais recente do workspace (ou None)."""
+    xlsx_prefix = 'VR MENSAL '
+    try:
+        candidatos = [
+            workspace.caminho(f)
+            for f in os.listdir(workspace.output_dir)
+            if f.startswith(xlsx_prefix) and f.lower().endswith('.xlsx')
+        ]
+    except FileNotFoundError:
+        return None
+    if not candidatos:
+        return None
+    # pega o mais recente
+    candidatos.sort(key=lambda p: os.path.getmtime(p), reverse=True)
+    return candidatos[0]
+
+
+def _executar_job(job):
+    """
+    Fluxo completo de um job, executado no pool de workers.
+
+    Gera a base unificada no diretório do job, dispara o webhook (n8n) informando o
+    job_id para que /validation, /calculation e /convert usem o mesmo diretório e
+    aguarda o XLSX final. Retorna o caminho do VR MENSAL *.xlsx.
+    """
+    # 1) Gera a base_unificada.csv primeiro
+    message = process_files(job.workspace)
+    if not os.path.exists(job.workspace.base_unificada):
+        raise RuntimeError(message)
+
+    # 2) Dispara o webhook (n8n) que irá chamar a API /calculation
+    try:
+        response = requests.post(
+            N8N_WEBHOOK_URL,
+            json={'job_id': job.id, 'competencia': job.competencia},
+            timeout=120
+        )
+        if response.status_code == 200:
+            app.logger.info(f"Webhook chamado com sucesso (job {job.id}).")
+        else:
+            app.logger.error(f"Webhook retornou status {response.status_code} (job {job.id})")
+    except Exception as e:
+        app.logger.error(f"Erro ao chamar webhook (job {job.id}): {e}")
+
+    # 3) Aguarda o sinal de /convert de que o XLSX (VR MENSAL *.xlsx) do job foi gerado
+    timeout_s = int(os.environ.get('RESULT_TIMEOUT_SECONDS', '300'))
+    result_path = job_manager.aguardar_resultado(job, timeout_s, verificar=lambda: _localizar_xlsx(job.workspace))
+    if result_path:
+        app.logger.info(f"Arquivo final encontrado: {result_path}")
+        return result_path
+    raise TimeoutError("Tempo de espera esgotado para geração do arquivo VR MENSAL (XLSX). Tente novamente.")
+
+
 @app.route('/', methods=['GET', 'POST'])
 def index():
-    """Renders the main page and handles file processing on POST."""
+    """Renders the main page and, on POST, enqueues a processing job for the uploaded files."""
     message = None
     if request.method == 'POST':
+        quer_json = request.accept_mimetypes.best_match(['application/json', 'text/html']) == 'application/json'
+        files = [f for f in request.files.getlist('planilhas[]') if f and f.filename in EXPECTED_FILENAMES]
+        if not files:
+            message = "Nenhuma das planilhas esperadas foi enviada."
+            if quer_json:
+                return {"status": "error", "message": message}, 400
+            return render_template('index.html', message=message)
+        # Reenvio de um conjunto já processado: as planilhas não enviadas vêm do job anterior
+        base_job_id = request.form.get('base_job_id') or None
+        base = job_manager.workspace(base_job_id) if base_job_id else None
+        if base_job_id and base is None:
+            message = f"Job anterior não encontrado: {base_job_id}."
+            if quer_json:
+                return {"status": "error", "message": message}, 404
+            return render_template('index.html', message=message), 404
+        enviadas = {f.filename for f in files}
+        herdadas = [f for f in EXPECTED_FILENAMES
+                    if f not in enviadas and base is not None and os.path.exists(base.entrada(f))]
+        faltando = [f for f in PLANILHAS_OBRIGATORIAS if f not in enviadas and f not in herdadas]
+        if faltando:
+            message = f"Planilhas obrigatórias não enviadas: {', '.join(faltando)}."
+            if quer_json:
+                return {"status": "error", "message": message, "faltando": faltando}, 400
+            return render_template('index.html', message=message), 400
+
         # 0) Lê e persiste a competência informada pelo usuário
         raw_comp = request.form.get('competencia')  # ex.: '2025-09' do input type=month
         competencia = _normalize_competencia(raw_comp)
+        job = job_manager.criar(competencia, base_job_id)
         try:
-            with open(COMPETENCIA_FILE, 'w', encoding='utf-8') as cf:
-                cf.write(competencia)
-            app.logger.info(f"Competência recebida: {competencia} (raw='{raw_comp}')")
+            job.workspace.salvar_competencia(competencia)
+            app.logger.info(f"Competência recebida: {competencia} (raw='{raw_comp}', job {job.id})")
         except Exception as e:
             app.logger.error(f"Falha ao salvar competência: {e}")
-        expected_filenames = [
-            'ATIVOS.xlsx',
-            'FÉRIAS.xlsx',
-            'DESLIGADOS.xlsx',
-            'ADMISSÃO ABRIL.xlsx',
-            'Base dias uteis.xlsx',              
-            'Base sindicato x valor.xlsx',
-            'AFASTAMENTOS.xlsx',
-            'APRENDIZ.xlsx',
-            'ESTÁGIO.xlsx',
-            'EXTERIOR.xlsx',
-            'VR MENSAL 05.2025.xlsx',
-        ]
-        files = request.files.getlist('planilhas[]')
-        saved_any = False
+
         for file in files:
-            if file and file.filename in expected_filenames:
-                save_path = os.path.join(INPUT_DIR, file.filename)
-                file.save(save_path)
-                saved_any = True
-        # 1) Gera a base_unificada.csv primeiro
-        if saved_any:
-            message = process_files()
-
-            # 2) Dispara o webhook (n8n) que irá chamar a API /calculation
-            try:
-                # Read the generated file and send it via the webhook
-                if os.path.exists(OUTPUT_FILENAME):
-                    response = requests.post(
-                        "http://localhost:5678/webhook/038b55dc-fc6d-4253-8b24-acdf648216eb",
-                        timeout=120
-                    )
-                    if response.status_code == 200:
-                        app.logger.info("Webhook chamado com sucesso.")
-                        # Aqui devemos retornar o arquivo XLSX já convertido no diretório de saída
-                        xlsx_prefix = 'VR MENSAL '
-                        try:
-                            candidatos = [
-                                os.path.join(OUTPUT_DIR, f)
-                                for f in os.listdir(OUTPUT_DIR)
-                                if f.startswith(xlsx_prefix) and f.lower().endswith('.xlsx')
-                            ]
-                        except FileNotFoundError:
-                            return "Arquivo não encontrado.", 404
-                        if candidatos:
-                            # pega o mais recente
-                            candidatos.sort(key=lambda p: os.path.getmtime(p), reverse=True)
-                            result_path = candidatos[0]
-                            return send_file(result_path, as_attachment=True)
-                        else:
-                            return "Arquivo VR MENSAL *.xlsx não encontrado.", 404
-                    else:
-                        app.logger.error(f"Webhook retornou status {response.status_code}")
-                else:
-                    app.logger.error("Arquivo base_unificada.csv não encontrado para envio via webhook.")
-            except Exception as e:
-                app.logger.error(f"Erro ao chamar webhook: {e}")
-
-            # 3) Aguarda a geração do arquivo XLSX (VR MENSAL *.xlsx) e faz o download
-            start_time = time.time()
-            timeout_s = int(os.environ.get('RESULT_TIMEOUT_SECONDS', '300'))
-            xlsx_prefix = 'VR MENSAL '
-            result_path = None
-            while time.time() - start_time < timeout_s:
-                try:
-                    candidatos = [
-                        os.path.join(OUTPUT_DIR, f)
-                        for f in os.listdir(OUTPUT_DIR)
-                        if f.startswith(xlsx_prefix) and f.lower().endswith('.xlsx')
-                    ]
-                except FileNotFoundError:
-                    candidatos = []
-                if candidatos:
-                    # pega o mais recente e, de preferência, gerado após o início da espera
-                    candidatos.sort(key=lambda p: os.path.getmtime(p), reverse=True)
-                    latest = candidatos[0]
-                    if os.path.getmtime(latest) >= start_time - 1:  # tolerância de 1s
-                        result_path = latest
-                        break
-                time.sleep(1)
-
-            if result_path and os.path.exists(result_path):
-                app.logger.info(f"Arquivo final encontrado: {result_path}. Enviando para download...")
-                return send_file(result_path, as_attachment=True)
-            else:
-                message = (
-                    (message + ' | ') if message else ''
-                ) + "Tempo de espera esgotado para geração do arquivo VR MENSAL (XLSX). Tente novamente."
+            file.save(job.workspace.entrada(file.filename))
+        for filename in herdadas:
+            shutil.copy2(base.entrada(filename), job.workspace.entrada(filename))
+        if herdadas:
+            job.planilhas_herdadas = herdadas
+            job.salvar()
+            app.logger.info(f"Job {job.id}: planilhas do job {base_job_id}: {', '.join(herdadas)}")
+
+        job_manager.submeter(job, _executar_job)
+        payload = {
+            "status": "accepted",
+            "job_id": job.id,
+            "base_job_id": base_job_id,
+            "planilhas_herdadas": herdadas,
+            "status_url": url_for('job_status', job_id=job.id),
+            "result_url": url_for('job_result', job_id=job.id),
+            "events_url": url_for('job_events', job_id=job.id),
+        }
+        if quer_json:
+            return payload, 202
+        message = f"Processamento iniciado (job {job.id}). Acompanhe em {payload['status_url']}."
+        if herdadas:
+            message += f" Planilhas do job {base_job_id}: {', '.join(herdadas)}."
     return render_template('index.html', message=message)
 
 
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Situação de um job: pendente, executando, concluido ou erro."""
+    job = job_manager.obter(job_id)
+    if job is None:
+        return _job_nao_encontrado()
+    return job.to_dict(), 200
+
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """Server-Sent Events com a situação do job a cada mudança; o stream termina quando o job finaliza."""
+    if job_manager.obter(job_id) is None:
+        return _job_nao_encontrado()
+
+    def eventos():
+        for estado in job_manager.acompanhar(job_id):
+            if estado is None:
+                yield ": keep-alive\n\n"
+            else:
+                yield f"data: {json.dumps(estado, ensure_ascii=False)}\n\n"
+
+    return Response(
+        stream_with_context(eventos()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    """Baixa o XLSX final do job; 202 enquanto ainda está em processamento."""
+    job = job_manager.obter(job_id)
+    if job is None:
+        return _job_nao_encontrado()
+    if job.status == ERRO:
+        return job.to_dict(), 409
+    if job.status != CONCLUIDO:
+        return job.to_dict(), 202
+    if not job.result_path or not os.path.exists(job.result_path):
+        return {"status": "error", "message": "Arquivo VR MENSAL *.xlsx não encontrado."}, 404
+    return send_file(job.result_path, as_attachment=True)
+
+
 @app.route('/download')
 def download_file():
-    """Allows the user to download the generated RESULTADO_VR_MENSAL_*.csv file."""
-    target_prefix = 'RESULTADO_VR_MENSAL_'
-    try:
-        candidatos = [
-            os.path.join(OUTPUT_DIR, f)
-            for f in os.listdir(OUTPUT_DIR)
-            if f.startswith(target_prefix) and f.lower().endswith('.csv')
-        ]
-    except FileNotFoundError:
-        return "Arquivo não encontrado.", 404
-    if candidatos:
-        # pega o mais recente
-        candidatos.sort(key=lambda p: os.path.getmtime(p), reverse=True)
-        result_path = candidatos[0]
+    """Allows the user to download the generated RESULTADO_VR_MENSAL_*.csv file.
+
+    Serve o arquivo da competência salva no workspace; sem competência, o mais recente.
+    """
+    workspace = _workspace_da_requisicao()
+    if workspace is None:
+        return _job_nao_encontrado()
+    result_path = find_latest_result_csv(workspace.output_dir, workspace.ler_competencia())
+    if result_path:
         return send_file(result_path, as_attachment=True)
     else:
         return "Arquivo RESULTADO_VR_MENSAL_*.csv não encontrado.", 404
@@ -315,8 +432,17 @@ def download_file():
 @app.route('/convert', methods=['POST'])
 def convert_to_xlsx():
     """Converte o arquivo RESULTADO_VR_MENSAL_*.csv mais recente para XLSX e retorna para download."""
+    workspace = _workspace_da_requisicao()
+    if workspace is None:
+        return _job_nao_encontrado()
     try:
-        xlsx_path = convert_latest_result_to_xlsx(OUTPUT_DIR, OUTPUT_DIR)
+        xlsx_path = convert_latest_result_to_xlsx(
+            workspace.output_dir, workspace.output_dir, competencia=workspace.ler_competencia()
+        )
+        job_id = _job_id_da_requisicao()
+        if job_id:
+            # Libera imediatamente o worker que aguarda este job
+            job_manager.sinalizar_resultado(job_id, xlsx_path)
         if os.path.exists(xlsx_path):
             return send_file(xlsx_path, as_attachment=True)
         return {"status": "error", "message": "Falha ao localizar o XLSX gerado."}, 500
@@ -330,18 +456,23 @@ def convert_to_xlsx():
 def validation():
     """Endpoint que valida o arquivo base_unificada.csv gerado.
 
-    - POST: executa a validação no OUTPUT_FILENAME e retorna o arquivo validado para download.
+    - POST: executa a validação no base_unificada.csv e retorna o arquivo validado para download.
     - GET: retorna instruções simples.
+    - `job_id` (opcional) usa o diretório do job em vez de output/.
     """
     if request.method == 'GET':
         return "Use POST para executar validação no arquivo base_unificada.csv.", 200
 
-    # Verifica se o OUTPUT_FILENAME existe
-    if not os.path.exists(OUTPUT_FILENAME):
+    workspace = _workspace_da_requisicao()
+    if workspace is None:
+        return _job_nao_encontrado()
+
+    # Verifica se a base unificada existe
+    if not os.path.exists(workspace.base_unificada):
         return {"status": "error", "message": "Arquivo base_unificada.csv não encontrado."}, 400
 
-    # Executa validação apontando para o OUTPUT_FILENAME
-    result = run_validation(INPUT_DIR, OUTPUT_DIR, base_csv_path=OUTPUT_FILENAME)
+    # Executa validação apontando para a base unificada
+    result = run_validation(workspace)
     if isinstance(result, dict):
         if result.get('success'):
             output_path = result.get('output_path')
@@ -360,41 +491,46 @@ def validation():
 def calculation():
     """
     Endpoint HTTP para calcular e adicionar o campo de dias úteis no CSV.
-    Não espera arquivo no POST; usa o arquivo presente no diretório de saída.
+    Não espera arquivo no POST; usa o arquivo presente no diretório de saída
+    (o do job, se `job_id` for informado, ou output/).
 
     Prioridade de arquivos de entrada:
-    1. OUTPUT_VALID_FILENAME (base_unificada_validada.csv)
-    2. OUTPUT_FILENAME (base_unificada.csv) — fallback
+    1. base_unificada_validada.csv
+    2. base_unificada.csv — fallback
 
     NÃO retorna o arquivo final como anexo; retorna apenas um JSON com status em caso de sucesso.
     """
+    workspace = _workspace_da_requisicao()
+    if workspace is None:
+        return _job_nao_encontrado()
     try:
         # Não espera arquivo enviado via POST: escolhe arquivo no diretório de output
-        if os.path.exists(OUTPUT_VALID_FILENAME):
-            output_csv = OUTPUT_VALID_FILENAME
-            app.logger.info(f"Usando arquivo validado: {output_csv}")
-        elif os.path.exists(OUTPUT_FILENAME):
-            output_csv = OUTPUT_FILENAME
-            app.logger.warning(f"Arquivo validado não encontrado. Usando fallback: {output_csv}")
-        else:
+        output_csv = workspace.base_para_calculo()
+        if output_csv is None:
             app.logger.error("Nenhum arquivo de entrada encontrado para execução dos cálculos.")
             return {"status": "error", "message": "Nenhum arquivo de entrada encontrado. Certifique-se que 'base_unificada_validada.csv' ou 'base_unificada.csv' exista em output/."}, 400
+        if output_csv == workspace.base_validada:
+            app.logger.info(f"Usando arquivo validado: {output_csv}")
+        else:
+            app.logger.warning(f"Arquivo validado não encontrado. Usando fallback: {output_csv}")
 
-        # Executa pipeline de cálculos usando o arquivo escolhido
-        app.logger.info(f"Iniciando pipeline de cálculos usando: {output_csv}")
-        calcular_dias_uteis_por_colaborador(INPUT_DIR, output_csv)
-        aplicar_regra_desligamento(INPUT_DIR, output_csv)
-        calcular_valor_total_vr(INPUT_DIR, output_csv)
         # Tenta carregar competência previamente salva no upload
         competencia = None
         try:
-            if os.path.exists(COMPETENCIA_FILE):
-                with open(COMPETENCIA_FILE, 'r', encoding='utf-8') as cf:
-                    competencia = cf.read().strip()
+            competencia = workspace.ler_competencia()
         except Exception as e:
             app.logger.warning(f"Não foi possível ler competência salva: {e}")
 
-        final_path = gerar_planilha_final(INPUT_DIR, output_csv, competencia=competencia)
+        # Modo auditoria: grava também os CSVs intermediários de cada etapa
+        salvar_intermediarios = (
+            request.args.get('audit', os.environ.get('CALCULATION_AUDIT', '0')).lower() in ('1', 'true', 'sim')
+        )
+
+        # Executa pipeline de cálculos em memória usando o arquivo escolhido
+        app.logger.info(f"Iniciando pipeline de cálculos usando: {output_csv} (intermediários: {salvar_intermediarios})")
+        final_path = executar_pipeline_calculo(
+            workspace, competencia=competencia, salvar_intermediarios=salvar_intermediarios, base_csv=output_csv
+        )
 
         if final_path and os.path.exists(final_path):
             app.logger.info(f"Processamento concluído. Arquivo final gerado em: {final_path}")
@@ -407,5 +543,19 @@ def calculation():
         app.logger.error(f"Erro no cálculo de dias úteis: {e}", exc_info=True)
         return {"status": "error", "message": str(e)}, 500
 
+@app.route('/metrics')
+def metrics():
+    """
+    Tempo de relógio, CPU, linhas e memória por etapa e por leitura de planilha, somados
+    desde o início do processo, mais os contadores do cache de planilhas. JSON por
+    padrão; texto do Prometheus com `?format=prometheus` ou `Accept: text/plain`.
+    """
+    formato = request.args.get('format')
+    if formato is None and request.accept_mimetypes.best_match(['application/json', 'text/plain']) == 'text/plain':
+        formato = 'prometheus'
+    if formato == 'prometheus':
+        return Response(metricas_prometheus(), mimetype='text/plain; version=0.0.4')
+    return dict(metricas(), cache_planilhas=cache_stats()), 200
+
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,200 @@
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    _HAS_ARROW = True
+except ImportError:
+    _HAS_ARROW = False
+
+logger = logging.getLogger("audit")
+
+# Nível da auditoria do cálculo: full (um registro por matrícula e etapa), sampled (só
+# as matrículas da amostra), summary (só o resumo por etapa e regra) ou off
+COMPLETO = 'full'
+AMOSTRA = 'sampled'
+RESUMO = 'summary'
+DESLIGADO = 'off'
+NIVEIS = (COMPLETO, AMOSTRA, RESUMO, DESLIGADO)
+CALCULATION_AUDIT_LEVEL = os.environ.get('CALCULATION_AUDIT_LEVEL', RESUMO).strip().lower()
+# No nível sampled, 1 em cada N matrículas (sempre as mesmas, em todas as etapas)
+CALCULATION_AUDIT_SAMPLE = int(os.environ.get('CALCULATION_AUDIT_SAMPLE', '100'))
+# Registros acumulados em memória antes de cada gravação no arquivo
+CALCULATION_AUDIT_BUFFER_ROWS = int(os.environ.get('CALCULATION_AUDIT_BUFFER_ROWS', '100000'))
+# jsonl (um objeto JSON por linha) ou parquet (colunar, bem mais rápido de gravar no nível full)
+CALCULATION_AUDIT_FORMAT = os.environ.get('CALCULATION_AUDIT_FORMAT', 'jsonl').strip().lower()
+FORMATOS = ('jsonl', 'parquet')
+AUDITORIA_PREFIX = 'AUDITORIA_VR_MENSAL_'
+
+COLUNAS = ['matricula', 'etapa', 'regra', 'antes', 'depois', 'motivo']
+
+
+def validar_nivel(nivel):
+    """Normaliza o nível da auditoria; ValueError se for desconhecido."""
+    nivel = str(nivel).strip().lower()
+    if nivel not in NIVEIS:
+        raise ValueError(f"Nível de auditoria inválido: {nivel!r} (use {', '.join(NIVEIS)})")
+    return nivel
+
+
+def validar_formato(formato):
+    """Normaliza o formato do arquivo de auditoria; ValueError se for desconhecido ou se faltar o pyarrow."""
+    formato = str(formato).strip().lower()
+    if formato not in FORMATOS:
+        raise ValueError(f"Formato de auditoria inválido: {formato!r} (use {', '.join(FORMATOS)})")
+    if formato == 'parquet' and not _HAS_ARROW:
+        raise ValueError("O formato 'parquet' requer o pacote pyarrow")
+    return formato
+
+
+def caminho_auditoria(output_dir, competencia, formato=None):
+    """AUDITORIA_VR_MENSAL_MM_YYYY.jsonl (ou .parquet), com '/' trocado por '_'."""
+    formato = validar_formato(formato or CALCULATION_AUDIT_FORMAT)
+    return os.path.join(output_dir, f"{AUDITORIA_PREFIX}{str(competencia).replace('/', '_')}.{formato}")
+
+
+def _na_amostra(matricula, a_cada):
+    """Máscara das matrículas (texto) da amostra, pelo hash do texto: estável entre execuções."""
+    hashes = pd.util.hash_array(matricula)
+    return hashes % np.uint64(a_cada) == 0
+
+
+def _numeros(valores):
+    """Coluna antes/depois como float (o que não for número vira nulo)."""
+    if valores is None:
+        return np.nan
+    return pd.to_numeric(valores, errors='coerce').to_numpy(dtype='float64')
+
+
+def _esquema_arrow():
+    texto = pa.string()
+    return pa.schema([('matricula', texto), ('etapa', texto), ('regra', texto),
+                      ('antes', pa.float64()), ('depois', pa.float64()), ('motivo', texto)])
+
+
+class RegistroDeAuditoria:
+    """
+    Auditoria estruturada do cálculo em AUDITORIA_VR_MENSAL_*.jsonl (ou .parquet).
+
+    Cada etapa entrega, em lote, as colunas de COLUNAS (matrícula, regra aplicada,
+    valor antes e depois da etapa e motivo); os registros ficam em memória até
+    CALCULATION_AUDIT_BUFFER_ROWS e então são gravados de uma vez. No JSONL cada
+    registro é um objeto por linha e no fim vem o resumo por etapa e regra (objetos
+    com "resumo": true, contagem e somas de antes/depois); no Parquet o resumo fica nos
+    metadados do arquivo (chave 'resumo'). O nível summary grava só o resumo. O
+    arquivo é escrito com nome temporário e só aparece no destino em `concluir()`;
+    use como gerenciador de contexto para descartá-lo em caso de erro.
+    """
+
+    def __init__(self, path, nivel=None, amostra=None, buffer_linhas=None):
+        self.path = path
+        self.formato = validar_formato(os.path.splitext(path)[1].lstrip('.'))
+        self.nivel = validar_nivel(nivel or CALCULATION_AUDIT_LEVEL)
+        self.amostra = max(1, amostra or CALCULATION_AUDIT_SAMPLE)
+        self.buffer_linhas = buffer_linhas or CALCULATION_AUDIT_BUFFER_ROWS
+        self._tmp = f"{path}.{os.getpid()}.tmp"
+        self._arquivo = None
+        self._buffer = []
+        self._linhas_buffer = 0
+        self._resumos = []
+
+    @property
+    def ativo(self):
+        return self.nivel != DESLIGADO
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, tipo, valor, traceback):
+        if tipo is None:
+            self.concluir()
+        else:
+            self.descartar()
+        return False
+
+    def registrar(self, etapa, matricula, regra, antes=None, depois=None, motivo=None):
+        """
+        Registra uma etapa para várias matrículas de uma vez: `matricula` e `regra` são
+        Series alinhadas; `antes`, `depois` e `motivo` podem ser Series ou omitidos.
+        """
+        if not self.ativo or len(matricula) == 0:
+            return
+        valores = pd.DataFrame({
+            'etapa': etapa,
+            'regra': regra.astype(str).to_numpy(dtype=object),
+            'antes': _numeros(antes),
+            'depois': _numeros(depois),
+        })
+        self._resumos.append(valores.groupby(['etapa', 'regra'], sort=False).agg(
+            linhas=('regra', 'size'), soma_antes=('antes', 'sum'), soma_depois=('depois', 'sum')))
+        if self.nivel == RESUMO:
+            return
+        matricula = matricula.astype(str).to_numpy(dtype=object)
+        valores.insert(0, 'matricula', matricula)
+        valores['motivo'] = None if motivo is None else motivo.astype(object).to_numpy()
+        registros = valores
+        if self.nivel == AMOSTRA:
+            registros = registros[_na_amostra(matricula, self.amostra)]
+        self._buffer.append(registros)
+        self._linhas_buffer += len(registros)
+        if self._linhas_buffer >= self.buffer_linhas:
+            self._gravar_buffer()
+
+    def _abrir(self):
+        if self._arquivo is None:
+            if self.formato == 'parquet':
+                self._arquivo = pq.ParquetWriter(self._tmp, _esquema_arrow())
+            else:
+                self._arquivo = open(self._tmp, 'w', encoding='utf-8')
+        return self._arquivo
+
+    def _gravar_buffer(self):
+        if not self._buffer:
+            return
+        registros = pd.concat(self._buffer, ignore_index=True)
+        self._buffer = []
+        self._linhas_buffer = 0
+        if not len(registros):
+            return
+        if self.formato == 'parquet':
+            self._abrir().write_table(pa.Table.from_pandas(registros, schema=_esquema_arrow(), preserve_index=False))
+        else:
+            # to_json(lines=True) já termina cada registro com '\n'
+            self._abrir().write(registros.to_json(orient='records', lines=True, force_ascii=False))
+
+    def resumo(self):
+        """Resumo por etapa e regra (DataFrame) dos registros recebidos até agora."""
+        if not self._resumos:
+            return pd.DataFrame(columns=['etapa', 'regra', 'linhas', 'soma_antes', 'soma_depois'])
+        resumo = pd.concat(self._resumos).groupby(level=['etapa', 'regra'], sort=False).sum()
+        return resumo.reset_index()
+
+    def concluir(self):
+        """Grava o que estiver no buffer e o resumo e publica o arquivo (nada é gravado no nível off)."""
+        if not self.ativo:
+            return None
+        self._gravar_buffer()
+        arquivo = self._abrir()
+        resumo = self.resumo().to_dict(orient='records')
+        for registro in resumo:
+            registro['linhas'] = int(registro['linhas'])
+        if self.formato == 'parquet':
+            arquivo.add_key_value_metadata({'resumo': json.dumps(resumo, ensure_ascii=False)})
+        else:
+            for registro in resumo:
+                arquivo.write(json.dumps(dict(registro, resumo=True), ensure_ascii=False) + '\n')
+        arquivo.close()
+        os.replace(self._tmp, self.path)
+        logger.info(f"Auditoria do cálculo ({self.nivel}) salva em: {self.path}")
+        return self.path
+
+    def descartar(self):
+        if self._arquivo is not None:
+            self._arquivo.close()
+        if os.path.exists(self._tmp):
+            os.remove(self._tmp)
@@ -1,8 +1,24 @@
+import numpy as np
 import pandas as pd
 import os
 import re
 import unicodedata
 
+from audit import RegistroDeAuditoria, caminho_auditoria
+from delta import (CALCULATION_DELTA, CALCULATION_DELTA_MAX_FRACTION, RELATORIO_PREFIX, assinatura_global,
+                   guardar_calculo, impressoes_por_matricula, matriculas_alteradas, mesclar_resultado,
+                   obter_calculo, relatorio_alteracoes)
+from excel_cache import cache_dir_for, read_excel_cached
+from incremental import INCREMENTAL_RECALCULATION, VERSAO_ETAPAS, CacheDeEtapas, impressao_digital
+from intermediates import GravadorEmBlocos, gravar_intermediario, ler_em_blocos, ler_intermediario
+from profiling import anotar_linhas, medido
+
+# Modo streaming: bases a partir deste tamanho são calculadas em blocos de
+# CALCULATION_CHUNK_ROWS linhas, com memória limitada ao bloco e às planilhas auxiliares
+CALCULATION_STREAMING_MIN_BYTES = int(os.environ.get('CALCULATION_STREAMING_MIN_BYTES', str(50 * 1024 * 1024)))
+CALCULATION_CHUNK_ROWS = int(os.environ.get('CALCULATION_CHUNK_ROWS', '50000'))
+
+
 # Helpers para normalização de texto e mapeamento UF->Estado (sem acentos)
 def _normalize_text(s: str) -> str:
     if s is None:
@@ -44,6 +60,7 @@ UF_TO_ESTADO = {
     'TO': 'TOCANTINS',
 }
 
+
 def _build_valor_mapping(df_valores: pd.DataFrame):
     """Cria mapa de chave->valor usando colunas de sindicato/estado, com aliases:
     - Normaliza texto (sem acentos)
@@ -104,28 +121,178 @@ def _build_valor_mapping(df_valores: pd.DataFrame):
 
     return map_raw, map_norm
 
-def calcular_dias_uteis_por_colaborador(input_dir, output_csv):
+# Colunas de estado/UF consultadas na base quando o sindicato não resolve sozinho
+ESTADO_COLUMNS = ['ESTADO', 'UF', 'STATE']
+
+# Nomes de 'reason' por etapa: as demais regras recebem apenas o prefixo
+_REASONS = {
+    'vr': {'prefixo': 'match_', 'sindicato_raw': 'match_exact_sindicato', None: 'no_match'},
+    'final': {'prefixo': 'fallback_', 'sindicato_raw': 'fallback_by_sindicato_raw',
+              'sindicato_norm': 'fallback_by_sindicato_norm', None: 'no_valor_found'},
+}
+
+
+class SindicatoValorResolver:
     """
-    Adiciona ao CSV unificado um campo 'DIAS_UTEIS' com a quantidade de dias úteis por colaborador,
-    considerando sindicato, férias, afastamentos e data de desligamento.
+    Resolve o valor diário de VR por sindicato/UF a partir de 'Base sindicato x valor.xlsx'.
+
+    Os mapas são montados uma vez via `_build_valor_mapping` e cada combinação
+    distinta (sindicato, estados, etapa) é resolvida uma única vez; o resultado
+    fica em cache junto com a `reason`. Uma mesma instância pode ser compartilhada
+    entre `calcular_valor_total_vr` (etapa 'vr') e `gerar_planilha_final` (etapa 'final').
     """
-    import logging
-    logging.basicConfig(level=logging.INFO)
-    logger = logging.getLogger("calculation")
 
-    # Carrega o arquivo base_unificada.csv
-    base = pd.read_csv(output_csv, sep=';', encoding='utf-8-sig')
-    logger.info(f"Arquivo base carregado: {output_csv} ({len(base)} registros)")
+    def __init__(self, map_raw, map_norm):
+        self.map_raw = map_raw
+        self.map_norm = map_norm
+        self._cache = {}
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_dataframe(cls, df_valores: pd.DataFrame):
+        return cls(*_build_valor_mapping(df_valores))
+
+    def resolve(self, sindicato: str, estados=(), etapa: str = 'vr'):
+        """
+        Retorna (valor_unitario, reason) para o sindicato já em maiúsculas.
+
+        `estados` é uma tupla de pares (coluna, valor em maiúsculas) vindos das
+        colunas ESTADO/UF/STATE preenchidas na linha, na ordem de ESTADO_COLUMNS.
+        A etapa 'final' também aceita o nome normalizado exato do sindicato.
+        """
+        chave = (sindicato, estados, etapa)
+        if chave in self._cache:
+            self.hits += 1
+            return self._cache[chave]
+        self.misses += 1
+        valor, regra = self._lookup(sindicato, estados, etapa == 'final')
+        reasons = _REASONS[etapa]
+        reason = reasons[regra] if regra in reasons else reasons['prefixo'] + regra
+        resultado = (0.0 if valor is None else valor, reason)
+        self._cache[chave] = resultado
+        return resultado
 
-    # Carrega as planilhas auxiliares
-    dias_uteis = pd.read_excel(os.path.join(input_dir, 'Base dias uteis.xlsx'), header=1)
-    logger.info(f"Planilha de dias úteis carregada ({len(dias_uteis)} sindicatos)")
-    sindicato_valor = pd.read_excel(os.path.join(input_dir, 'Base sindicato x valor.xlsx'))
-    afastamentos = pd.read_excel(os.path.join(input_dir, 'AFASTAMENTOS.xlsx'))
-    logger.info(f"Planilha de afastamentos carregada ({len(afastamentos)} registros)")
-    ferias = pd.read_excel(os.path.join(input_dir, 'FÉRIAS.xlsx'))
-    desligados = pd.read_excel(os.path.join(input_dir, 'DESLIGADOS.xlsx'))
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entradas': len(self._cache),
+            'hit_rate': round(self.hits / total, 4) if total else 0.0,
+        }
+
+    def _lookup_keys(self, keys):
+        """Procura as chaves em map_raw e depois em map_norm; retorna (valor, sufixo)."""
+        for lk in keys:
+            if lk in self.map_raw:
+                return self.map_raw[lk], ''
+            if lk in self.map_norm:
+                return self.map_norm[lk], '_norm'
+        return None, None
+
+    def _lookup(self, sindicato_raw, estados, exato_normalizado):
+        sindicato_norm = _normalize_text(sindicato_raw)
+
+        # 1) tentativa exata pelo nome do sindicato
+        if sindicato_raw and sindicato_raw in self.map_raw:
+            return self.map_raw[sindicato_raw], 'sindicato_raw'
+        if exato_normalizado and sindicato_norm in self.map_norm:
+            return self.map_norm[sindicato_norm], 'sindicato_norm'
+
+        # 2) tentativa por coluna de estado/uf na base
+        for estado_col, estado_key_raw in estados:
+            # Se vier UF, tenta converter para nome de estado
+            lookup_keys = [estado_key_raw, _normalize_text(estado_key_raw)]
+            if estado_key_raw in UF_TO_ESTADO:
+                nome_estado = UF_TO_ESTADO[estado_key_raw]
+                lookup_keys.extend([nome_estado, _normalize_text(nome_estado)])
+            valor, sufixo = self._lookup_keys(lookup_keys)
+            if valor is not None:
+                return valor, f'estado_column{sufixo}:{estado_col}'
 
+        # 3) tentativa por substring (ex.: sindicato string contém nome do estado)
+        if sindicato_norm:
+            # tenta UF dentro do texto do sindicato (ex.: 'ESTADO DE SP')
+            for t in re.findall(r"\b([A-Z]{2})\b", sindicato_raw):
+                if t in UF_TO_ESTADO:
+                    nome_estado = UF_TO_ESTADO[t]
+                    valor, sufixo = self._lookup_keys([t, _normalize_text(t), nome_estado, _normalize_text(nome_estado)])
+                    if valor is not None:
+                        return valor, f'uf_in_sindicato{sufixo}:{t}'
+            # tenta substring por nome completo (normalizado)
+            for k_norm, v in self.map_norm.items():
+                if k_norm and k_norm in sindicato_norm:
+                    return v, f'substring_norm:{k_norm}'
+
+        # 4) não encontrado
+        return None, None
+
+
+def _estados_da_linha(row):
+    """Pares (coluna, valor) das colunas de estado/UF preenchidas em uma linha."""
+    estados = []
+    for estado_col in ESTADO_COLUMNS:
+        estado_val = row.get(estado_col)
+        if estado_val is not None and not pd.isna(estado_val):
+            estados.append((estado_col, str(estado_val).strip().upper()))
+    return tuple(estados)
+
+
+def _resolver_valores(resolver, base, sindicato_raw, etapa):
+    """
+    Resolve valor unitário e reason para cada linha da base, consultando o
+    resolvedor apenas uma vez por combinação distinta de sindicato/estados.
+    """
+    colunas_estado = [c for c in ESTADO_COLUMNS if c in base.columns]
+    chaves = pd.DataFrame({'SINDICATO': sindicato_raw}, index=base.index)
+    for col in colunas_estado:
+        preenchido = base[col].notna()
+        chaves[col] = base[col].astype(str).str.strip().str.upper().where(preenchido, None)
+    codigos, distintos = pd.factorize(pd.Series(list(chaves.itertuples(index=False, name=None)), index=base.index))
+    resolvidos = []
+    for chave in distintos:
+        estados = tuple((col, val) for col, val in zip(colunas_estado, chave[1:]) if val is not None)
+        resolvidos.append(resolver.resolve(chave[0], estados, etapa=etapa))
+    valores = pd.Series([r[0] for r in resolvidos], dtype='float64').take(codigos)
+    reasons = pd.Series([r[1] for r in resolvidos], dtype=object).take(codigos)
+    valores.index = base.index
+    reasons.index = base.index
+    return valores, reasons
+
+
+def _coalesce_colunas(df, colunas, padrao=None):
+    """Equivalente vetorizado de `row.get(c1) or row.get(c2) or ... or padrao`.
+
+    Mantém a semântica de veracidade do Python usada nos laços originais:
+    NaN é verdadeiro, enquanto None, '' e 0 são falsos. Sem `padrao`, a cadeia
+    termina no valor da última coluna (ou None se ela não existir).
+    """
+    colunas = list(colunas)
+    if padrao is None and colunas and colunas[-1] in df.columns:
+        resultado = df[colunas.pop()].astype(object)
+    else:
+        resultado = pd.Series([padrao] * len(df), index=df.index, dtype=object)
+    for col in reversed(colunas):
+        if col not in df.columns:
+            continue
+        valores = df[col].astype(object)
+        resultado = valores.where(valores.map(bool), resultado)
+    return resultado
+
+
+@medido('calculo_dias_uteis', linhas='base')
+def _calcular_dias_uteis(base, dias_uteis, afastamentos, ferias, auditoria=None, com_logs=True):
+    """
+    Calcula 'DIAS_UTEIS' para a base inteira com operações por coluna.
+
+    Os dias do sindicato, a soma de férias (via groupby) e os afastamentos são
+    resolvidos uma única vez e aplicados com máscaras, em vez de filtrar as
+    planilhas auxiliares linha a linha. Retorna (base, logs), com uma linha de
+    log por matrícula no mesmo formato de antes (vazio com `com_logs=False`: o texto
+    não é montado); `auditoria` (audit.RegistroDeAuditoria) recebe os ajustes
+    aplicados a cada matrícula.
+    """
     # Identifica a coluna de sindicato e de dias uteis, independente do nome exato
     col_sindicato = None
     col_dias_uteis = None
@@ -140,53 +307,82 @@ def calcular_dias_uteis_por_colaborador(input_dir, output_csv):
     if not col_dias_uteis:
         raise ValueError("Coluna de dias úteis não encontrada em 'Base dias uteis.xlsx' (esperado: 'DIAS UTEIS')")
 
+    # Padroniza as chaves do dicionário para maiúsculas (uma vez só)
     sindicato_dias = dias_uteis.set_index(col_sindicato)[col_dias_uteis].to_dict()
-    # Cria um set de matrículas afastadas
-    matriculas_afastadas = set(afastamentos['MATRICULA'].astype(str))
-
-    logs_modificacoes = []
-
-    def calcular_linha(row):
-        # Busca o sindicato na linha, independente do nome da coluna
-        sindicato = (
-            row.get('Sindicato') or
-            row.get('SINDICATO') or
-            row.get('sindicato') or
-            row.get('SINDICADO')
-        )
-        if sindicato:
-            sindicato = str(sindicato).strip().upper()
-        # Padroniza as chaves do dicionário para maiúsculas
-        sindicato_dias_padrao = {str(k).strip().upper(): v for k, v in sindicato_dias.items()}
-        dias = sindicato_dias_padrao.get(sindicato, 0)
-        matricula = str(row.get('MATRICULA'))
-
-        log_msg = f"Matrícula {matricula}: sindicato='{sindicato}' dias_uteis_base={dias}"
-
-        # Subtrai dias de férias
-        dias_ferias = ferias.loc[ferias['MATRICULA'] == matricula, 'DIAS DE FÉRIAS'].sum() if 'DIAS DE FÉRIAS' in ferias else 0
-        if dias_ferias > 0:
-            log_msg += f" | Férias: -{dias_ferias}"
-
-        # Se a matrícula está em afastamentos, considera todos os dias úteis como afastados
-        if matricula in matriculas_afastadas:
-            dias_afast = dias
-            log_msg += f" | Afastamento: -{dias_afast} (afastado)"
-        else:
-            dias_afast = 0
+    sindicato_dias = {str(k).strip().upper(): v for k, v in sindicato_dias.items()}
+
+    sindicato = _coalesce_colunas(base, ['Sindicato', 'SINDICATO', 'sindicato', 'SINDICADO'])
+    preenchido = sindicato.map(bool)
+    sindicato = sindicato.astype(str).str.strip().str.upper().where(preenchido, sindicato)
+    matricula = base['MATRICULA'].astype(str)
+
+    dias = sindicato.map(sindicato_dias).fillna(0)
+    if pd.api.types.is_integer_dtype(dias_uteis[col_dias_uteis]):
+        dias = dias.astype('int64')
+
+    # Soma de férias por matrícula (mesma comparação de chave do filtro original)
+    if 'DIAS DE FÉRIAS' in ferias:
+        soma_ferias = ferias.groupby('MATRICULA')['DIAS DE FÉRIAS'].sum()
+        dias_ferias = matricula.map(soma_ferias).fillna(0)
+        if pd.api.types.is_integer_dtype(soma_ferias):
+            dias_ferias = dias_ferias.astype('int64')
+    else:
+        dias_ferias = pd.Series(0, index=base.index)
 
-        # Se houver data de desligamento, ajustar dias úteis proporcionalmente (exemplo simplificado)
-        if pd.notnull(row.get('DATA DEMISSÃO')):
-            dias_ant = dias
-            dias = dias // 2  # Exemplo: reduz pela metade
-            log_msg += f" | Desligamento: dias_uteis {dias_ant} -> {dias}"
+    # Se a matrícula está em afastamentos, considera todos os dias úteis como afastados
+    afastado = matricula.isin(set(afastamentos['MATRICULA'].astype(str)))
+    dias_afast = dias.where(afastado, 0)
 
-        resultado = max(dias - dias_ferias - dias_afast, 0)
-        log_msg += f" | DIAS_UTEIS final: {resultado}"
-        logs_modificacoes.append(log_msg)
-        return resultado
+    # Se houver data de desligamento, ajustar dias úteis proporcionalmente (exemplo simplificado)
+    if 'DATA DEMISSÃO' in base.columns:
+        desligado = base['DATA DEMISSÃO'].notna()
+    else:
+        desligado = pd.Series(False, index=base.index)
+    dias_ajustados = dias.where(~desligado, dias // 2)
 
-    base['DIAS_UTEIS'] = base.apply(calcular_linha, axis=1)
+    resultado = (dias_ajustados - dias_ferias - dias_afast).clip(lower=0)
+
+    logs = []
+    if com_logs:
+        log = "Matrícula " + matricula + ": sindicato='" + sindicato.astype(str) + "' dias_uteis_base=" + dias.astype(str)
+        log += (" | Férias: -" + dias_ferias.astype(str)).where(dias_ferias > 0, '')
+        log += (" | Afastamento: -" + dias_afast.astype(str) + " (afastado)").where(afastado, '')
+        log += (" | Desligamento: dias_uteis " + dias.astype(str) + " -> " + dias_ajustados.astype(str)).where(desligado, '')
+        log += " | DIAS_UTEIS final: " + resultado.astype(str)
+        logs = log.tolist()
+
+    if auditoria is not None and auditoria.ativo:
+        regra = ('dias_sindicato' + pd.Series('+ferias', index=base.index).where(dias_ferias > 0, '')
+                 + pd.Series('+afastamento', index=base.index).where(afastado, '')
+                 + pd.Series('+desligamento', index=base.index).where(desligado, ''))
+        auditoria.registrar('dias_uteis', matricula, regra, antes=dias, depois=resultado, motivo=sindicato)
+
+    base['DIAS_UTEIS'] = resultado
+    return base, logs
+
+
+def calcular_dias_uteis_por_colaborador(input_dir, output_csv):
+    """
+    Adiciona ao CSV unificado um campo 'DIAS_UTEIS' com a quantidade de dias úteis por colaborador,
+    considerando sindicato, férias, afastamentos e data de desligamento.
+    """
+    import logging
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger("calculation")
+    cache_dir = cache_dir_for(os.path.dirname(output_csv))
+
+    # Carrega o arquivo base_unificada.csv
+    base = pd.read_csv(output_csv, sep=';', encoding='utf-8-sig')
+    logger.info(f"Arquivo base carregado: {output_csv} ({len(base)} registros)")
+
+    # Carrega as planilhas auxiliares
+    dias_uteis = read_excel_cached(os.path.join(input_dir, 'Base dias uteis.xlsx'), cache_dir, header=1)
+    logger.info(f"Planilha de dias úteis carregada ({len(dias_uteis)} sindicatos)")
+    afastamentos = read_excel_cached(os.path.join(input_dir, 'AFASTAMENTOS.xlsx'), cache_dir)
+    logger.info(f"Planilha de afastamentos carregada ({len(afastamentos)} registros)")
+    ferias = read_excel_cached(os.path.join(input_dir, 'FÉRIAS.xlsx'), cache_dir)
+
+    base, logs_modificacoes = _calcular_dias_uteis(base, dias_uteis, afastamentos, ferias)
 
     # Garante que o novo arquivo será base_unificada_calculation.csv
     output_calc = os.path.join(os.path.dirname(output_csv), "base_unificada_calculation.csv")
@@ -202,6 +398,95 @@ def calcular_dias_uteis_por_colaborador(input_dir, output_csv):
 
     return
 
+
+@medido('calculo_desligamento', linhas='base')
+def _aplicar_desligamento(base, desligados, matriculas_elegiveis=None, auditoria=None, com_logs=True):
+    """
+    Aplica a regra de desligamento sobre a base inteira com um hash join.
+
+    DESLIGADOS é indexado por matrícula uma única vez (mantendo o primeiro
+    registro de cada matrícula, como o filtro original), as datas de demissão
+    são convertidas em lote e a regra do dia 15 é aplicada com máscaras.
+    `matriculas_elegiveis=None` considera todos elegíveis. Retorna (base, logs), com
+    logs vazio se `com_logs=False`; `auditoria` recebe a regra aplicada a cada
+    matrícula não elegível ou desligada.
+    """
+    # Padroniza os nomes das colunas para evitar erro de KeyError
+    desligados = desligados.copy()
+    desligados.columns = [str(col).strip().upper() for col in desligados.columns]
+
+    matricula = base['MATRICULA'].astype(str)
+    if matriculas_elegiveis is None:
+        elegivel = pd.Series(True, index=base.index)
+    else:
+        elegivel = matricula.isin(matriculas_elegiveis)
+
+    # Índice por matrícula (uma conversão para str por planilha, não por linha)
+    desligados.index = desligados['MATRICULA'].astype(str)
+    desligados = desligados[~desligados.index.duplicated(keep='first')]
+    encontrado = elegivel & matricula.isin(desligados.index)
+    registro = desligados.reindex(matricula.where(encontrado))
+    registro.index = base.index
+
+    if 'COMUNICADO DE DESLIGAMENTO' in registro.columns:
+        comunicado = registro['COMUNICADO DE DESLIGAMENTO'].astype(str).str.strip().str.upper()
+    else:
+        comunicado = pd.Series('', index=base.index)
+    if 'DATA DEMISSÃO' not in registro.columns:
+        data_demissao = pd.Series(pd.NaT, index=base.index, dtype='datetime64[ns]')
+    elif pd.api.types.is_datetime64_any_dtype(registro['DATA DEMISSÃO']):
+        data_demissao = registro['DATA DEMISSÃO']
+    else:
+        # format='mixed' interpreta cada valor isoladamente, como o parse escalar anterior
+        data_demissao = pd.to_datetime(registro['DATA DEMISSÃO'].astype(object), dayfirst=True, errors='coerce', format='mixed')
+
+    comunicado_ok = encontrado & (comunicado == 'OK') & data_demissao.notna()
+    ate_dia_15 = comunicado_ok & (data_demissao.dt.day <= 15)
+    apos_dia_15 = comunicado_ok & (data_demissao.dt.day > 15)
+    mantido = encontrado & ~(ate_dia_15 | apos_dia_15)
+
+    dias_uteis_atual = base['DIAS_UTEIS']
+    auditada = ~elegivel | encontrado
+    if auditoria is not None and auditoria.ativo:
+        dias_antes = dias_uteis_atual[auditada].copy()
+    novo_valor = dias_uteis_atual[apos_dia_15] // 2
+    base.loc[ate_dia_15, 'DIAS_UTEIS'] = 0
+    base.loc[apos_dia_15, 'DIAS_UTEIS'] = novo_valor
+
+    logs = []
+    if com_logs:
+        prefixo = "Matrícula " + matricula + ": "
+        data_txt = data_demissao.dt.date.astype(str)
+        log = pd.Series('', index=base.index)
+        log[~elegivel] = prefixo[~elegivel] + "não elegível ao benefício (exclusão)."
+        log[ate_dia_15] = prefixo[ate_dia_15] + "comunicado OK até dia 15 (" + data_txt[ate_dia_15] + "), DIAS_UTEIS=0"
+        log[apos_dia_15] = (prefixo[apos_dia_15] + "comunicado OK após dia 15 (" + data_txt[apos_dia_15]
+                            + "), DIAS_UTEIS=" + novo_valor.astype('int64').astype(str) + " (proporcional)")
+        log[mantido] = (prefixo[mantido] + "comunicado '" + comunicado[mantido]
+                        + "' ou data de demissão inválida, DIAS_UTEIS mantido (" + dias_uteis_atual[mantido].astype(str) + ")")
+        logs = log[auditada].tolist()
+
+    if auditoria is not None and auditoria.ativo:
+        data_txt = data_demissao.dt.date.astype(str)
+        regra = pd.Series(np.select([~elegivel, ate_dia_15, apos_dia_15],
+                                    ['nao_elegivel', 'comunicado_ate_dia_15', 'comunicado_apos_dia_15'],
+                                    'desligamento_mantido'), index=base.index)
+        motivo = data_txt.where(comunicado_ok, comunicado).where(elegivel, 'base_tratamento_exclusoes')
+        auditoria.registrar('desligamento', matricula[auditada], regra[auditada], antes=dias_antes,
+                            depois=base.loc[auditada, 'DIAS_UTEIS'], motivo=motivo[auditada])
+
+    return base, logs
+
+
+def _carregar_elegiveis(input_dir, cache_dir=None):
+    """Matrículas elegíveis segundo 'base_tratamento_exclusoes.xlsx' (None se o arquivo não existir)."""
+    exclusoes_path = os.path.join(input_dir, 'base_tratamento_exclusoes.xlsx')
+    if not os.path.exists(exclusoes_path):
+        return None
+    exclusoes = read_excel_cached(exclusoes_path, cache_dir)
+    return set(exclusoes['MATRICULA'].astype(str))
+
+
 def aplicar_regra_desligamento(input_dir, output_csv):
     """
     Aplica a regra de desligamento:
@@ -210,10 +495,10 @@ def aplicar_regra_desligamento(input_dir, output_csv):
     - Só aplica para quem for elegível ao benefício (vide base de tratamento de exclusões).
     """
     import logging
-    from datetime import datetime
 
     logging.basicConfig(level=logging.INFO)
     logger = logging.getLogger("calculation-desligamento")
+    cache_dir = cache_dir_for(os.path.dirname(output_csv))
 
     # Carrega o arquivo base_unificada_calculation.csv
     base_path = os.path.join(os.path.dirname(output_csv), "base_unificada_calculation.csv")
@@ -221,57 +506,13 @@ def aplicar_regra_desligamento(input_dir, output_csv):
     logger.info(f"Arquivo base carregado: {base_path} ({len(base)} registros)")
 
     # Carrega a planilha de desligados
-    desligados = pd.read_excel(os.path.join(input_dir, 'DESLIGADOS.xlsx'))  # MATRÍCULA, DATA DEMISSÃO, COMUNICADO DE DESLIGAMENTO
-    # Padroniza os nomes das colunas para evitar erro de KeyError
-    desligados.columns = [str(col).strip().upper() for col in desligados.columns]
-
-    # Carrega a base de tratamento de exclusões (supondo nome e campo de matrícula)
-    exclusoes_path = os.path.join(input_dir, 'base_tratamento_exclusoes.xlsx')
-    if os.path.exists(exclusoes_path):
-        exclusoes = pd.read_excel(exclusoes_path)
-        matriculas_elegiveis = set(exclusoes['MATRICULA'].astype(str))
-    else:
-        matriculas_elegiveis = set(base['MATRICULA'].astype(str))  # Se não houver, considera todos elegíveis
-
-    logs_desligamento = []
+    desligados = read_excel_cached(os.path.join(input_dir, 'DESLIGADOS.xlsx'), cache_dir)  # MATRÍCULA, DATA DEMISSÃO, COMUNICADO DE DESLIGAMENTO
 
-    for idx, row in base.iterrows():
-        matricula = str(row['MATRICULA'])
-        if matricula not in matriculas_elegiveis:
-            logs_desligamento.append(f"Matrícula {matricula}: não elegível ao benefício (exclusão).")
-            continue
+    # Carrega a base de tratamento de exclusões (supondo nome e campo de matrícula);
+    # se não houver, considera todos elegíveis
+    matriculas_elegiveis = _carregar_elegiveis(input_dir, cache_dir)
 
-        desligado = desligados[desligados['MATRICULA'].astype(str) == matricula]
-        if desligado.empty:
-            continue
-
-        comunicado = str(desligado.iloc[0].get('COMUNICADO DE DESLIGAMENTO', '')).strip().upper()
-        data_demissao = desligado.iloc[0].get('DATA DEMISSÃO')
-        dias_uteis_atual = row['DIAS_UTEIS']
-
-        if pd.notnull(data_demissao):
-            try:
-                data_demissao_dt = pd.to_datetime(data_demissao, dayfirst=True, errors='coerce')
-            except Exception:
-                data_demissao_dt = None
-        else:
-            data_demissao_dt = None
-
-        if comunicado == 'OK' and data_demissao_dt and data_demissao_dt.day <= 15:
-            base.at[idx, 'DIAS_UTEIS'] = 0
-            logs_desligamento.append(
-                f"Matrícula {matricula}: comunicado OK até dia 15 ({data_demissao_dt.date()}), DIAS_UTEIS=0"
-            )
-        elif comunicado == 'OK' and data_demissao_dt and data_demissao_dt.day > 15:
-            novo_valor = int(dias_uteis_atual // 2)
-            base.at[idx, 'DIAS_UTEIS'] = novo_valor
-            logs_desligamento.append(
-                f"Matrícula {matricula}: comunicado OK após dia 15 ({data_demissao_dt.date()}), DIAS_UTEIS={novo_valor} (proporcional)"
-            )
-        else:
-            logs_desligamento.append(
-                f"Matrícula {matricula}: comunicado '{comunicado}' ou data de demissão inválida, DIAS_UTEIS mantido ({dias_uteis_atual})"
-            )
+    base, logs_desligamento = _aplicar_desligamento(base, desligados, matriculas_elegiveis)
 
     # Salva o novo arquivo
     output_desligamento = os.path.join(os.path.dirname(output_csv), "base_unificada_calculation_desligamento.csv")
@@ -287,13 +528,51 @@ def aplicar_regra_desligamento(input_dir, output_csv):
 
     return
 
-def calcular_valor_total_vr(input_dir, output_csv):
+
+@medido('calculo_vr', linhas='base')
+def _calcular_valor_total(base, resolver, auditoria=None, com_logs=True):
+    """
+    Calcula 'VALOR TOTAL VR' (valor unitário do sindicato x DIAS_UTEIS) para a base inteira.
+
+    Retorna (base, logs), com uma linha de log por matrícula (vazio com
+    `com_logs=False`); `auditoria` recebe o valor unitário, o total e a forma como o
+    valor foi encontrado (reason).
+    """
+    matricula = _coalesce_colunas(base, ['MATRICULA', 'Matricula', 'matricula'], '').astype(str)
+    sindicato = _coalesce_colunas(base, ['Sindicato', 'SINDICATO', 'sindicato', 'SINDICADO'], '')
+    sindicato_raw = sindicato.astype(str).str.strip().str.upper()
+
+    valor_unitario, reasons = _resolver_valores(resolver, base, sindicato_raw, etapa='vr')
+
+    dias_uteis = _coalesce_colunas(base, ['DIAS_UTEIS'], 0)
+    dias_num = pd.to_numeric(dias_uteis, errors='coerce')
+    # Valores não numéricos (mas preenchidos) resultavam em 0.0 no cálculo linha a linha
+    valor_total = (valor_unitario * dias_num).where(dias_num.notna() | dias_uteis.isna(), 0.0)
+
+    logs = []
+    if com_logs:
+        logs = ("Matrícula " + matricula + ": sindicato='" + sindicato.astype(str) + "', valor_unitario="
+                + valor_unitario.astype(str) + ", dias_uteis=" + dias_uteis.astype(str) + ", VALOR TOTAL VR="
+                + valor_total.astype(str) + " (reason=" + reasons + ")").tolist()
+
+    if auditoria is not None:
+        auditoria.registrar('vr', matricula, reasons, antes=valor_unitario, depois=valor_total, motivo=sindicato)
+
+    base['VALOR TOTAL VR'] = valor_total
+    return base, logs
+
+
+def calcular_valor_total_vr(input_dir, output_csv, resolver=None):
     """
     Calcula e adiciona a coluna 'VALOR TOTAL VR' ao CSV, conforme valor do sindicato de cada colaborador.
+
+    `resolver` permite reaproveitar um `SindicatoValorResolver` já montado (e seu cache);
+    se omitido, é criado a partir de 'Base sindicato x valor.xlsx'.
     """
     import logging
     logging.basicConfig(level=logging.INFO)
     logger = logging.getLogger("calculation-vr")
+    cache_dir = cache_dir_for(os.path.dirname(output_csv))
 
     # Carrega o arquivo base_unificada_calculation_desligamento.csv se existir, senão base_unificada_calculation.csv
     base_path = os.path.join(os.path.dirname(output_csv), "base_unificada_calculation_desligamento.csv")
@@ -303,105 +582,16 @@ def calcular_valor_total_vr(input_dir, output_csv):
     logger.info(f"Arquivo base carregado: {base_path} ({len(base)} registros)")
 
     # Carrega a planilha de valor por sindicato
-    sindicato_valor_df = pd.read_excel(os.path.join(input_dir, 'Base sindicato x valor.xlsx'))
-    map_raw, map_norm = _build_valor_mapping(sindicato_valor_df)
-    if not map_raw:
+    if resolver is None:
+        sindicato_valor_df = read_excel_cached(os.path.join(input_dir, 'Base sindicato x valor.xlsx'), cache_dir)
+        resolver = SindicatoValorResolver.from_dataframe(sindicato_valor_df)
+    if not resolver.map_raw:
         logger.warning("Mapa de sindicato/estado->valor ficou vazio após leitura de 'Base sindicato x valor.xlsx'.")
 
     # Calcula o valor total de VR para cada colaborador
-    valores = []
-    logs_vr = []
-    # garantia: mapas prontos (raw e normalizado)
-
-    for idx, row in base.iterrows():
-        matricula = row.get('MATRICULA') or row.get('Matricula') or row.get('matricula') or ''
-        matricula = str(matricula)
-        sindicato = (
-            row.get('Sindicato') or
-            row.get('SINDICATO') or
-            row.get('sindicato') or
-            row.get('SINDICADO') or
-            ''
-        )
-        sindicato_raw = str(sindicato).strip().upper()
-        sindicato_norm = _normalize_text(sindicato_raw)
-
-        valor_unitario = None
-        reason = None
-
-        # 1) tentativa exata pelo nome do sindicato
-        if sindicato_raw and sindicato_raw in map_raw:
-            valor_unitario = map_raw[sindicato_raw]
-            reason = 'match_exact_sindicato'
-
-        # 2) tentativa por coluna de estado/uf na base
-        if valor_unitario is None:
-            for estado_col in ['ESTADO', 'UF', 'STATE']:
-                estado_val = row.get(estado_col)
-                if estado_val is not None and not pd.isna(estado_val):
-                    estado_key_raw = str(estado_val).strip().upper()
-                    estado_key_norm = _normalize_text(estado_key_raw)
-                    # Se vier UF, tenta converter para nome de estado
-                    lookup_keys = [estado_key_raw, estado_key_norm]
-                    if estado_key_raw in UF_TO_ESTADO:
-                        nome_estado = UF_TO_ESTADO[estado_key_raw]
-                        lookup_keys.extend([nome_estado, _normalize_text(nome_estado)])
-                    for lk in lookup_keys:
-                        if lk in map_raw:
-                            valor_unitario = map_raw[lk]
-                            reason = f'match_estado_column:{estado_col}'
-                            break
-                        if lk in map_norm:
-                            valor_unitario = map_norm[lk]
-                            reason = f'match_estado_column_norm:{estado_col}'
-                            break
-                    if valor_unitario is not None:
-                        break
-
-        # 3) tentativa por substring (ex.: sindicato string contém nome do estado)
-        if valor_unitario is None and sindicato_norm:
-            # tenta UF dentro do texto do sindicato (ex.: 'ESTADO DE SP')
-            tokens = re.findall(r"\b([A-Z]{2})\b", sindicato_raw)
-            for t in tokens:
-                if t in UF_TO_ESTADO:
-                    nome_estado = UF_TO_ESTADO[t]
-                    for lk in [t, _normalize_text(t), nome_estado, _normalize_text(nome_estado)]:
-                        if lk in map_raw:
-                            valor_unitario = map_raw[lk]
-                            reason = f'match_uf_in_sindicato:{t}'
-                            break
-                        if lk in map_norm:
-                            valor_unitario = map_norm[lk]
-                            reason = f'match_uf_in_sindicato_norm:{t}'
-                            break
-                    if valor_unitario is not None:
-                        break
-            # tenta substring por nome completo (normalizado)
-            if valor_unitario is None:
-                for k_norm, v in map_norm.items():
-                    if k_norm and k_norm in sindicato_norm:
-                        valor_unitario = v
-                        reason = f'match_substring_norm:{k_norm}'
-                        break
-
-        # 4) fallback: não encontrado
-        if valor_unitario is None:
-            valor_unitario = 0.0
-            reason = 'no_match'
-
-        dias_uteis = row.get('DIAS_UTEIS', 0) or 0
-        try:
-            valor_total = float(valor_unitario) * float(dias_uteis)
-        except Exception:
-            valor_total = 0.0
-
-        valores.append(valor_total)
-        log_line = (f"Matrícula {matricula}: sindicato='{sindicato}', valor_unitario={valor_unitario}, "
-                    f"dias_uteis={dias_uteis}, VALOR TOTAL VR={valor_total} (reason={reason})")
-        logger.info(log_line)
-        logs_vr.append(log_line)
+    base, logs_vr = _calcular_valor_total(base, resolver)
+    logger.info(f"Resolvedor sindicato->valor: {resolver.stats()}")
 
-    base['VALOR TOTAL VR'] = valores
     # Salva o novo arquivo
     output_vr = os.path.join(os.path.dirname(output_csv), "base_unificada_calculation_vr.csv")
     base.to_csv(output_vr, sep=';', index=False, encoding='utf-8-sig')
@@ -415,23 +605,11 @@ def calcular_valor_total_vr(input_dir, output_csv):
     logger.info(f"Log detalhado de VR salvo em: {vr_log_path}")
     return
 
-def gerar_planilha_final(input_dir, output_csv, competencia=None):
-    """
-    Gera a planilha final para envio à operadora com os campos:
-    Matricula	Admissão	Sindicato do Colaborador	Competência	Dias	VALOR DIÁRIO VR	TOTAL	Custo empresa	Desconto profissional	OBS GERAL
 
-    - Usa o arquivo com valores de VR gerados (prefere base_unificada_calculation_vr.csv)
-    - Calcula VALOR DIÁRIO como TOTAL / Dias quando possível; faz fallback para valor por sindicato
-    - Custo empresa = 80% do TOTAL; Desconto profissional = 20% do TOTAL
-    """
-    import logging
-    import math
+def _normalizar_competencia(competencia=None):
+    """Normaliza a competência para texto no formato MM/YYYY (mês atual se ausente ou inválida)."""
     from datetime import datetime
 
-    logging.basicConfig(level=logging.INFO)
-    logger = logging.getLogger("calculation-final")
-
-    # Competência precisa ser texto no formato MM/YYYY
     if competencia is None:
         competencia = datetime.now().strftime("%m/%Y")
     else:
@@ -452,203 +630,234 @@ def gerar_planilha_final(input_dir, output_csv, competencia=None):
         except Exception:
             competencia = datetime.now().strftime('%m/%Y')
 
-    # Carrega base de VR
-    base_path = os.path.join(os.path.dirname(output_csv), "base_unificada_calculation_vr.csv")
-    if not os.path.exists(base_path):
-        base_path = os.path.join(os.path.dirname(output_csv), "base_unificada_calculation.csv")
-    base = pd.read_csv(base_path, sep=';', encoding='utf-8-sig')
-    logger.info(f"Arquivo base carregado para planilha final: {base_path} ({len(base)} registros)")
+    return competencia
+
+# Colunas candidatas (em ordem de preferência) para a data de admissão
+ADMISSAO_COLUMNS = [
+    'Admissão', 'ADMISSÃO', 'ADMISSAO', 'DATA ADMISSAO', 'DATA DE ADMISSAO', 'DATA_ADMISSAO',
+    'Data Admissao', 'Data de Admissao',
+]
+
+COLUNAS_PLANILHA_FINAL = [
+    'Matricula', 'Admissão', 'Sindicato do Colaborador', 'Competência', 'Dias',
+    'VALOR DIÁRIO VR', 'TOTAL', 'Custo empresa', 'Desconto profissional', 'OBS GERAL',
+]
+
+
+def _mapear_distintos(serie, func):
+    """Aplica `func` uma única vez por valor distinto da série (o tipo faz parte da chave)."""
+    cache = {}
+
+    def _aplicar(valor):
+        chave = (type(valor), valor)
+        if chave not in cache:
+            cache[chave] = func(valor)
+        return cache[chave]
+
+    return serie.map(_aplicar)
+
+
+def _formatar_admissao(adm):
+    """Formata uma data de admissão como dd/mm/aaaa (inclui fallback para serial Excel)."""
+    try:
+        adm_dt = pd.to_datetime(adm, errors='coerce', dayfirst=True)
+        if pd.isna(adm_dt):
+            # tenta serial Excel
+            adm_num = pd.to_numeric(pd.Series([adm]), errors='coerce').iloc[0]
+            adm_dt = pd.to_datetime(adm_num, unit='d', origin='1899-12-30', errors='coerce')
+        if pd.notnull(adm_dt):
+            return adm_dt.strftime('%d/%m/%Y')
+        return str(adm)
+    except Exception:
+        return str(adm)
+
+
+def _dia_demissao(data_dem):
+    """Dia do mês da data de demissão, ou None quando a data não é reconhecida."""
+    try:
+        data_dem_dt = pd.to_datetime(data_dem, errors='coerce', dayfirst=True)
+    except Exception:
+        return None
+    return data_dem_dt.day if pd.notnull(data_dem_dt) else None
+
+
+def _para_int(valor):
+    try:
+        return int(valor) if not pd.isna(valor) else 0
+    except Exception:
+        try:
+            return int(float(valor))
+        except Exception:
+            return 0
 
-    # Carrega valores por sindicato (para fallback)
-    sindicato_valor_df = pd.read_excel(os.path.join(input_dir, 'Base sindicato x valor.xlsx'))
-    map_raw, map_norm = _build_valor_mapping(sindicato_valor_df)
 
-    # Prepara linhas de saída
-    out_rows = []
+def _para_float(valor):
+    try:
+        return float(valor) if not pd.isna(valor) else 0.0
+    except Exception:
+        return 0.0
+
+
+def _coluna_numerica(serie, conversor):
+    """
+    Converte uma coluna com `conversor` (`_para_int`/`_para_float`).
+
+    Colunas só com números são convertidas em lote; as demais (texto, tipos
+    mistos) passam pelo conversor escalar uma vez por valor distinto.
+    """
+    if pd.api.types.infer_dtype(serie, skipna=True) in ('integer', 'floating', 'mixed-integer-float', 'empty'):
+        numeros = serie.astype('float64')
+        finitos = np.isfinite(numeros)
+        if conversor is _para_float:
+            return numeros.fillna(0.0)
+        if (numeros[finitos].abs() < 2 ** 62).all():
+            return np.trunc(numeros.where(finitos, 0)).astype('int64')
+    return _mapear_distintos(serie, conversor)
+
+
+def _arredondar(valores, casas=2):
+    """
+    `round(valor, casas)` do Python para uma coluna inteira.
+
+    O `np.round` escala, arredonda e divide; só diverge do `round` embutido
+    quando o valor escalado fica praticamente em cima de x,5 (ou é enorme),
+    e apenas esses casos são recalculados um a um.
+    """
+    valores = valores.astype('float64')
+    escala = 10 ** casas
+    escalado = valores * escala
+    resultado = np.round(valores, casas)
+    fracao = (escalado - np.trunc(escalado)).abs()
+    duvidoso = np.isfinite(escalado) & (((fracao - 0.5).abs() < 1e-6) | (escalado.abs() >= 2 ** 52))
+    if duvidoso.any():
+        resultado[duvidoso] = [round(v, casas) for v in valores[duvidoso].tolist()]
+    return resultado
+
+
+def _obs_por_reason(reason):
+    """Observação da planilha final associada à forma como o valor diário foi obtido."""
+    if reason == 'no_valor_found':
+        return 'Valor unitário do sindicato/estado não encontrado'
+    if reason.startswith('fallback_'):
+        # Mensagens mais amigáveis para alguns fallbacks
+        if 'estado_column' in reason or 'uf_in_sindicato' in reason:
+            return 'Valor diário obtido por fallback (UF/Estado)'
+        if 'substring' in reason:
+            return 'Valor diário obtido por fallback (substring)'
+        return 'Valor diário obtido por fallback'
+    return ''
+
+
+def _juntar_observacoes(index, mensagens):
+    """Concatena com ' | ' as mensagens (Series de texto, '' = sem mensagem), na ordem dada."""
+    obs = pd.Series('', index=index, dtype=object)
+    for msg in mensagens:
+        tem = msg != ''
+        obs = obs.where(~tem, (obs + ' | ' + msg).where(obs != '', msg))
+    return obs
+
+
+@medido('calculo_final', linhas='base')
+def _montar_planilha_final(base, resolver, competencia, auditoria=None, com_logs=True):
+    """
+    Monta o DataFrame da planilha final (uma linha por colaborador) a partir da base de VR.
+
+    Todas as colunas são calculadas em lote. Datas de admissão e de demissão são
+    interpretadas uma vez por valor distinto, com o mesmo parse escalar de antes, e
+    o fallback por sindicato/estado só é consultado para linhas sem dias úteis.
+    Retorna (df_out, logs), com logs vazio se `com_logs=False`; `auditoria` recebe o
+    total antes e depois da planilha final.
+    """
+    index = base.index
+    matricula = _coalesce_colunas(base, ['MATRICULA', 'Matricula', 'matricula'], '').astype(str)
+
+    # Primeira data de admissão preenchida entre as colunas candidatas
+    adm = pd.Series('', index=index, dtype=object)
+    for col in reversed([c for c in ADMISSAO_COLUMNS if c in base.columns]):
+        valores = base[col].astype(object)
+        preenchido = valores.notna() & (valores.astype(str).str.strip() != '')
+        adm = valores.where(preenchido, adm)
+    com_adm = adm != ''
+    adm[com_adm] = _mapear_distintos(adm[com_adm], _formatar_admissao)
+
+    sindicato = _coalesce_colunas(base, ['Sindicato', 'SINDICATO', 'sindicato', 'SINDICADO'], '').astype(str).str.strip()
+    dias_n = _coluna_numerica(_coalesce_colunas(base, ['DIAS_UTEIS', 'DIAS'], 0), _para_int)
+    total_f = _coluna_numerica(_coalesce_colunas(base, ['VALOR TOTAL VR', 'VALOR_TOTAL_VR', 'VALOR TOTAL VR '], 0), _para_float)
+
+    # Calcula valor diário a partir do total; sem dias úteis, usa o valor unitário do sindicato/estado
+    com_dias = dias_n > 0
+    valor_diario = (total_f / dias_n.where(com_dias, 1)).where(com_dias, 0.0)
+    total_antes = total_f
+    reason = pd.Series('calc_from_total', index=index, dtype=object)
+    if (~com_dias).any():
+        sem_dias = base[~com_dias]
+        valor_unit, reason_fallback = _resolver_valores(resolver, sem_dias, sindicato[~com_dias].str.upper(), etapa='final')
+        valor_diario[~com_dias] = valor_unit
+        total_f = total_f.where(com_dias, valor_unit * dias_n)
+        reason[~com_dias] = reason_fallback
+
+    # Observações de desligamento quando possível
+    comunicado = _coalesce_colunas(base, ['COMUNICADO DE DESLIGAMENTO', 'Comunicado de desligamento'])
+    comunicado_up = comunicado.astype(str).str.strip().str.upper().where(comunicado.map(bool), '')
+    data_dem = _coalesce_colunas(base, ['DATA DEMISSÃO', 'Data Demissão', 'DATA DEMISSAO'])
+    comunicado_ok = (comunicado_up == 'OK') & data_dem.notna()
+    dia_dem = pd.Series(None, index=index, dtype=object)
+    dia_dem[comunicado_ok] = _mapear_distintos(data_dem[comunicado_ok], _dia_demissao)
+    com_data = dia_dem.notna()
+    dia_dem = dia_dem.where(com_data, 0).astype('int64')
+
+    reasons_distintas = reason.unique()
+    mensagens = [
+        pd.Series(np.where((sindicato == '') | (sindicato.str.lower() == 'nan'), 'Sindicato não informado', ''), index=index),
+        pd.Series(np.where(dias_n == 0, 'Sem dias úteis no período', ''), index=index),
+        reason.map(dict(zip(reasons_distintas, map(_obs_por_reason, reasons_distintas)))),
+        pd.Series(np.select([com_data & (dia_dem <= 15), com_data],
+                            ['Desligamento comunicado até dia 15', 'Desligamento após dia 15 (proporcional)'], ''), index=index),
+    ]
+    # As mensagens são sempre distintas entre si, então não há duplicatas a remover
+    obs = _juntar_observacoes(index, mensagens)
+
+    # Garante tipos numéricos com 2 casas decimais
+    valor_diario = _arredondar(valor_diario)
+    total_f = _arredondar(total_f)
+
+    df_out = pd.DataFrame({
+        'Matricula': matricula,
+        'Admissão': adm,
+        'Sindicato do Colaborador': sindicato,
+        'Competência': str(competencia),
+        'Dias': dias_n,
+        'VALOR DIÁRIO VR': valor_diario,
+        'TOTAL': total_f,
+        'Custo empresa': _arredondar(total_f * 0.8),
+        'Desconto profissional': _arredondar(total_f * 0.2),
+        'OBS GERAL': obs,
+    }, columns=COLUNAS_PLANILHA_FINAL).reset_index(drop=True)
+
     logs_final = []
+    if com_logs:
+        logs_final = ("Matricula " + matricula + ": dias=" + dias_n.astype(str) + ", valor_diario=" + valor_diario.astype(str)
+                      + ", total=" + total_f.astype(str) + " (reason=" + reason + ") obs=" + obs).tolist()
 
-    for idx, row in base.iterrows():
-        matricula = row.get('MATRICULA') or row.get('Matricula') or row.get('matricula') or ''
-        matricula = str(matricula)
-        # tenta várias colunas para admissão
-        adm_candidates = [
-            row.get('Admissão'), row.get('ADMISSÃO'), row.get('ADMISSAO'),
-            row.get('DATA ADMISSAO'), row.get('DATA DE ADMISSAO'), row.get('DATA_ADMISSAO'),
-            row.get('Data Admissao'), row.get('Data de Admissao')
-        ]
-        adm = next((v for v in adm_candidates if v is not None and not pd.isna(v) and str(v).strip() != ''), '')
-        # Formata data de admissão como dd/mm/aaaa quando possível (inclui fallback para serial Excel)
-        if adm not in ['', None] and not pd.isna(adm):
-            try:
-                adm_dt = pd.to_datetime(adm, errors='coerce', dayfirst=True)
-                if pd.isna(adm_dt):
-                    # tenta serial Excel
-                    adm_num = pd.to_numeric(pd.Series([adm]), errors='coerce').iloc[0]
-                    adm_dt = pd.to_datetime(adm_num, unit='d', origin='1899-12-30', errors='coerce')
-                if pd.notnull(adm_dt):
-                    adm = adm_dt.strftime('%d/%m/%Y')
-                else:
-                    adm = str(adm)
-            except Exception:
-                adm = str(adm)
-        sindicato = (row.get('Sindicato') or row.get('SINDICATO') or row.get('sindicato') or row.get('SINDICADO') or '')
-        sindicato = str(sindicato).strip()
-        dias = row.get('DIAS_UTEIS') or row.get('DIAS') or 0
-        try:
-            dias_n = int(dias) if not pd.isna(dias) else 0
-        except Exception:
-            try:
-                dias_n = int(float(dias))
-            except Exception:
-                dias_n = 0
+    if auditoria is not None:
+        auditoria.registrar('final', matricula, reason, antes=total_antes, depois=total_f, motivo=obs)
+
+    return df_out, logs_final
 
-        total = row.get('VALOR TOTAL VR') or row.get('VALOR_TOTAL_VR') or row.get('VALOR TOTAL VR ') or 0
-        try:
-            total_f = float(total) if not pd.isna(total) else 0.0
-        except Exception:
-            total_f = 0.0
-
-        # Calcula valor diário
-        obs_msgs = []
-        # Avisos iniciais
-        if not sindicato or str(sindicato).strip().lower() in ['nan', '']:
-            obs_msgs.append('Sindicato não informado')
-        if dias_n == 0:
-            obs_msgs.append('Sem dias úteis no período')
-
-        if dias_n > 0:
-            valor_diario = total_f / dias_n
-            reason = 'calc_from_total'
-        else:
-            # fallback: tentar obter valor unitário por sindicato/estado com mapas melhorados
-            valor_unit = 0.0
-            s_key_raw = sindicato.strip().upper()
-            s_key_norm = _normalize_text(s_key_raw)
-            # tentativas ordenadas
-            if s_key_raw in map_raw:
-                valor_unit = map_raw[s_key_raw]
-                reason = 'fallback_by_sindicato_raw'
-            elif s_key_norm in map_norm:
-                valor_unit = map_norm[s_key_norm]
-                reason = 'fallback_by_sindicato_norm'
-            else:
-                # tenta UF em colunas conhecidas
-                matched = False
-                for estado_col in ['ESTADO', 'UF', 'STATE']:
-                    estado_val = row.get(estado_col)
-                    if estado_val is None or pd.isna(estado_val):
-                        continue
-                    estado_key_raw = str(estado_val).strip().upper()
-                    estado_key_norm = _normalize_text(estado_key_raw)
-                    lookup = [estado_key_raw, estado_key_norm]
-                    if estado_key_raw in UF_TO_ESTADO:
-                        nome_estado = UF_TO_ESTADO[estado_key_raw]
-                        lookup.extend([nome_estado, _normalize_text(nome_estado)])
-                    for lk in lookup:
-                        if lk in map_raw:
-                            valor_unit = map_raw[lk]
-                            reason = f'fallback_estado_column:{estado_col}'
-                            matched = True
-                            break
-                        if lk in map_norm:
-                            valor_unit = map_norm[lk]
-                            reason = f'fallback_estado_column_norm:{estado_col}'
-                            matched = True
-                            break
-                    if matched:
-                        break
-                if not matched:
-                    # tenta UF dentro do próprio texto do sindicato
-                    tokens = re.findall(r"\b([A-Z]{2})\b", s_key_raw)
-                    for t in tokens:
-                        if t in UF_TO_ESTADO:
-                            nome_estado = UF_TO_ESTADO[t]
-                            for lk in [t, _normalize_text(t), nome_estado, _normalize_text(nome_estado)]:
-                                if lk in map_raw:
-                                    valor_unit = map_raw[lk]
-                                    reason = f'fallback_uf_in_sindicato:{t}'
-                                    matched = True
-                                    break
-                                if lk in map_norm:
-                                    valor_unit = map_norm[lk]
-                                    reason = f'fallback_uf_in_sindicato_norm:{t}'
-                                    matched = True
-                                    break
-                        if matched:
-                            break
-                if not matched:
-                    # por fim substring normalizada
-                    for k_norm, v in map_norm.items():
-                        if k_norm and k_norm in s_key_norm:
-                            valor_unit = v
-                            reason = f'fallback_substring_norm:{k_norm}'
-                            matched = True
-                            break
-                if not matched:
-                    reason = 'no_valor_found'
-            valor_diario = valor_unit
-            total_f = valor_diario * dias_n
-
-        # Observações com base no método de cálculo/erros
-        if 'reason' in locals():
-            if reason == 'no_valor_found':
-                obs_msgs.append('Valor unitário do sindicato/estado não encontrado')
-            elif reason.startswith('fallback_'):
-                # Mensagens mais amigáveis para alguns fallbacks
-                if 'estado_column' in reason or 'uf_in_sindicato' in reason:
-                    obs_msgs.append('Valor diário obtido por fallback (UF/Estado)')
-                elif 'substring' in reason:
-                    obs_msgs.append('Valor diário obtido por fallback (substring)')
-                else:
-                    obs_msgs.append('Valor diário obtido por fallback')
-
-        # Observações de desligamento quando possível
-        comunicado = row.get('COMUNICADO DE DESLIGAMENTO') or row.get('Comunicado de desligamento')
-        data_dem = row.get('DATA DEMISSÃO') or row.get('Data Demissão') or row.get('DATA DEMISSAO')
-        if comunicado:
-            comunicado_up = str(comunicado).strip().upper()
-        else:
-            comunicado_up = ''
-        if data_dem is not None and not pd.isna(data_dem):
-            try:
-                data_dem_dt = pd.to_datetime(data_dem, errors='coerce', dayfirst=True)
-            except Exception:
-                data_dem_dt = None
-        else:
-            data_dem_dt = None
-        if comunicado_up == 'OK' and data_dem_dt is not None and pd.notnull(data_dem_dt):
-            if data_dem_dt.day <= 15:
-                obs_msgs.append('Desligamento comunicado até dia 15')
-            else:
-                obs_msgs.append('Desligamento após dia 15 (proporcional)')
-        # Garante tipos numéricos com 2 casas decimais
-        valor_diario = float(round(valor_diario, 2))
-        total_f = float(round(total_f, 2))
-        custo_empresa = float(round(total_f * 0.8, 2))
-        desconto_prof = float(round(total_f * 0.2, 2))
-
-        out_row = {
-            'Matricula': matricula,
-            'Admissão': adm,
-            'Sindicato do Colaborador': sindicato,
-            'Competência': str(competencia),
-            'Dias': int(dias_n),
-            'VALOR DIÁRIO VR': valor_diario,
-            'TOTAL': total_f,
-            'Custo empresa': custo_empresa,
-            'Desconto profissional': desconto_prof,
-            'OBS GERAL': ' | '.join(dict.fromkeys([m for m in obs_msgs if m]))
-        }
-        out_rows.append(out_row)
-        logs_final.append(f"Matricula {matricula}: dias={dias_n}, valor_diario={valor_diario}, total={total_f} (reason={locals().get('reason','')}) obs={' | '.join(obs_msgs)}")
 
-    df_out = pd.DataFrame(out_rows, columns=['Matricula', 'Admissão', 'Sindicato do Colaborador', 'Competência', 'Dias', 'VALOR DIÁRIO VR', 'TOTAL', 'Custo empresa', 'Desconto profissional', 'OBS GERAL'])
+def _caminho_resultado(output_dir, competencia):
+    """RESULTADO_VR_MENSAL_MM_YYYY.csv (nome seguro, com '/' trocado por '_')."""
+    return os.path.join(output_dir, f"RESULTADO_VR_MENSAL_{str(competencia).replace('/', '_')}.csv")
 
+
+def _salvar_planilha_final(df_out, logs_final, output_dir, competencia, logger, com_log=True):
+    """Salva RESULTADO_VR_MENSAL_MM_YYYY.csv e (com `com_log`) o respectivo _log.txt; retorna o caminho do CSV."""
     # Salva CSV
-    # Garante nome seguro substituindo '/' por '_'
-    out_filename = os.path.join(os.path.dirname(output_csv), f"RESULTADO_VR_MENSAL_{str(competencia).replace('/', '_')}.csv")
+    out_filename = _caminho_resultado(output_dir, competencia)
     df_out.to_csv(out_filename, sep=';', index=False, encoding='utf-8-sig')
     logger.info(f"Planilha final CSV salva em: {out_filename}")
+    if not com_log:
+        return out_filename
 
     # salva log
     log_path = os.path.splitext(out_filename)[0] + '_log.txt'
@@ -657,4 +866,362 @@ def gerar_planilha_final(input_dir, output_csv, competencia=None):
             lf.write(l + '\n')
     logger.info(f"Log da geração final salvo em: {log_path}")
 
-    return out_filename
\ No newline at end of file
+    return out_filename
+
+
+def gerar_planilha_final(input_dir, output_csv, competencia=None, resolver=None):
+    """
+    Gera a planilha final para envio à operadora com os campos:
+    Matricula	Admissão	Sindicato do Colaborador	Competência	Dias	VALOR DIÁRIO VR	TOTAL	Custo empresa	Desconto profissional	OBS GERAL
+
+    - Usa o arquivo com valores de VR gerados (prefere base_unificada_calculation_vr.csv)
+    - Calcula VALOR DIÁRIO como TOTAL / Dias quando possível; faz fallback para valor por sindicato
+    - Custo empresa = 80% do TOTAL; Desconto profissional = 20% do TOTAL
+    - `resolver` permite compartilhar o `SindicatoValorResolver` usado em `calcular_valor_total_vr`
+    """
+    import logging
+
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger("calculation-final")
+    cache_dir = cache_dir_for(os.path.dirname(output_csv))
+
+    # Competência precisa ser texto no formato MM/YYYY
+    competencia = _normalizar_competencia(competencia)
+
+    # Carrega base de VR
+    base_path = os.path.join(os.path.dirname(output_csv), "base_unificada_calculation_vr.csv")
+    if not os.path.exists(base_path):
+        base_path = os.path.join(os.path.dirname(output_csv), "base_unificada_calculation.csv")
+    base = pd.read_csv(base_path, sep=';', encoding='utf-8-sig')
+    logger.info(f"Arquivo base carregado para planilha final: {base_path} ({len(base)} registros)")
+
+    # Carrega valores por sindicato (para fallback)
+    if resolver is None:
+        sindicato_valor_df = read_excel_cached(os.path.join(input_dir, 'Base sindicato x valor.xlsx'), cache_dir)
+        resolver = SindicatoValorResolver.from_dataframe(sindicato_valor_df)
+
+    df_out, logs_final = _montar_planilha_final(base, resolver, competencia)
+    out_filename = _salvar_planilha_final(df_out, logs_final, os.path.dirname(output_csv), competencia, logger)
+    logger.info(f"Resolvedor sindicato->valor: {resolver.stats()}")
+
+    return out_filename
+
+
+def _salvar_etapa(base, logs, path, logger):
+    """Grava o intermediário de uma etapa (no formato da extensão de `path`) e o respectivo _log.txt."""
+    gravar_intermediario(base, path)
+    log_path = os.path.splitext(path)[0] + "_log.txt"
+    with open(log_path, "w", encoding="utf-8") as f:
+        for log in logs:
+            f.write(log + "\n")
+    logger.info(f"Etapa salva em: {path} (log: {log_path})")
+
+
+class _SaidaEmBlocos:
+    """
+    Arquivo de uma etapa (CSV ';' UTF-8 com BOM, Parquet ou Arrow, pela extensão) e,
+    com `com_log`, seu _log.txt, gravados bloco a bloco.
+
+    Os arquivos são escritos com nome temporário e só aparecem no destino em
+    `concluir()`, para que ninguém leia um resultado pela metade.
+    """
+
+    def __init__(self, path, com_log=True):
+        self.path = path
+        self.log_path = os.path.splitext(path)[0] + "_log.txt"
+        self._dados = GravadorEmBlocos(path)
+        self._tmp_log = f"{self.log_path}.{os.getpid()}.tmp"
+        self._log = open(self._tmp_log, 'w', encoding='utf-8') if com_log else None
+
+    def escrever(self, df, logs):
+        self._dados.escrever(df)
+        if self._log is not None:
+            for log in logs:
+                self._log.write(log + "\n")
+
+    def concluir(self):
+        self._dados.concluir()
+        if self._log is not None:
+            self._log.close()
+            os.replace(self._tmp_log, self.log_path)
+
+    def descartar(self):
+        if self._log is not None:
+            self._log.close()
+        self._dados.descartar()
+        if os.path.exists(self._tmp_log):
+            os.remove(self._tmp_log)
+
+
+def _calcular_blocos(blocos, auxiliares, resolver, competencia, saidas_etapas=None, auditoria=None):
+    """
+    Gerador: aplica dias úteis -> desligamento -> valor VR -> linha final a cada bloco.
+
+    Todas as regras são por colaborador, então o resultado de cada bloco é o mesmo
+    que as suas linhas teriam no cálculo da base inteira. `saidas_etapas` (modo
+    auditoria) recebe cada etapa intermediária antes da seguinte alterar o bloco e
+    `auditoria` os registros de auditoria de cada etapa. Gera (df_out, logs_final) por
+    bloco; os logs só são montados quando há `saidas_etapas`.
+    """
+    dias_uteis, afastamentos, ferias, desligados, matriculas_elegiveis = auxiliares
+    com_logs = bool(saidas_etapas)
+    for base in blocos:
+        base, logs = _calcular_dias_uteis(base, dias_uteis, afastamentos, ferias, auditoria, com_logs)
+        if saidas_etapas:
+            saidas_etapas[0].escrever(base, logs)
+        base, logs = _aplicar_desligamento(base, desligados, matriculas_elegiveis, auditoria, com_logs)
+        if saidas_etapas:
+            saidas_etapas[1].escrever(base, logs)
+        base, logs = _calcular_valor_total(base, resolver, auditoria, com_logs)
+        if saidas_etapas:
+            saidas_etapas[2].escrever(base, logs)
+        df_out, logs_final = _montar_planilha_final(base, resolver, competencia, auditoria, com_logs)
+        yield df_out, logs_final
+
+
+def _executar_em_blocos(base_csv, auxiliares, resolver, competencia, output_dir, caminhos_etapas, chunksize, logger,
+                        auditoria=None):
+    """
+    Modo streaming de `executar_pipeline_calculo`; retorna o caminho do RESULTADO.
+
+    `caminhos_etapas` lista os intermediários a gravar (vazio fora do modo auditoria);
+    o _log.txt do RESULTADO só é gravado junto com eles.
+    """
+    out_filename = _caminho_resultado(output_dir, competencia)
+    saidas = [_SaidaEmBlocos(out_filename, com_log=bool(caminhos_etapas))]
+    saidas += [_SaidaEmBlocos(path) for path in caminhos_etapas]
+    try:
+        registros = 0
+        for df_out, logs_final in _calcular_blocos(ler_em_blocos(base_csv, chunksize), auxiliares,
+                                                    resolver, competencia, saidas[1:], auditoria):
+            saidas[0].escrever(df_out, logs_final)
+            registros += len(df_out)
+        for saida in saidas:
+            saida.concluir()
+    except BaseException:
+        for saida in saidas:
+            saida.descartar()
+        raise
+    anotar_linhas(registros)
+    logger.info(f"Planilha final CSV salva em: {out_filename} ({registros} registros, blocos de {chunksize} linhas)")
+    return out_filename
+
+
+def _chaves_calculo(etapas, workspace, base_csv, competencia):
+    """
+    Chaves das etapas do cálculo, encadeadas: cada etapa depende da chave da anterior e
+    das planilhas que lê. Retorna [(etapa, chave, dependências)] na ordem de execução.
+    """
+    def planilha(nome):
+        return impressao_digital(workspace.entrada(nome))
+
+    valores = planilha('Base sindicato x valor.xlsx')
+    dependencias_por_etapa = [
+        ('calculo_dias_uteis', {
+            'base': impressao_digital(base_csv),
+            'dias_uteis': planilha('Base dias uteis.xlsx'),
+            'afastamentos': planilha('AFASTAMENTOS.xlsx'),
+            'ferias': planilha('FÉRIAS.xlsx'),
+        }),
+        ('calculo_desligamento', {
+            'desligados': planilha('DESLIGADOS.xlsx'),
+            'exclusoes': planilha('base_tratamento_exclusoes.xlsx'),
+        }),
+        ('calculo_vr', {'valores': valores}),
+        ('calculo_final', {'valores': valores, 'competencia': competencia}),
+    ]
+    chaves = []
+    anterior = None
+    for etapa, dependencias in dependencias_por_etapa:
+        if anterior is not None:
+            dependencias['anterior'] = anterior
+        anterior = etapas.chave(etapa, **dependencias)
+        chaves.append((etapa, anterior, dependencias))
+    return chaves
+
+
+def _chave_delta(etapas, workspace, competencia):
+    """Chave do último cálculo da competência no workspace (base do cálculo por diferença)."""
+    return etapas.chave('calculo_delta', competencia=competencia, workspace=os.path.abspath(workspace.output_dir))
+
+
+def _calculo_por_diferenca(etapas, workspace, competencia, base, auxiliares, calculos, resolver, auditoria, logger):
+    """
+    Cálculo por diferença (ver delta.py): recalcula só as matrículas da `base` cuja
+    impressão digital mudou desde o último cálculo da competência neste workspace ou,
+    no primeiro cálculo de um reenvio, no job em que ele se baseou.
+
+    Retorna (atual, anterior, df_out): `atual` é o que se guarda com o resultado para a
+    próxima comparação, `anterior` o cálculo comparado (ou None) e `df_out` a planilha
+    final, ou None quando é preciso o cálculo completo (sem cálculo anterior, mudança
+    que vale para todas as linhas ou matrículas alteradas demais).
+    """
+    ferias, afastamentos, desligados, matriculas_elegiveis = auxiliares
+    matriculas = base['MATRICULA'].astype(str)
+    atual = {
+        'globais': assinatura_global(
+            base, ferias, desligados, matriculas_elegiveis, versao=VERSAO_ETAPAS, competencia=competencia,
+            dias_uteis=impressao_digital(workspace.entrada('Base dias uteis.xlsx')),
+            valores=impressao_digital(workspace.entrada('Base sindicato x valor.xlsx')),
+        ),
+        'impressoes': impressoes_por_matricula(base, ferias, afastamentos, desligados, matriculas_elegiveis),
+        'chaves': matriculas.to_numpy(),
+    }
+    # O cache de etapas é compartilhado entre os jobs, e o cálculo de um job sem relação com este não serve
+    anterior = obter_calculo(etapas, _chave_delta(etapas, workspace, competencia))
+    workspace_base = workspace.workspace_base()
+    if anterior is None and workspace_base is not None:
+        anterior = obter_calculo(etapas, _chave_delta(etapas, workspace_base, competencia))
+    if anterior is None or anterior['globais'] != atual['globais']:
+        return atual, anterior, None
+
+    recalculadas = matriculas.isin(matriculas_alteradas(anterior['impressoes'], atual['impressoes'])).to_numpy()
+    if not recalculadas.mean() <= CALCULATION_DELTA_MAX_FRACTION:
+        return atual, anterior, None
+    parcial = None
+    if recalculadas.any():
+        parcial = base[recalculadas].copy()
+        for calculo in calculos:
+            parcial, _ = calculo(parcial)
+        parcial, _ = _montar_planilha_final(parcial, resolver, competencia, auditoria, com_logs=False)
+    logger.info(f"Cálculo por diferença: {int(recalculadas.sum())} de {len(base)} linhas recalculadas")
+    return atual, anterior, mesclar_resultado(anterior, matriculas, recalculadas, parcial)
+
+
+def _retomar_etapas(etapas, chaves, base, base_csv, calculos, caminhos_etapas, logger):
+    """
+    Executa as etapas do cálculo a partir da última já guardada no cache de etapas com as
+    mesmas entradas (ou do início, com a `base` já lida ou lida de `base_csv`), guardando
+    as que executar. `caminhos_etapas` (modo auditoria) recebe cada etapa intermediária.
+    Retorna a base depois da última etapa.
+    """
+    inicio = 0
+    for i in reversed(range(len(chaves) - 1)):
+        calculada, _ = etapas.obter_tabela(chaves[i][1])
+        if calculada is not None:
+            base = calculada
+            inicio = i + 1
+            etapas.registrar(*chaves[i], reaproveitada=True)
+            break
+    if base is None:
+        base = ler_intermediario(base_csv)
+        logger.info(f"Arquivo base carregado: {base_csv} ({len(base)} registros)")
+
+    for i in range(inicio, len(calculos)):
+        base, logs = calculos[i](base)
+        if caminhos_etapas:
+            _salvar_etapa(base, logs, caminhos_etapas[i], logger)
+        if etapas:
+            etapas.guardar_tabela(chaves[i][1], base)
+            etapas.registrar(*chaves[i], reaproveitada=False)
+    return base
+
+
+@medido('calculo')
+def executar_pipeline_calculo(workspace, competencia=None, salvar_intermediarios=False, base_csv=None, streaming=None):
+    """
+    Executa dias úteis -> desligamento -> valor VR -> planilha final em uma única passada,
+    lendo e gravando no `workspace`. A base vem de `base_csv` (ou de
+    `workspace.base_para_calculo()`) e a competência, se omitida, do competencia.txt.
+    Os modos auditoria (`salvar_intermediarios`), em blocos (`streaming`; None decide
+    pelo tamanho da base), recálculo incremental e cálculo por diferença estão descritos
+    no README. Retorna o caminho do RESULTADO_VR_MENSAL_*.csv.
+    """
+    import logging
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger("calculation-pipeline")
+
+    input_dir = workspace.input_dir
+    output_dir = workspace.output_dir
+    cache_dir = workspace.cache_dir
+    base_csv = base_csv or workspace.base_para_calculo()
+    if base_csv is None:
+        raise FileNotFoundError(f"Nenhuma base unificada encontrada em {output_dir}")
+    competencia = _normalizar_competencia(competencia or workspace.ler_competencia())
+    if streaming is None:
+        streaming = os.path.getsize(base_csv) >= CALCULATION_STREAMING_MIN_BYTES
+
+    out_filename = _caminho_resultado(output_dir, competencia)
+    log_path = os.path.splitext(out_filename)[0] + '_log.txt'
+    # Fora do modo auditoria não há _log.txt (e o de um cálculo anterior não deve ficar)
+    saidas_finais = [out_filename]
+    # O relatório de alterações e a auditoria só valem para o cálculo que os gerou: ficam
+    # guardados junto com o resultado e voltam com ele quando ele é reaproveitado. O
+    # relatório compara com o cálculo anterior deste workspace, então é guardado por workspace
+    relatorio_path = os.path.join(output_dir, f"{RELATORIO_PREFIX}{str(competencia).replace('/', '_')}.csv")
+    auditoria_path = caminho_auditoria(output_dir, competencia)
+    etapas = CacheDeEtapas(workspace) if INCREMENTAL_RECALCULATION and not salvar_intermediarios else None
+    chaves = _chaves_calculo(etapas, workspace, base_csv, competencia) if etapas else []
+    chave_relatorio = etapas.chave('calculo_relatorio', resultado=chaves[-1][1],
+                                   workspace=os.path.abspath(output_dir)) if etapas else None
+    if (etapas and etapas.obter_arquivos(chaves[-1][1], saidas_finais, [auditoria_path, log_path])
+            and etapas.obter_arquivos(chave_relatorio, [], [relatorio_path])):
+        etapas.registrar(*chaves[-1], reaproveitada=True)
+        logger.info(f"Base e planilhas sem alterações; resultado anterior reaproveitado: {out_filename}")
+        return out_filename
+    for path in (relatorio_path, auditoria_path, log_path):
+        if os.path.exists(path):
+            os.remove(path)
+
+    # Carrega cada planilha auxiliar uma única vez
+    dias_uteis = read_excel_cached(os.path.join(input_dir, 'Base dias uteis.xlsx'), cache_dir, header=1)
+    afastamentos = read_excel_cached(os.path.join(input_dir, 'AFASTAMENTOS.xlsx'), cache_dir)
+    ferias = read_excel_cached(os.path.join(input_dir, 'FÉRIAS.xlsx'), cache_dir)
+    desligados = read_excel_cached(os.path.join(input_dir, 'DESLIGADOS.xlsx'), cache_dir)
+    resolver = SindicatoValorResolver.from_dataframe(
+        read_excel_cached(os.path.join(input_dir, 'Base sindicato x valor.xlsx'), cache_dir)
+    )
+    if not resolver.map_raw:
+        logger.warning("Mapa de sindicato/estado->valor ficou vazio após leitura de 'Base sindicato x valor.xlsx'.")
+    matriculas_elegiveis = _carregar_elegiveis(input_dir, cache_dir)
+
+    caminhos_etapas = [workspace.intermediario(nome) for nome in (
+        "base_unificada_calculation.csv",
+        "base_unificada_calculation_desligamento.csv",
+        "base_unificada_calculation_vr.csv",
+    )] if salvar_intermediarios else []
+
+    auditoria = RegistroDeAuditoria(auditoria_path)
+    with auditoria:
+        if streaming:
+            logger.info(f"Calculando {base_csv} em blocos de {CALCULATION_CHUNK_ROWS} linhas")
+            auxiliares = (dias_uteis, afastamentos, ferias, desligados, matriculas_elegiveis)
+            out_filename = _executar_em_blocos(base_csv, auxiliares, resolver, competencia, output_dir,
+                                               caminhos_etapas, CALCULATION_CHUNK_ROWS, logger, auditoria)
+        else:
+            calculos = [
+                lambda base: _calcular_dias_uteis(base, dias_uteis, afastamentos, ferias, auditoria, salvar_intermediarios),
+                lambda base: _aplicar_desligamento(base, desligados, matriculas_elegiveis, auditoria, salvar_intermediarios),
+                lambda base: _calcular_valor_total(base, resolver, auditoria, salvar_intermediarios),
+            ]
+
+            base = atual = anterior = df_out = None
+            logs = []
+            if etapas and CALCULATION_DELTA:
+                base = ler_intermediario(base_csv)
+                logger.info(f"Arquivo base carregado: {base_csv} ({len(base)} registros)")
+                atual, anterior, df_out = _calculo_por_diferenca(
+                    etapas, workspace, competencia, base, (ferias, afastamentos, desligados, matriculas_elegiveis),
+                    calculos, resolver, auditoria, logger)
+            if df_out is None:
+                base = _retomar_etapas(etapas, chaves, base, base_csv, calculos, caminhos_etapas, logger)
+                df_out, logs = _montar_planilha_final(base, resolver, competencia, auditoria, salvar_intermediarios)
+
+            anotar_linhas(len(df_out))
+            out_filename = _salvar_planilha_final(df_out, logs, output_dir, competencia, logger,
+                                                  com_log=salvar_intermediarios)
+            if anterior is not None:
+                relatorio = relatorio_alteracoes(anterior['saida'], anterior['chaves'], df_out, atual['chaves'])
+                relatorio.to_csv(relatorio_path, sep=';', index=False, encoding='utf-8-sig')
+                logger.info(f"Relatório de alterações ({len(relatorio)} linhas) salvo em: {relatorio_path}")
+            if atual is not None:
+                guardar_calculo(etapas, _chave_delta(etapas, workspace, competencia), atual['globais'],
+                                atual['impressoes'], atual['chaves'], df_out)
+
+    if etapas:
+        etapas.guardar_arquivos(chaves[-1][1], saidas_finais, [auditoria_path])
+        etapas.guardar_arquivos(chave_relatorio, [], [relatorio_path])
+        etapas.registrar(*chaves[-1], reaproveitada=False)
+    logger.info(f"Resolvedor sindicato->valor: {resolver.stats()}")
+
+    return out_filename
@@ -1,32 +1,53 @@
+import math
 import os
 import re
 from datetime import datetime
-from typing import Optional, Tuple
+from typing import Iterator, List, Optional, Tuple
 
 import pandas as pd
 
+from intermediates import tipos_das_colunas_csv
+from profiling import anotar_linhas, medido
+
 
 RESULT_PREFIX = "RESULTADO_VR_MENSAL_"
 
+# CSVs at least this large are converted in streaming mode (chunked read + write-only workbook)
+STREAMING_MIN_BYTES = int(os.environ.get("XLSX_STREAMING_MIN_BYTES", str(20 * 1024 * 1024)))
+STREAMING_CHUNK_ROWS = int(os.environ.get("XLSX_STREAMING_CHUNK_ROWS", "50000"))
+
+CSV_OPTIONS = {"sep": ";", "encoding": "utf-8-sig"}
+
 
 def _parse_month_year_from_filename(filename: str) -> Optional[Tuple[str, str]]:
 	"""Extract MM and YYYY from a filename like 'RESULTADO_VR_MENSAL_08_2025.csv'.
 
 	Returns (MM, YYYY) if matched, otherwise None.
 	"""
-	m = re.match(rf"^{RESULT_PREFIX}(\d{2})_(\d{4})\.csv$", filename)
+	m = re.match(rf"^{RESULT_PREFIX}(\d{{2}})_(\d{{4}})\.csv$", filename)
 	if not m:
 		return None
 	return m.group(1), m.group(2)
 
 
-def find_latest_result_csv(output_dir: str) -> Optional[str]:
+def result_csv_name(competencia: str) -> str:
+	"""Build the result CSV filename for a competência 'MM/YYYY': 'RESULTADO_VR_MENSAL_MM_YYYY.csv'"""
+	return f"{RESULT_PREFIX}{str(competencia).replace('/', '_')}.csv"
+
+
+def find_latest_result_csv(output_dir: str, competencia: Optional[str] = None) -> Optional[str]:
 	"""Return the most recent RESULTADO_VR_MENSAL_*.csv file path in output_dir.
 
+	If competencia ('MM/YYYY') is given, only that month's file is considered, so a
+	shared directory never serves another month's result.
+
 	Returns None if not found.
 	"""
 	if not os.path.isdir(output_dir):
 		return None
+	if competencia:
+		path = os.path.join(output_dir, result_csv_name(competencia))
+		return path if os.path.exists(path) else None
 	candidates = [
 		os.path.join(output_dir, f)
 		for f in os.listdir(output_dir)
@@ -50,17 +71,91 @@ def _make_xlsx_name(mm: str, yyyy: str) -> str:
 	return f"VR MENSAL {mm}.{yyyy}.xlsx"
 
 
-def convert_latest_result_to_xlsx(output_dir: str, dest_dir: Optional[str] = None) -> str:
+def _excel_value(value):
+	"""Cell value as DataFrame.to_excel writes it: NaN/None -> '' (na_rep), +/-inf -> 'inf'/'-inf'."""
+	if value is None:
+		return ""
+	if isinstance(value, float):
+		if math.isnan(value):
+			return ""
+		if math.isinf(value):
+			return "inf" if value > 0 else "-inf"
+	return value
+
+
+def _iter_csv_rows(csv_path: str, chunksize: int) -> Iterator[Tuple[List[str], Iterator[list]]]:
+	"""Yield (columns, rows) for each chunk of the CSV, with Python-native cell values."""
+	dtypes = tipos_das_colunas_csv(csv_path, chunksize, **CSV_OPTIONS)
+	for chunk in pd.read_csv(csv_path, chunksize=chunksize, dtype=dtypes, **CSV_OPTIONS):
+		columns = [chunk[col].tolist() for col in chunk.columns]
+		yield list(chunk.columns), ([_excel_value(v) for v in row] for row in zip(*columns))
+
+
+def _write_xlsx_streaming(csv_path: str, xlsx_path: str, chunksize: int = STREAMING_CHUNK_ROWS) -> int:
+	"""Convert CSV -> XLSX with constant memory: chunked read and an openpyxl write-only sheet.
+
+	The header gets the same style DataFrame.to_excel applies, so both modes produce the
+	same workbook (sheet 'Sheet1', same cell values and types). Returns the number of data rows.
+	"""
+	try:
+		from openpyxl import Workbook
+		from openpyxl.cell import WriteOnlyCell
+		from openpyxl.styles import Alignment, Border, Font, Side
+	except ImportError as e:
+		raise ImportError(
+			"Falha ao exportar Excel. Instale um engine XLSX, por exemplo: 'pip install openpyxl'"
+		) from e
+
+	wb = Workbook(write_only=True)
+	ws = wb.create_sheet("Sheet1")
+	thin = Side(style="thin")
+	header_font = Font(bold=True)
+	header_border = Border(left=thin, right=thin, top=thin, bottom=thin)
+	header_alignment = Alignment(horizontal="center", vertical="top")
+
+	header_written = False
+	total = 0
+	for columns, rows in _iter_csv_rows(csv_path, chunksize):
+		if not header_written:
+			header = []
+			for col in columns:
+				cell = WriteOnlyCell(ws, value=col)
+				cell.font = header_font
+				cell.border = header_border
+				cell.alignment = header_alignment
+				header.append(cell)
+			ws.append(header)
+			header_written = True
+		for row in rows:
+			ws.append(row)
+			total += 1
+	wb.save(xlsx_path)
+	return total
+
+
+@medido('conversao_xlsx')
+def convert_latest_result_to_xlsx(
+	output_dir: str,
+	dest_dir: Optional[str] = None,
+	competencia: Optional[str] = None,
+	streaming: Optional[bool] = None,
+) -> str:
 	"""Convert the latest RESULTADO_VR_MENSAL_*.csv found in output_dir to XLSX.
 
 	- output_dir: directory where RESULTADO_VR_MENSAL_*.csv files are stored
 	- dest_dir: where to write the resulting XLSX; if None, writes to output_dir
+	- competencia: 'MM/YYYY' to convert that month's file instead of the most recent one
+	- streaming: read the CSV in chunks and write a write-only workbook (constant memory);
+	  None chooses it automatically for CSVs of at least STREAMING_MIN_BYTES
+
+	The XLSX is written to a temporary name and renamed, so a partially written
+	'VR MENSAL *.xlsx' is never visible to readers of the directory.
 
 	Returns the absolute path of the generated XLSX file.
 	Raises FileNotFoundError if no CSV result is found.
 	Raises ImportError if an XLSX writer engine is not available.
 	"""
-	csv_path = find_latest_result_csv(output_dir)
+	csv_path = find_latest_result_csv(output_dir, competencia)
 	if not csv_path:
 		raise FileNotFoundError("Nenhum arquivo 'RESULTADO_VR_MENSAL_*.csv' encontrado em output.")
 
@@ -76,20 +171,33 @@ def convert_latest_result_to_xlsx(output_dir: str, dest_dir: Optional[str] = Non
 	target_dir = dest_dir or output_dir
 	os.makedirs(target_dir, exist_ok=True)
 	xlsx_path = os.path.join(target_dir, xlsx_name)
+	tmp_path = os.path.join(target_dir, f".~{os.getpid()}.{xlsx_name}")
 
-	# Read CSV with expected delimiter and encoding
-	df = pd.read_csv(csv_path, sep=';', encoding='utf-8-sig')
+	if streaming is None:
+		streaming = os.path.getsize(csv_path) >= STREAMING_MIN_BYTES
 
-	# Try to write to XLSX. This typically requires 'openpyxl' or 'xlsxwriter'.
 	try:
-		df.to_excel(xlsx_path, index=False)
-	except Exception as e:
-		# Provide a clearer message for missing engine
-		if 'openpyxl' in str(e).lower() or 'xlsxwriter' in str(e).lower():
-			raise ImportError(
-				"Falha ao exportar Excel. Instale um engine XLSX, por exemplo: 'pip install openpyxl'"
-			) from e
-		raise
+		if streaming:
+			anotar_linhas(_write_xlsx_streaming(csv_path, tmp_path))
+		else:
+			# Read CSV with expected delimiter and encoding
+			df = pd.read_csv(csv_path, **CSV_OPTIONS)
+			anotar_linhas(len(df))
+
+			# Try to write to XLSX. This typically requires 'openpyxl' or 'xlsxwriter'.
+			try:
+				df.to_excel(tmp_path, index=False)
+			except Exception as e:
+				# Provide a clearer message for missing engine
+				if 'openpyxl' in str(e).lower() or 'xlsxwriter' in str(e).lower():
+					raise ImportError(
+						"Falha ao exportar Excel. Instale um engine XLSX, por exemplo: 'pip install openpyxl'"
+					) from e
+				raise
+		os.replace(tmp_path, xlsx_path)
+	finally:
+		if os.path.exists(tmp_path):
+			os.remove(tmp_path)
 
 	return xlsx_path
 
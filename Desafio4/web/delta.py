@@ -0,0 +1,168 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# Recalcula só as matrículas que mudaram desde o último cálculo da mesma competência (no mesmo
+# workspace ou no job anterior de um reenvio)
+CALCULATION_DELTA = os.environ.get('CALCULATION_DELTA', '1').lower() in ('1', 'true', 'sim')
+# Acima desta fração de linhas alteradas faz o cálculo completo
+CALCULATION_DELTA_MAX_FRACTION = float(os.environ.get('CALCULATION_DELTA_MAX_FRACTION', '0.5'))
+RELATORIO_PREFIX = 'ALTERACOES_VR_MENSAL_'
+
+# Colunas acrescentadas à planilha final no cálculo guardado (ver `guardar_calculo`)
+_MATRICULA = '__matricula__'
+_IMPRESSAO = '__impressao__'
+
+INCLUIDA = 'incluída'
+REMOVIDA = 'removida'
+ALTERADA = 'alterada'
+
+
+def _hash_linhas(df):
+    return pd.util.hash_pandas_object(df, index=False).to_numpy()
+
+
+def _por_chave(chaves, hashes):
+    """Combina os hashes das linhas de cada chave (a ordem das linhas conta)."""
+    chaves = pd.Series(np.asarray(chaves, dtype=object))
+    ocorrencia = chaves.groupby(chaves, sort=False).cumcount().to_numpy()
+    combinados = _hash_linhas(pd.DataFrame({'h': hashes, 'o': ocorrencia}))
+    return pd.Series(combinados, index=chaves.to_numpy()).groupby(level=0, sort=False).sum()
+
+
+def _alinhar(por_chave, chaves):
+    """Valores de `por_chave` para cada chave (0 para as ausentes), sem passar por float."""
+    posicoes = por_chave.index.get_indexer(chaves)
+    return np.append(por_chave.to_numpy(dtype='uint64'), np.uint64(0))[posicoes]
+
+
+def impressoes_por_matricula(base, ferias, afastamentos, desligados, matriculas_elegiveis):
+    """
+    Impressão digital (uint64) de tudo o que o cálculo lê para cada matrícula, indexada
+    pela MATRICULA como texto: as linhas da base, as linhas de FÉRIAS, o primeiro
+    registro de DESLIGADOS e se ela está em AFASTAMENTOS e entre as elegíveis.
+    """
+    matricula = base['MATRICULA'].astype(str)
+    contexto = pd.DataFrame({'base': _hash_linhas(base)}, index=base.index)
+    if 'DIAS DE FÉRIAS' in ferias and 'MATRICULA' in ferias:
+        linhas_ferias = ferias[['MATRICULA', 'DIAS DE FÉRIAS']]
+        contexto['ferias'] = _alinhar(_por_chave(linhas_ferias['MATRICULA'].astype(str), _hash_linhas(linhas_ferias)), matricula)
+    contexto['afastado'] = matricula.isin(set(afastamentos['MATRICULA'].astype(str)))
+    desligados = desligados.copy()
+    desligados.columns = [str(col).strip().upper() for col in desligados.columns]
+    chaves_desligados = desligados['MATRICULA'].astype(str)
+    primeiro = ~chaves_desligados.duplicated(keep='first')
+    registros = pd.Series(_hash_linhas(desligados[primeiro]), index=chaves_desligados[primeiro].to_numpy())
+    contexto['desligado'] = _alinhar(registros, matricula)
+    if matriculas_elegiveis is not None:
+        contexto['elegivel'] = matricula.isin(matriculas_elegiveis)
+    return _por_chave(matricula, _hash_linhas(contexto))
+
+
+def assinatura_global(base, ferias, desligados, matriculas_elegiveis, **dependencias):
+    """
+    O que vale para todas as linhas: `dependencias` (planilhas por sindicato/estado,
+    competência, versão) e as colunas e tipos das tabelas lidas. Se mudar, o cálculo
+    por diferença não se aplica. Já vem como sai do JSON em que é guardada.
+    """
+    def tipos(df):
+        return [[str(col), str(tipo)] for col, tipo in df.dtypes.items()]
+    assinatura = dict(dependencias, base=tipos(base), ferias=tipos(ferias), desligados=tipos(desligados),
+                      elegiveis=matriculas_elegiveis is not None)
+    return json.loads(json.dumps(assinatura, default=str))
+
+
+def matriculas_alteradas(anteriores, atuais):
+    """Matrículas novas ou com impressão digital diferente da execução anterior."""
+    nova = anteriores.index.get_indexer(atuais.index) < 0
+    return atuais.index[nova | (_alinhar(anteriores, atuais.index) != atuais.to_numpy(dtype='uint64'))]
+
+
+def guardar_calculo(etapas, chave, globais, impressoes, chaves, saida):
+    """
+    Guarda no cache de etapas um cálculo para a próxima comparação: a planilha final com
+    a matrícula e a impressão digital de cada linha, e `globais` nos metadados.
+    """
+    tabela = saida.reset_index(drop=True)
+    tabela[_MATRICULA] = np.asarray(chaves, dtype=object)
+    tabela[_IMPRESSAO] = _alinhar(impressoes, tabela[_MATRICULA])
+    etapas.guardar_tabela(chave, tabela, {'globais': globais})
+
+
+def obter_calculo(etapas, chave):
+    """Cálculo guardado por `guardar_calculo` ({'globais', 'impressoes', 'chaves', 'saida'}) ou None."""
+    tabela, dados = etapas.obter_tabela(chave)
+    if tabela is None or not dados:
+        return None
+    chaves = tabela[_MATRICULA].to_numpy(dtype=object)
+    primeira = ~tabela[_MATRICULA].duplicated()
+    impressoes = pd.Series(tabela[_IMPRESSAO][primeira].to_numpy(dtype='uint64'), index=chaves[primeira.to_numpy()])
+    return {
+        'globais': dados['globais'],
+        'impressoes': impressoes,
+        'chaves': chaves,
+        'saida': tabela.drop(columns=[_MATRICULA, _IMPRESSAO]),
+    }
+
+
+def _chaves_com_ocorrencia(*listas):
+    """
+    Chave inteira (matrícula, ocorrência da matrícula) de cada linha de cada lista de
+    matrículas, numa numeração comum a todas as listas.
+    """
+    codigos, _ = pd.factorize(np.concatenate([np.asarray(chaves, dtype=object) for chaves in listas]))
+    indices = []
+    inicio = 0
+    for chaves in listas:
+        parte = codigos[inicio:inicio + len(chaves)]
+        inicio += len(chaves)
+        ocorrencia = pd.Series(parte).groupby(parte).cumcount().to_numpy()
+        indices.append(pd.Index(parte.astype('int64') * (1 << 32) + ocorrencia))
+    return indices
+
+
+def mesclar_resultado(anterior, chaves, recalculadas, parcial):
+    """
+    Planilha final na ordem de `chaves` (matrícula de cada linha da base): linhas em
+    `recalculadas` vêm de `parcial` (mesma ordem relativa), as demais do resultado
+    anterior.
+    """
+    recalculadas = np.asarray(recalculadas, dtype=bool)
+    indice_anterior, indice_atual = _chaves_com_ocorrencia(anterior['chaves'], chaves)
+    posicoes = indice_anterior.get_indexer(indice_atual)
+    saida = anterior['saida']
+    if recalculadas.any():
+        posicoes[recalculadas] = len(anterior['saida']) + np.arange(int(recalculadas.sum()))
+        saida = pd.concat([anterior['saida'], parcial], ignore_index=True)
+    if (posicoes < 0).any():
+        raise ValueError("Resultado anterior não contém todas as matrículas inalteradas")
+    return saida.take(posicoes).reset_index(drop=True)
+
+
+def relatorio_alteracoes(anterior, chaves_anteriores, atual, chaves_atuais):
+    """
+    Linhas da planilha final que mudaram entre duas execuções, casadas por matrícula
+    (e ordem dentro da matrícula): 'incluída', 'removida' ou 'alterada', com dias e
+    total antes e depois.
+    """
+    indice_anterior, indice_atual = _chaves_com_ocorrencia(chaves_anteriores, chaves_atuais)
+    removidas = ~indice_anterior.isin(indice_atual)
+    todas = indice_atual.append(indice_anterior[removidas])
+    matriculas = np.concatenate([np.asarray(chaves_atuais, dtype=object), np.asarray(chaves_anteriores, dtype=object)[removidas]])
+    antes = anterior.set_axis(indice_anterior).reindex(todas)
+    depois = atual.set_axis(indice_atual).reindex(todas)
+    presente_antes = todas.isin(indice_anterior)
+    presente_depois = np.arange(len(todas)) < len(indice_atual)
+    diferente = ((antes != depois) & ~(antes.isna() & depois.isna())).any(axis=1).to_numpy()
+    situacao = np.select([~presente_antes, ~presente_depois, diferente], [INCLUIDA, REMOVIDA, ALTERADA], '')
+    mudou = situacao != ''
+    return pd.DataFrame({
+        'Matricula': matriculas[mudou],
+        'Alteração': situacao[mudou],
+        'Dias anterior': antes['Dias'].to_numpy()[mudou],
+        'Dias': depois['Dias'].to_numpy()[mudou],
+        'TOTAL anterior': antes['TOTAL'].to_numpy()[mudou],
+        'TOTAL': depois['TOTAL'].to_numpy()[mudou],
+    })
@@ -0,0 +1,294 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import pandas as pd
+
+from profiling import medir
+
+try:
+    import pyarrow  # noqa: F401  (engine do Parquet)
+    _HAS_PARQUET = True
+except ImportError:
+    _HAS_PARQUET = False
+
+logger = logging.getLogger("excel-cache")
+
+# Subpasta (dentro de output/) onde ficam as planilhas já convertidas
+CACHE_SUBDIR = '.cache'
+MAX_DISK_ENTRIES = int(os.environ.get('EXCEL_CACHE_MAX_ENTRIES', '64'))
+MAX_DISK_AGE_DAYS = float(os.environ.get('EXCEL_CACHE_MAX_AGE_DAYS', '30'))
+MAX_MEMORY_ENTRIES = int(os.environ.get('EXCEL_CACHE_MEMORY_ENTRIES', '32'))
+# Processos usados para converter várias planilhas ao mesmo tempo (1 = leitura em série)
+READ_WORKERS = int(os.environ.get('EXCEL_READ_WORKERS', str(min(4, os.cpu_count() or 1))))
+# Iniciar o pool custa alguns segundos (spawn reimporta pandas em cada processo): só vale
+# a pena com muito a converter. O pool é usado quando as planilhas a converter somam ao
+# menos EXCEL_PARALLEL_MIN_BYTES ou são ao menos EXCEL_PARALLEL_MIN_SHEETS (0 desliga o
+# critério); abaixo disso a leitura é em série. Com as planilhas de exemplo (~150 KB),
+# 10 planilhas levam ~1,6 s em série e ~5,3 s com 4 processos.
+PARALLEL_MIN_BYTES = int(os.environ.get('EXCEL_PARALLEL_MIN_BYTES', str(32 * 1024 * 1024)))
+PARALLEL_MIN_SHEETS = int(os.environ.get('EXCEL_PARALLEL_MIN_SHEETS', '0'))
+
+_memoria = OrderedDict()  # chave -> DataFrame
+_hash_por_stat = {}  # (path, size, mtime_ns) -> sha1 do conteúdo
+_lock = threading.Lock()
+_stats = {'memoria': 0, 'disco': 0, 'excel': 0}
+_pool = None
+_pool_workers = 0
+
+
+def cache_dir_for(output_dir):
+    """Diretório de cache padrão para um diretório de saída (output/.cache)."""
+    return os.path.join(output_dir, CACHE_SUBDIR)
+
+
+def hash_conteudo(path):
+    """sha1 do arquivo; só relê o conteúdo quando tamanho/mtime mudam."""
+    st = os.stat(path)
+    stat_key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    digest = _hash_por_stat.get(stat_key)
+    if digest is None:
+        if len(_hash_por_stat) > 1024:
+            _hash_por_stat.clear()
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for bloco in iter(lambda: f.read(1 << 20), b''):
+                sha.update(bloco)
+        digest = sha.hexdigest()
+        _hash_por_stat[stat_key] = digest
+    return digest
+
+
+def _chave(path, kwargs):
+    """Chave do cache: conteúdo do arquivo + parâmetros de leitura (ex.: header=1)."""
+    params = repr(sorted(kwargs.items()))
+    return hashlib.sha1(f"{hash_conteudo(path)}|{params}".encode('utf-8')).hexdigest()
+
+
+def normaliza_nulos(df):
+    """O Parquet devolve None em colunas texto; o read_excel devolve NaN."""
+    for col in df.columns[df.dtypes == object]:
+        df[col] = df[col].where(df[col].notna(), float('nan'))
+    return df
+
+
+def mesmo_frame(a, b):
+    """Se `b` (lido de volta do disco) reproduz `a` exatamente: colunas, tipos, índice e valores."""
+    return (
+        list(a.columns) == list(b.columns)
+        and [type(c) for c in a.columns] == [type(c) for c in b.columns]
+        and a.dtypes.equals(b.dtypes)
+        and a.index.equals(b.index)
+        and a.equals(b)
+    )
+
+
+def _ler_disco(cache_dir, chave):
+    parquet_path = os.path.join(cache_dir, chave + '.parquet')
+    pickle_path = os.path.join(cache_dir, chave + '.pkl')
+    try:
+        if _HAS_PARQUET and os.path.exists(parquet_path):
+            df = normaliza_nulos(pd.read_parquet(parquet_path))
+            os.utime(parquet_path)
+            return df
+        if os.path.exists(pickle_path):
+            df = pd.read_pickle(pickle_path)
+            os.utime(pickle_path)
+            return df
+    except Exception as e:
+        logger.warning(f"Entrada de cache ilegível ({chave}): {e}")
+    return None
+
+
+def _gravar_disco(df, cache_dir, chave):
+    """
+    Grava a planilha convertida em Parquet. Se o Parquet não reproduzir o DataFrame
+    exatamente (colunas com nomes numéricos, tipos mistos etc.), usa pickle.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = os.path.join(cache_dir, f"{chave}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        if _HAS_PARQUET:
+            try:
+                df.to_parquet(tmp_path)
+                fiel = mesmo_frame(df, normaliza_nulos(pd.read_parquet(tmp_path)))
+            except Exception:
+                fiel = False
+            if fiel:
+                os.replace(tmp_path, os.path.join(cache_dir, chave + '.parquet'))
+                return
+        df.to_pickle(tmp_path, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, os.path.join(cache_dir, chave + '.pkl'))
+    except Exception as e:
+        logger.warning(f"Não foi possível gravar cache da planilha ({chave}): {e}")
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        _evict_disco(cache_dir)
+
+
+def _evict_disco(cache_dir):
+    """Remove entradas mais antigas que MAX_DISK_AGE_DAYS e mantém no máximo MAX_DISK_ENTRIES."""
+    try:
+        entradas = [
+            os.path.join(cache_dir, f) for f in os.listdir(cache_dir)
+            if f.endswith('.parquet') or f.endswith('.pkl')
+        ]
+        entradas.sort(key=os.path.getmtime, reverse=True)
+        limite = time.time() - MAX_DISK_AGE_DAYS * 86400
+        for i, path in enumerate(entradas):
+            if i >= MAX_DISK_ENTRIES or os.path.getmtime(path) < limite:
+                os.remove(path)
+    except OSError as e:
+        logger.warning(f"Falha ao limpar cache de planilhas em {cache_dir}: {e}")
+
+
+def _lembrar(chave, df):
+    with _lock:
+        _memoria[chave] = df
+        _memoria.move_to_end(chave)
+        while len(_memoria) > MAX_MEMORY_ENTRIES:
+            _memoria.popitem(last=False)
+
+
+def read_excel_cached(path, cache_dir=None, **kwargs):
+    """
+    Equivalente a `pd.read_excel(path, **kwargs)` com cache em dois níveis.
+
+    A chave combina o conteúdo do arquivo (sha1, recalculado só quando tamanho ou
+    mtime mudam) com os parâmetros de leitura. O primeiro nível é um LRU em memória
+    do processo; o segundo, se `cache_dir` for informado, guarda a planilha em
+    Parquet (ou pickle, quando o Parquet não reproduz o DataFrame fielmente), de modo
+    que execuções repetidas não voltam ao openpyxl. Sempre devolve uma cópia. Cada
+    leitura é medida como a etapa 'leitura_excel:<arquivo>' (ver profiling).
+    """
+    with medir(f"leitura_excel:{os.path.basename(path)}") as medicao:
+        df = _ler_com_cache(path, cache_dir, kwargs)
+        medicao.linhas = len(df)
+    return df
+
+
+def _ler_com_cache(path, cache_dir, kwargs):
+    chave = _chave(path, kwargs)
+    with _lock:
+        df = _memoria.get(chave)
+        if df is not None:
+            _memoria.move_to_end(chave)
+            _stats['memoria'] += 1
+            return df.copy()
+
+    df = _ler_disco(cache_dir, chave) if cache_dir else None
+    if df is not None:
+        _stats['disco'] += 1
+    else:
+        df = pd.read_excel(path, **kwargs)
+        _stats['excel'] += 1
+        if cache_dir:
+            _gravar_disco(df, cache_dir, chave)
+    _lembrar(chave, df)
+    return df.copy()
+
+
+def _ler_excel(path, kwargs):
+    """Executado nos processos do pool (precisa ser uma função de módulo)."""
+    return pd.read_excel(path, **kwargs)
+
+
+def _obter_pool(workers):
+    """Pool de processos compartilhado, criado no primeiro uso (spawn: seguro com threads)."""
+    global _pool, _pool_workers
+    with _lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            _pool_workers = workers
+        return _pool
+
+
+def _descartar_pool():
+    global _pool
+    with _lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def _vale_paralelizar(pendentes):
+    """Se as planilhas a converter são muitas ou grandes o bastante para pagar o pool."""
+    pendentes = list(pendentes)
+    if PARALLEL_MIN_SHEETS and len(pendentes) >= PARALLEL_MIN_SHEETS:
+        return True
+    try:
+        total = sum(os.path.getsize(path) for path, _ in pendentes)
+    except OSError:
+        return False
+    return total >= PARALLEL_MIN_BYTES
+
+
+def read_excel_many(leituras, cache_dir=None, workers=None):
+    """
+    Lê várias planilhas de uma vez, convertendo em paralelo as que não estão no cache.
+
+    `leituras` é uma lista de (path, kwargs). As planilhas já em cache (memória ou
+    disco) são servidas direto; as demais são convertidas pelo openpyxl em até
+    `workers` processos (padrão EXCEL_READ_WORKERS) e gravadas no cache como em
+    `read_excel_cached`, de modo que as leituras seguintes — inclusive de outras
+    etapas — não voltam ao openpyxl. A leitura é feita em série com um worker, com
+    uma única planilha a converter, abaixo dos limites de `_vale_paralelizar` ou se
+    o pool não puder ser usado.
+
+    Devolve uma lista de DataFrames (cópias) na mesma ordem de `leituras`.
+    """
+    workers = READ_WORKERS if workers is None else workers
+    chaves = [_chave(path, kwargs) for path, kwargs in leituras]
+
+    pendentes = {}
+    for (path, kwargs), chave in zip(leituras, chaves):
+        with _lock:
+            em_memoria = chave in _memoria
+        if em_memoria or chave in pendentes:
+            continue
+        df = _ler_disco(cache_dir, chave) if cache_dir else None
+        if df is not None:
+            _stats['disco'] += 1
+            _lembrar(chave, df)
+        else:
+            pendentes[chave] = (path, kwargs)
+
+    if workers > 1 and len(pendentes) > 1 and _vale_paralelizar(pendentes.values()):
+        # A conversão roda em outros processos: a medida tem o tempo de relógio de todas juntas
+        with medir('leitura_excel_paralela') as medicao:
+            medicao.linhas = 0
+            try:
+                pool = _obter_pool(workers)
+                futuros = {chave: pool.submit(_ler_excel, path, kwargs) for chave, (path, kwargs) in pendentes.items()}
+                for chave, futuro in futuros.items():
+                    df = futuro.result()
+                    medicao.linhas += len(df)
+                    _stats['excel'] += 1
+                    if cache_dir:
+                        _gravar_disco(df, cache_dir, chave)
+                    _lembrar(chave, df)
+                    del pendentes[chave]
+            except (BrokenProcessPool, OSError, RuntimeError) as e:
+                logger.warning(f"Leitura paralela de planilhas indisponível ({e}); lendo em série.")
+                _descartar_pool()
+
+    # Em série: um worker, uma única planilha ou falha do pool
+    for path, kwargs in pendentes.values():
+        read_excel_cached(path, cache_dir, **kwargs)
+
+    return [read_excel_cached(path, cache_dir, **kwargs) for path, kwargs in leituras]
+
+
+def cache_stats():
+    """Contadores de leituras servidas pela memória, pelo disco ou pelo openpyxl."""
+    return dict(_stats, entradas_memoria=len(_memoria))
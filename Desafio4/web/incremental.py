@@ -0,0 +1,218 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+import pandas as pd
+
+from excel_cache import hash_conteudo, mesmo_frame, normaliza_nulos
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    _HAS_PARQUET = True
+except ImportError:
+    _HAS_PARQUET = False
+
+logger = logging.getLogger("incremental")
+
+# Reaproveita etapas cujas entradas não mudaram desde uma execução anterior
+INCREMENTAL_RECALCULATION = os.environ.get('INCREMENTAL_RECALCULATION', '1').lower() in ('1', 'true', 'sim')
+# Subpasta do cache de planilhas onde ficam os resultados das etapas
+ETAPAS_SUBDIR = 'etapas'
+ETAPAS_MAX_ENTRIES = int(os.environ.get('ETAPAS_CACHE_MAX_ENTRIES', '32'))
+ETAPAS_MAX_AGE_DAYS = float(os.environ.get('ETAPAS_CACHE_MAX_AGE_DAYS', '7'))
+MANIFESTO_FILENAME = 'pipeline_manifest.json'
+# Módulos com a lógica das etapas (a unificação está no app.py). A versão das etapas é o
+# hash do código deles: qualquer mudança invalida os resultados guardados
+MODULOS_DAS_ETAPAS = ('app.py', 'unification.py', 'validation.py', 'calculation.py', 'delta.py',
+                      'intermediates.py', 'excel_cache.py', 'incremental.py')
+
+_lock = threading.Lock()
+
+
+def _versao_das_etapas():
+    sha = hashlib.sha1()
+    pasta = os.path.dirname(os.path.abspath(__file__))
+    for nome in MODULOS_DAS_ETAPAS:
+        with open(os.path.join(pasta, nome), 'rb') as f:
+            sha.update(f.read())
+    return sha.hexdigest()[:16]
+
+
+VERSAO_ETAPAS = _versao_das_etapas()
+
+
+def impressao_digital(path):
+    """sha1 do conteúdo do arquivo, ou None se ele não existir."""
+    if not path or not os.path.exists(path):
+        return None
+    return hash_conteudo(path)
+
+
+class CacheDeEtapas:
+    """
+    Resultados de etapas do fluxo (unificação, validação e etapas do cálculo) guardados
+    pela impressão digital das suas entradas.
+
+    A chave de uma etapa combina o nome da etapa, VERSAO_ETAPAS (hash do código das
+    etapas) e as dependências (sha1 das planilhas e arquivos lidos, parâmetros e a chave
+    da etapa anterior), então uma planilha alterada invalida só as etapas que dependem
+    dela. Os resultados ficam em `<cache_dir>/etapas/` e, como o cache de planilhas,
+    podem ser compartilhados entre workspaces; por isso são guardados só como dados
+    (Parquet, JSON e cópias dos arquivos gerados), nunca como pickle. Cada etapa
+    executada ou reaproveitada é registrada no pipeline_manifest.json do workspace.
+    """
+
+    def __init__(self, workspace):
+        self.workspace = workspace
+        self.diretorio = os.path.join(workspace.cache_dir, ETAPAS_SUBDIR)
+
+    def chave(self, etapa, **dependencias):
+        conteudo = json.dumps({'etapa': etapa, 'versao': VERSAO_ETAPAS, 'dependencias': dependencias},
+                              sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha1(conteudo.encode('utf-8')).hexdigest()
+
+    def _caminho(self, chave, sufixo):
+        return os.path.join(self.diretorio, chave + sufixo)
+
+    def _gravar(self, destino, escrever):
+        os.makedirs(self.diretorio, exist_ok=True)
+        tmp_path = f"{destino}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            escrever(tmp_path)
+            os.replace(tmp_path, destino)
+        except Exception as e:
+            logger.warning(f"Não foi possível guardar resultado da etapa ({os.path.basename(destino)}): {e}")
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def obter_dados(self, chave):
+        """Dados (JSON) guardados por `guardar_dados`, ou None."""
+        path = self._caminho(chave, '.json')
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                dados = json.load(f)
+            os.utime(path)
+            return dados
+        except Exception as e:
+            logger.warning(f"Resultado de etapa ilegível ({chave}): {e}")
+            return None
+
+    def guardar_dados(self, chave, dados):
+        def escrever(tmp_path):
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(dados, f, ensure_ascii=False)
+        self._gravar(self._caminho(chave, '.json'), escrever)
+        self._evict()
+
+    def obter_tabela(self, chave):
+        """(DataFrame, dados) guardados por `guardar_tabela`, ou (None, None)."""
+        path = self._caminho(chave, '.parquet')
+        if not _HAS_PARQUET or not os.path.exists(path):
+            return None, None
+        try:
+            tabela = pq.read_table(path)
+            dados = json.loads((tabela.schema.metadata or {}).get(b'dados', b'null'))
+            df = normaliza_nulos(tabela.to_pandas())
+            os.utime(path)
+            return df, dados
+        except Exception as e:
+            logger.warning(f"Resultado de etapa ilegível ({chave}): {e}")
+            return None, None
+
+    def guardar_tabela(self, chave, df, dados=None):
+        """
+        Guarda `df` em Parquet, com `dados` (JSON) nos metadados do mesmo arquivo. Se o
+        Parquet não reproduzir o DataFrame exatamente (tipos mistos numa coluna etc.), a
+        etapa não é guardada e será executada de novo.
+        """
+        if not _HAS_PARQUET:
+            return
+
+        def escrever(tmp_path):
+            tabela = pa.Table.from_pandas(df)
+            metadados = dict(tabela.schema.metadata or {}, dados=json.dumps(dados, ensure_ascii=False))
+            pq.write_table(tabela.replace_schema_metadata(metadados), tmp_path)
+            if not mesmo_frame(df, normaliza_nulos(pd.read_parquet(tmp_path))):
+                raise ValueError("o Parquet não reproduz o DataFrame")
+        self._gravar(self._caminho(chave, '.parquet'), escrever)
+        self._evict()
+
+    def obter_arquivos(self, chave, destinos, opcionais=()):
+        """
+        Copia para `destinos` os arquivos guardados com `guardar_arquivos`; False se faltar
+        algum. Cada um dos `opcionais` é restaurado se tiver sido guardado e removido do
+        destino se não tiver (para não ficar um arquivo de outra execução).
+        """
+        origens = self._origens(chave, destinos)
+        if not all(os.path.exists(o) for o in origens):
+            return False
+        copias = list(zip(origens, destinos))
+        for origem, destino in zip(self._origens(chave, opcionais, inicio=len(destinos)), opcionais):
+            if os.path.exists(origem):
+                copias.append((origem, destino))
+            elif os.path.exists(destino):
+                os.remove(destino)
+        try:
+            for origem, destino in copias:
+                tmp_path = f"{destino}.{os.getpid()}.{threading.get_ident()}.tmp"
+                shutil.copyfile(origem, tmp_path)
+                os.replace(tmp_path, destino)
+                os.utime(origem)
+        except OSError as e:
+            logger.warning(f"Não foi possível restaurar resultado da etapa ({chave}): {e}")
+            return False
+        return True
+
+    def guardar_arquivos(self, chave, origens, opcionais=()):
+        """Guarda os arquivos `origens` e, dos `opcionais`, os que existirem."""
+        for origem, destino in zip(origens, self._origens(chave, origens)):
+            self._gravar(destino, lambda tmp_path: shutil.copyfile(origem, tmp_path))
+        for origem, destino in zip(opcionais, self._origens(chave, opcionais, inicio=len(origens))):
+            if os.path.exists(origem):
+                self._gravar(destino, lambda tmp_path: shutil.copyfile(origem, tmp_path))
+            elif os.path.exists(destino):
+                os.remove(destino)
+        self._evict()
+
+    def _origens(self, chave, arquivos, inicio=0):
+        return [self._caminho(chave, f"_{i}{os.path.splitext(a)[1]}") for i, a in enumerate(arquivos, start=inicio)]
+
+    def _evict(self):
+        """Remove resultados mais antigos que ETAPAS_MAX_AGE_DAYS e mantém no máximo ETAPAS_MAX_ENTRIES chaves."""
+        try:
+            ultimo_uso = {}
+            for f in os.listdir(self.diretorio):
+                if f.endswith('.tmp'):
+                    continue
+                chave = f[:40]
+                ultimo_uso[chave] = max(ultimo_uso.get(chave, 0), os.path.getmtime(os.path.join(self.diretorio, f)))
+            ordem = sorted(ultimo_uso, key=ultimo_uso.get, reverse=True)
+            limite = time.time() - ETAPAS_MAX_AGE_DAYS * 86400
+            removidas = {c for i, c in enumerate(ordem) if i >= ETAPAS_MAX_ENTRIES or ultimo_uso[c] < limite}
+            for f in os.listdir(self.diretorio):
+                if f[:40] in removidas and not f.endswith('.tmp'):
+                    os.remove(os.path.join(self.diretorio, f))
+        except OSError as e:
+            logger.warning(f"Falha ao limpar resultados de etapas em {self.diretorio}: {e}")
+
+    def registrar(self, etapa, chave, dependencias, reaproveitada):
+        """Anota a etapa no pipeline_manifest.json do workspace."""
+        path = self.workspace.caminho(MANIFESTO_FILENAME)
+        with _lock:
+            manifesto = self.workspace.ler_json(path) or {}
+            manifesto[etapa] = {
+                'chave': chave,
+                'dependencias': dependencias,
+                'reaproveitada': reaproveitada,
+                'registrada_em': time.time(),
+            }
+            self.workspace.salvar_json(path, manifesto)
+        logger.info(f"Etapa {etapa}: {'reaproveitada' if reaproveitada else 'executada'} ({chave[:12]})")
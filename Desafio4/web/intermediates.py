@@ -0,0 +1,287 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+    _HAS_ARROW = True
+except ImportError:
+    _HAS_ARROW = False
+
+# Formato dos arquivos intermediários (base_unificada*, etapas do cálculo): csv, parquet ou
+# arrow (Arrow IPC, lido com memory map). O RESULTADO_VR_MENSAL_*.csv é sempre CSV.
+INTERMEDIATE_FORMAT = os.environ.get('INTERMEDIATE_FORMAT', 'csv').strip().lower()
+EXTENSOES = {'csv': '.csv', 'parquet': '.parquet', 'arrow': '.arrow'}
+
+TEXTO = 'texto'
+DATA = 'data'
+NUMERO = 'numero'
+
+# Tipos fixos das colunas conhecidas. As demais seguem o tipo do DataFrame: números viram
+# float, datas continuam datas e qualquer outra coisa vira texto.
+ESQUEMA = {
+    'MATRICULA': TEXTO,
+    'Admissão': DATA,
+    'Cargo': TEXTO,
+    'DESC. SITUACAO': TEXTO,
+    'DIAS DE FÉRIAS': NUMERO,
+    'Sindicato': TEXTO,
+    'DATA DEMISSÃO': DATA,
+    'COMUNICADO DE DESLIGAMENTO': TEXTO,
+    'DIAS_UTEIS': NUMERO,
+    'VALOR TOTAL VR': NUMERO,
+}
+
+
+def validar_formato(formato):
+    """Normaliza o nome do formato; ValueError se for desconhecido ou se faltar o pyarrow."""
+    formato = str(formato).strip().lower()
+    if formato not in EXTENSOES:
+        raise ValueError(f"Formato de intermediários inválido: {formato!r} (use {', '.join(EXTENSOES)})")
+    if formato != 'csv' and not _HAS_ARROW:
+        raise ValueError(f"O formato {formato!r} requer o pacote pyarrow")
+    return formato
+
+
+def nome_intermediario(nome_csv, formato):
+    """'base_unificada.csv' -> 'base_unificada.parquet' (ou .arrow) conforme o formato."""
+    return os.path.splitext(nome_csv)[0] + EXTENSOES[formato]
+
+
+def formato_do_arquivo(path):
+    """Formato de um intermediário pela extensão (qualquer outra extensão é tratada como CSV)."""
+    ext = os.path.splitext(path)[1].lower()
+    for formato, extensao in EXTENSOES.items():
+        if ext == extensao:
+            return formato
+    return 'csv'
+
+
+def _tipo_da_coluna(coluna, serie):
+    tipo = ESQUEMA.get(coluna)
+    if tipo is not None:
+        return tipo
+    if pd.api.types.is_bool_dtype(serie):
+        return None
+    if pd.api.types.is_numeric_dtype(serie):
+        return NUMERO
+    if pd.api.types.is_datetime64_any_dtype(serie):
+        return DATA
+    return TEXTO
+
+
+def _como_texto(serie):
+    """Valores preenchidos viram str; vazio ('') e nulos viram nulo, como na leitura do CSV."""
+    preenchido = serie.notna()
+    texto = serie.astype(object).where(~preenchido, serie.astype(str))
+    return texto.where(preenchido & (texto != ''))
+
+
+def _como_data(serie):
+    """
+    Datas como datetime64[ns]. Texto é interpretado valor a valor (dd/mm/aaaa ou ISO) e
+    números como data serial do Excel; o que não for data vira NaT.
+    """
+    if pd.api.types.is_datetime64_any_dtype(serie):
+        if getattr(serie.dt, 'tz', None) is not None:
+            serie = serie.dt.tz_localize(None)
+        return serie.astype('datetime64[ns]')
+    distintos = pd.Series(pd.unique(serie.dropna()), dtype=object)
+    numeros = pd.to_numeric(distintos, errors='coerce')
+    datas = pd.to_datetime(distintos.where(numeros.isna()), format='mixed', dayfirst=True, errors='coerce')
+    seriais = pd.to_datetime(numeros.astype('float64'), unit='D', origin='1899-12-30', errors='coerce')
+    datas = datas.where(numeros.isna(), seriais).astype('datetime64[ns]')
+    # Posição -1 (valor nulo) aponta para o NaT acrescentado no fim
+    valores = np.append(datas.to_numpy(dtype='datetime64[ns]'), np.datetime64('NaT', 'ns'))
+    return pd.Series(valores[pd.Index(distintos).get_indexer(serie)], index=serie.index)
+
+
+def aplicar_esquema(df):
+    """
+    Cópia de `df` com os tipos fixos dos intermediários: texto (str), data (datetime64[ns])
+    ou número (float64). Com o esquema fixo, MATRICULA é sempre texto e as datas não passam
+    por texto entre uma etapa e outra.
+    """
+    colunas = {}
+    for coluna in df.columns:
+        serie = df[coluna]
+        tipo = _tipo_da_coluna(coluna, serie)
+        if tipo == TEXTO:
+            serie = _como_texto(serie)
+        elif tipo == DATA:
+            serie = _como_data(serie)
+        elif tipo == NUMERO:
+            serie = pd.to_numeric(serie, errors='coerce').astype('float64')
+        colunas[coluna] = serie
+    return pd.DataFrame(colunas, index=df.index, columns=df.columns)
+
+
+_TIPOS_ARROW = {
+    TEXTO: lambda: pa.string(),
+    DATA: lambda: pa.timestamp('ns'),
+    NUMERO: lambda: pa.float64(),
+}
+
+
+def esquema_arrow(df):
+    """Schema Arrow fixo para `df` (já passado por `aplicar_esquema`)."""
+    campos = []
+    for coluna in df.columns:
+        tipo = _tipo_da_coluna(coluna, df[coluna])
+        if tipo is None:
+            tipo_arrow = pa.Schema.from_pandas(df[[coluna]], preserve_index=False).field(coluna).type
+        else:
+            tipo_arrow = _TIPOS_ARROW[tipo]()
+        campos.append(pa.field(str(coluna), tipo_arrow))
+    return pa.schema(campos)
+
+
+def _tabela(df, schema=None):
+    df = aplicar_esquema(df)
+    schema = schema if schema is not None else esquema_arrow(df)
+    return pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+
+
+def _para_pandas(tabela):
+    """Tabela Arrow -> DataFrame com NaN (e não None) nas colunas texto, como o read_csv."""
+    df = tabela.to_pandas()
+    for col in df.columns[df.dtypes == object]:
+        df[col] = df[col].where(df[col].notna(), float('nan'))
+    return df
+
+
+def gravar_intermediario(df, path):
+    """Grava um intermediário no formato indicado pela extensão de `path`."""
+    formato = formato_do_arquivo(path)
+    if formato == 'csv':
+        df.to_csv(path, index=False, sep=';', encoding='utf-8-sig')
+    elif formato == 'parquet':
+        pq.write_table(_tabela(df), path)
+    else:
+        # Sem compressão, para que a leitura possa mapear o arquivo em memória
+        feather.write_feather(_tabela(df), path, compression='uncompressed')
+
+
+def ler_intermediario(path):
+    """Lê um intermediário gravado por `gravar_intermediario` (formato pela extensão)."""
+    formato = formato_do_arquivo(path)
+    if formato == 'csv':
+        return pd.read_csv(path, sep=';', encoding='utf-8-sig')
+    if formato == 'parquet':
+        return _para_pandas(pq.read_table(path, memory_map=True))
+    with pa.memory_map(path) as origem:
+        return _para_pandas(pa.ipc.open_file(origem).read_all())
+
+
+def _combinar_tipos(atual, novo):
+    """Tipo de uma coluna que teve `atual` e `novo` em dois blocos, como numa leitura completa."""
+    if atual is None or atual == novo:
+        return novo
+    numericos = ('i', 'u', 'f')
+    if atual.kind in numericos and novo.kind in numericos:
+        return pd.api.types.pandas_dtype('float64')
+    return pd.api.types.pandas_dtype('object')
+
+
+def tipos_das_colunas_csv(path, chunksize, **opcoes):
+    """
+    Primeira passada por um CSV em blocos: {coluna: dtype} valendo para o arquivo todo,
+    para que cada bloco seja interpretado igual (sem isso uma coluna numérica em um
+    bloco e texto em outro sairia com tipos diferentes). `opcoes` vão para o read_csv
+    (padrão: ';' e UTF-8 com BOM).
+    """
+    opcoes = {'sep': ';', 'encoding': 'utf-8-sig', **opcoes}
+    tipos = {}
+    for bloco in pd.read_csv(path, chunksize=chunksize, **opcoes):
+        for coluna, tipo in bloco.dtypes.items():
+            tipos[coluna] = _combinar_tipos(tipos.get(coluna), tipo)
+    return tipos
+
+
+def ler_em_blocos(path, chunksize):
+    """
+    Gera o intermediário em blocos de até `chunksize` linhas (índice contínuo entre blocos).
+
+    No CSV os tipos das colunas são determinados antes, numa primeira passada pelo
+    arquivo, para que cada bloco seja interpretado como numa leitura completa (uma
+    coluna numérica em um bloco e vazia em outro continua float em todos). Parquet e
+    Arrow já guardam o esquema fixo.
+    """
+    formato = formato_do_arquivo(path)
+    if formato == 'csv':
+        dtypes = tipos_das_colunas_csv(path, chunksize)
+        yield from pd.read_csv(path, sep=';', encoding='utf-8-sig', chunksize=chunksize, dtype=dtypes)
+        return
+    inicio = 0
+    if formato == 'parquet':
+        lotes = pq.ParquetFile(path, memory_map=True).iter_batches(batch_size=chunksize)
+        for lote in lotes:
+            df = _para_pandas(pa.Table.from_batches([lote]))
+            df.index = pd.RangeIndex(inicio, inicio + len(df))
+            inicio += len(df)
+            yield df
+        return
+    with pa.memory_map(path) as origem:
+        for lote in pa.ipc.open_file(origem).read_all().to_batches(max_chunksize=chunksize):
+            df = _para_pandas(pa.Table.from_batches([lote]))
+            df.index = pd.RangeIndex(inicio, inicio + len(df))
+            inicio += len(df)
+            yield df
+
+
+class GravadorEmBlocos:
+    """
+    Intermediário (ou o RESULTADO em CSV) gravado bloco a bloco, no formato da extensão.
+
+    O arquivo é escrito com nome temporário e só aparece no destino em `concluir()`,
+    para que ninguém leia um resultado pela metade. No Parquet/Arrow o schema do
+    primeiro bloco (tipos fixos de `aplicar_esquema`) vale para todos os seguintes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.formato = formato_do_arquivo(path)
+        self._tmp = f"{path}.{os.getpid()}.tmp"
+        self._arquivo = open(self._tmp, 'w', encoding='utf-8-sig', newline='') if self.formato == 'csv' else None
+        self._escritor = None
+        self._schema = None
+        self._cabecalho = True
+
+    def escrever(self, df):
+        if self.formato == 'csv':
+            df.to_csv(self._arquivo, sep=';', index=False, header=self._cabecalho)
+            self._cabecalho = False
+            return
+        if self._escritor is None:
+            self._schema = esquema_arrow(aplicar_esquema(df))
+            if self.formato == 'parquet':
+                self._escritor = pq.ParquetWriter(self._tmp, self._schema)
+            else:
+                self._escritor = pa.ipc.new_file(self._tmp, self._schema)
+        self._escritor.write_table(_tabela(df, self._schema))
+
+    def _fechar(self):
+        if self._arquivo is not None:
+            self._arquivo.close()
+        if self._escritor is not None:
+            self._escritor.close()
+
+    def concluir(self):
+        self._fechar()
+        if self._escritor is None and self.formato != 'csv':
+            # Nenhum bloco: grava uma tabela vazia para o arquivo existir
+            if self.formato == 'parquet':
+                pq.write_table(pa.table({}), self._tmp)
+            else:
+                feather.write_feather(pa.table({}), self._tmp, compression='uncompressed')
+        os.replace(self._tmp, self.path)
+
+    def descartar(self):
+        try:
+            self._fechar()
+        finally:
+            if os.path.exists(self._tmp):
+                os.remove(self._tmp)
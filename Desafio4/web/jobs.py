@@ -0,0 +1,277 @@
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from workspace import Workspace
+
+logger = logging.getLogger("jobs")
+
+# Número de jobs processados em paralelo e por quanto tempo um job concluído é mantido
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '4'))
+JOB_RETENTION_HOURS = float(os.environ.get('JOB_RETENTION_HOURS', '24'))
+# Enquanto espera o sinal de conclusão, confere o workspace com esta frequência (resultado
+# produzido por outro processo do servidor, que não consegue sinalizar este)
+JOB_RESULT_CHECK_SECONDS = float(os.environ.get('JOB_RESULT_CHECK_SECONDS', '15'))
+
+# Situações possíveis de um job
+PENDENTE = 'pendente'
+EXECUTANDO = 'executando'
+CONCLUIDO = 'concluido'
+ERRO = 'erro'
+
+_JOB_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+def job_id_valido(job_id) -> bool:
+    """Aceita apenas ids gerados por `JobManager.criar` (evita caminhos arbitrários)."""
+    return bool(job_id) and bool(_JOB_ID_RE.match(str(job_id)))
+
+
+class Job:
+    """
+    Uma execução do fluxo upload -> n8n -> download.
+
+    Cada job tem seu próprio `Workspace` (`output/<job_id>/`), com as planilhas
+    recebidas em `files/` e todas as saídas na raiz do diretório. A situação do
+    job é gravada em `job.json` no workspace, para que qualquer processo consiga
+    consultá-la. `base_job_id` é o job de um envio anterior do mesmo conjunto de
+    dados: as planilhas não reenviadas vêm dele (`planilhas_herdadas`) e o cálculo
+    compara o resultado com o dele (ver calculation.executar_pipeline_calculo).
+    """
+
+    def __init__(self, job_id, workspace, competencia=None, base_job_id=None):
+        self.id = job_id
+        self.workspace = workspace
+        self.competencia = competencia
+        self.base_job_id = base_job_id
+        self.planilhas_herdadas = []
+        self.status = PENDENTE
+        self.message = None
+        self.result_path = None
+        self.criado_em = time.time()
+        self.iniciado_em = None
+        self.concluido_em = None
+        # Sinalizado por `JobManager.sinalizar_resultado` assim que o XLSX é gerado
+        self._resultado = threading.Event()
+        self._resultado_path = None
+
+    @property
+    def output_dir(self):
+        return self.workspace.output_dir
+
+    @property
+    def input_dir(self):
+        return self.workspace.input_dir
+
+    @property
+    def finalizado(self) -> bool:
+        return self.status in (CONCLUIDO, ERRO)
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'competencia': self.competencia,
+            'base_job_id': self.base_job_id,
+            'planilhas_herdadas': self.planilhas_herdadas,
+            'message': self.message,
+            'result': os.path.basename(self.result_path) if self.result_path else None,
+            'criado_em': self.criado_em,
+            'iniciado_em': self.iniciado_em,
+            'concluido_em': self.concluido_em,
+        }
+
+    def salvar(self):
+        dados = self.to_dict()
+        dados['result_path'] = self.result_path
+        self.workspace.salvar_json(self.workspace.job_file, dados)
+
+    @classmethod
+    def carregar(cls, workspace):
+        """Reconstrói um job a partir do job.json do workspace (ou None)."""
+        dados = workspace.ler_json(workspace.job_file)
+        if not dados:
+            return None
+        job = cls(dados['job_id'], workspace, dados.get('competencia'), dados.get('base_job_id'))
+        job.planilhas_herdadas = dados.get('planilhas_herdadas') or []
+        job.status = dados.get('status', PENDENTE)
+        job.message = dados.get('message')
+        job.result_path = dados.get('result_path')
+        job.criado_em = dados.get('criado_em')
+        job.iniciado_em = dados.get('iniciado_em')
+        job.concluido_em = dados.get('concluido_em')
+        return job
+
+
+class JobManager:
+    """
+    Registro de jobs e pool de workers em segundo plano.
+
+    `criar` reserva o workspace do job; `submeter` agenda `func(job)` no pool. O
+    valor retornado por `func` é o caminho do arquivo de resultado; exceções
+    marcam o job como 'erro' com a mensagem correspondente. `cache_dir` é o cache
+    de planilhas compartilhado pelos workspaces.
+
+    A conclusão é orientada a eventos: quem gera o resultado chama
+    `sinalizar_resultado`, o que libera `aguardar_resultado`, e toda mudança de
+    situação acorda os consumidores de `acompanhar` (usado pelo stream SSE).
+    """
+
+    def __init__(self, base_dir, cache_dir=None, max_workers=JOB_WORKERS, retention_hours=JOB_RETENTION_HOURS):
+        self.base_dir = base_dir
+        self.cache_dir = cache_dir
+        self.retention_hours = retention_hours
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._mudou = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+
+    def criar(self, competencia=None, base_job_id=None) -> Job:
+        self.limpar_antigos()
+        job_id = uuid.uuid4().hex
+        job = Job(job_id, Workspace.do_job(self.base_dir, job_id, self.cache_dir).criar(), competencia, base_job_id)
+        job.salvar()
+        with self._lock:
+            self._jobs[job_id] = job
+        return job
+
+    def workspace(self, job_id):
+        """Workspace de um job existente em disco (criado por qualquer processo), ou None."""
+        if not job_id_valido(job_id):
+            return None
+        workspace = Workspace.do_job(self.base_dir, job_id, self.cache_dir)
+        return workspace if workspace.existe() else None
+
+    def obter(self, job_id):
+        """Job em memória ou, se foi criado por outro processo, lido do job.json."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            return job
+        workspace = self.workspace(job_id)
+        return Job.carregar(workspace) if workspace else None
+
+    def _notificar(self, job: Job):
+        job.salvar()
+        with self._mudou:
+            self._mudou.notify_all()
+
+    def sinalizar_resultado(self, job_id, result_path):
+        """Informa que o resultado do job está pronto (chamado por quem gera o XLSX)."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            return False
+        job._resultado_path = result_path
+        job._resultado.set()
+        return True
+
+    def aguardar_resultado(self, job: Job, timeout, verificar=None):
+        """
+        Bloqueia até `sinalizar_resultado` ser chamado para o job ou o tempo acabar.
+
+        `verificar()` (opcional) procura o resultado no workspace; é chamada na entrada
+        e a cada JOB_RESULT_CHECK_SECONDS, só para cobrir resultados gerados por outro
+        processo. Retorna o caminho do resultado ou None em caso de timeout.
+        """
+        limite = time.monotonic() + timeout
+        while True:
+            if verificar is not None:
+                result_path = verificar()
+                if result_path:
+                    return result_path
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                return None
+            if job._resultado.wait(min(restante, JOB_RESULT_CHECK_SECONDS)):
+                return job._resultado_path
+
+    def acompanhar(self, job_id, keepalive=15.0):
+        """
+        Gera a situação do job (dict) a cada mudança, terminando quando ele finaliza.
+
+        Gera None após `keepalive` segundos sem mudança. Jobs de outro processo são
+        relidos do job.json periodicamente.
+        """
+        job = self.obter(job_id)
+        anterior = None
+        while job is not None:
+            estado = job.to_dict()
+            if estado != anterior:
+                anterior = estado
+                yield estado
+                if job.finalizado:
+                    return
+            else:
+                yield None
+            with self._lock:
+                local = self._jobs.get(job_id) is job
+            if local:
+                with self._mudou:
+                    self._mudou.wait_for(lambda: job.to_dict() != anterior, timeout=keepalive)
+            else:
+                time.sleep(min(keepalive, 2.0))
+                job = self.obter(job_id)
+
+    def submeter(self, job: Job, func):
+        self._executor.submit(self._executar, job, func)
+        return job
+
+    def _executar(self, job: Job, func):
+        job.status = EXECUTANDO
+        job.iniciado_em = time.time()
+        self._notificar(job)
+        logger.info(f"Job {job.id} iniciado")
+        try:
+            job.result_path = func(job)
+            job.status = CONCLUIDO
+            job.message = "Processamento concluído."
+        except Exception as e:
+            logger.error(f"Job {job.id} falhou: {e}", exc_info=True)
+            job.status = ERRO
+            job.message = str(e)
+        finally:
+            job.concluido_em = time.time()
+            self._notificar(job)
+            logger.info(f"Job {job.id} finalizado com status '{job.status}' em {job.concluido_em - job.iniciado_em:.1f}s")
+
+    def limpar_antigos(self):
+        """
+        Remove do registro (e do disco) jobs finalizados há mais de `retention_hours` e
+        apaga os diretórios de jobs deixados em `base_dir` por execuções anteriores do
+        servidor (ou por outros processos) sem atividade há mais de `retention_hours`.
+        """
+        limite = time.time() - self.retention_hours * 3600
+        with self._lock:
+            antigos = [j for j in self._jobs.values() if j.finalizado and j.concluido_em < limite]
+            for job in antigos:
+                del self._jobs[job.id]
+            em_memoria = set(self._jobs)
+        for job in antigos:
+            shutil.rmtree(job.output_dir, ignore_errors=True)
+        self._limpar_disco(limite, em_memoria)
+
+    def _limpar_disco(self, limite, em_memoria):
+        """Apaga `<base_dir>/<job_id>/` de jobs fora do registro cuja última alteração é anterior a `limite`."""
+        try:
+            entradas = [e for e in os.scandir(self.base_dir)
+                        if e.is_dir(follow_symlinks=False) and job_id_valido(e.name) and e.name not in em_memoria]
+        except OSError as e:
+            logger.warning(f"Falha ao listar jobs em {self.base_dir}: {e}")
+            return
+        for entrada in entradas:
+            workspace = Workspace.do_job(self.base_dir, entrada.name, self.cache_dir)
+            # As saídas ficam na raiz do workspace, as planilhas em files/ e a situação em job.json
+            caminhos = (entrada.path, workspace.input_dir, workspace.job_file)
+            try:
+                alterado_em = max(os.path.getmtime(c) for c in caminhos if os.path.exists(c))
+            except (OSError, ValueError):
+                continue
+            if alterado_em < limite:
+                logger.info(f"Removendo job antigo do disco: {entrada.name}")
+                shutil.rmtree(entrada.path, ignore_errors=True)
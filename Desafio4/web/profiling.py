@@ -0,0 +1,262 @@
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+logger = logging.getLogger("profiling")
+
+# Perfil de cada execução, acrescentado (uma linha JSON por execução) no diretório de saída
+PERFIL_FILENAME = 'pipeline_profile.jsonl'
+# Captura opcional do perfil das funções em cada execução: cprofile (.prof, para pstats/snakeviz)
+# ou pyinstrument (.html, requer o pacote pyinstrument); vazio desliga
+PIPELINE_PROFILE = os.environ.get('PIPELINE_PROFILE', '').strip().lower()
+CAPTURAS = ('cprofile', 'pyinstrument')
+
+_lock = threading.Lock()
+_metricas = {}  # etapa -> totais desde o início do processo
+_execucao = contextvars.ContextVar('execucao_perfil', default=None)
+_medicao = contextvars.ContextVar('medicao_perfil', default=None)
+_aviso_pyinstrument = False
+
+
+def _rss_pico_mb():
+    """Pico de memória residente do processo até agora (MB), ou None sem o módulo resource."""
+    if resource is None:
+        return None
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss vem em KB no Linux e em bytes no macOS
+    return pico / (1024 * 1024) if sys.platform == 'darwin' else pico / 1024
+
+
+def _rss_atual_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class Medicao:
+    """Medida de uma chamada de etapa: tempo de relógio, CPU da thread, memória e linhas."""
+
+    def __init__(self, etapa, linhas=None):
+        self.etapa = etapa
+        self.linhas = linhas
+        self.segundos = None
+        self.cpu_segundos = None
+        self.rss_pico_mb = None
+        self.rss_pico_aumento_mb = None
+
+    def iniciar(self):
+        self._pico_inicial = _rss_pico_mb()
+        self._cpu = time.thread_time()
+        self._inicio = time.perf_counter()
+
+    def concluir(self):
+        self.segundos = time.perf_counter() - self._inicio
+        self.cpu_segundos = time.thread_time() - self._cpu
+        self.rss_pico_mb = _rss_pico_mb()
+        if self.rss_pico_mb is not None:
+            self.rss_pico_aumento_mb = self.rss_pico_mb - self._pico_inicial
+
+
+def _acumular(totais, medicao):
+    atual = totais.setdefault(medicao.etapa, {
+        'chamadas': 0, 'segundos': 0.0, 'cpu_segundos': 0.0, 'linhas': 0,
+        'segundos_max': 0.0, 'rss_pico_mb': None, 'rss_pico_aumento_mb': 0.0,
+    })
+    atual['chamadas'] += 1
+    atual['segundos'] += medicao.segundos
+    atual['cpu_segundos'] += medicao.cpu_segundos
+    atual['linhas'] += medicao.linhas or 0
+    atual['segundos_max'] = max(atual['segundos_max'], medicao.segundos)
+    if medicao.rss_pico_mb is not None:
+        atual['rss_pico_mb'] = max(atual['rss_pico_mb'] or 0.0, medicao.rss_pico_mb)
+        atual['rss_pico_aumento_mb'] += medicao.rss_pico_aumento_mb
+
+
+@contextmanager
+def medir(etapa, linhas=None):
+    """
+    Mede o bloco como uma chamada de `etapa` e devolve a Medicao (defina `linhas` nela,
+    ou use `anotar_linhas`, quando o total só é conhecido no fim). A medida entra nas
+    métricas do processo (`metricas()`) e, dentro de uma `execucao`, no perfil da execução.
+
+    A CPU é a da thread que executa a etapa (conversões feitas em outros processos não
+    entram). O pico de memória é o do processo: `rss_pico_aumento_mb` é quanto a etapa
+    elevou o maior RSS visto até então.
+    """
+    medicao = Medicao(etapa, linhas)
+    token = _medicao.set(medicao)
+    medicao.iniciar()
+    try:
+        yield medicao
+    finally:
+        medicao.concluir()
+        _medicao.reset(token)
+        with _lock:
+            _acumular(_metricas, medicao)
+        execucao = _execucao.get()
+        if execucao is not None:
+            _acumular(execucao['etapas'], medicao)
+
+
+def anotar_linhas(linhas):
+    """Define as linhas processadas pela medição em andamento nesta thread (se houver)."""
+    medicao = _medicao.get()
+    if medicao is not None:
+        medicao.linhas = int(linhas)
+
+
+def _iniciar_captura(captura):
+    if captura == 'cprofile':
+        import cProfile
+        perfilador = cProfile.Profile()
+        perfilador.enable()
+        return perfilador
+    global _aviso_pyinstrument
+    try:
+        from pyinstrument import Profiler
+    except ImportError:
+        if not _aviso_pyinstrument:
+            logger.warning("PIPELINE_PROFILE=pyinstrument requer o pacote pyinstrument; captura desligada")
+            _aviso_pyinstrument = True
+        return None
+    perfilador = Profiler()
+    perfilador.start()
+    return perfilador
+
+
+def _salvar_captura(captura, perfilador, destino):
+    if captura == 'cprofile':
+        perfilador.disable()
+        perfilador.dump_stats(destino + '.prof')
+        return destino + '.prof'
+    perfilador.stop()
+    with open(destino + '.html', 'w', encoding='utf-8') as f:
+        f.write(perfilador.output_html())
+    return destino + '.html'
+
+
+@contextmanager
+def execucao(output_dir, nome):
+    """
+    Execução de uma etapa do fluxo (unificação, validação, cálculo, conversão) gravando
+    o perfil em `<output_dir>/pipeline_profile.jsonl`: uma linha JSON com o nome, o início,
+    a duração e os totais por etapa medida dentro dela. Execuções aninhadas fazem parte
+    da mais externa. Com PIPELINE_PROFILE, captura também o perfil das funções.
+    """
+    if _execucao.get() is not None or not output_dir:
+        yield
+        return
+    atual = {'nome': nome, 'etapas': {}}
+    token = _execucao.set(atual)
+    captura = PIPELINE_PROFILE if PIPELINE_PROFILE in CAPTURAS else None
+    perfilador = _iniciar_captura(captura) if captura else None
+    inicio = time.time()
+    inicio_relogio = time.perf_counter()
+    erro = None
+    try:
+        yield
+    except BaseException as e:
+        erro = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _execucao.reset(token)
+        registro = {
+            'nome': nome,
+            'inicio': inicio,
+            'segundos': time.perf_counter() - inicio_relogio,
+            'erro': erro,
+            'rss_mb': _rss_atual_mb(),
+            'rss_pico_mb': _rss_pico_mb(),
+            'etapas': atual['etapas'],
+        }
+        try:
+            if perfilador is not None:
+                destino = os.path.join(output_dir, f"profile_{nome}_{time.strftime('%Y%m%d-%H%M%S', time.localtime(inicio))}")
+                registro['captura'] = _salvar_captura(captura, perfilador, destino)
+            with _lock, open(os.path.join(output_dir, PERFIL_FILENAME), 'a', encoding='utf-8') as f:
+                f.write(json.dumps(registro, ensure_ascii=False) + '\n')
+        except OSError as e:
+            logger.warning(f"Não foi possível gravar o perfil da execução ({nome}): {e}")
+
+
+def _diretorio_da_chamada(argumentos):
+    """Diretório de saída de uma chamada: o do argumento `workspace` ou `output_dir`."""
+    workspace = argumentos.get('workspace')
+    if workspace is not None:
+        return getattr(workspace, 'output_dir', None)
+    return argumentos.get('output_dir')
+
+
+def medido(etapa, linhas=None):
+    """
+    Decorador: mede cada chamada da função como `etapa`. Se a chamada recebe um
+    `workspace` (ou `output_dir`) e não há execução em andamento, ela é a execução
+    (ver `execucao`). `linhas` é o nome de um argumento DataFrame cujo número de linhas
+    é anotado na medida.
+    """
+    def decorador(func):
+        assinatura = inspect.signature(func)
+
+        @functools.wraps(func)
+        def medida(*args, **kwargs):
+            argumentos = assinatura.bind(*args, **kwargs)
+            argumentos.apply_defaults()
+            argumentos = argumentos.arguments
+            total = len(argumentos[linhas]) if linhas and argumentos.get(linhas) is not None else None
+            with execucao(_diretorio_da_chamada(argumentos), etapa), medir(etapa, total):
+                return func(*args, **kwargs)
+        return medida
+    return decorador
+
+
+def metricas():
+    """Totais por etapa desde o início do processo e a memória atual do processo."""
+    with _lock:
+        etapas = {etapa: dict(totais) for etapa, totais in _metricas.items()}
+    return {
+        'processo': {'rss_mb': _rss_atual_mb(), 'rss_pico_mb': _rss_pico_mb(), 'pid': os.getpid()},
+        'etapas': etapas,
+    }
+
+
+def _rotulo(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+_METRICAS_PROMETHEUS = [
+    ('vr_etapa_chamadas_total', 'counter', 'chamadas', 'Chamadas da etapa'),
+    ('vr_etapa_segundos_total', 'counter', 'segundos', 'Tempo de relógio da etapa (s)'),
+    ('vr_etapa_cpu_segundos_total', 'counter', 'cpu_segundos', 'Tempo de CPU da etapa (s)'),
+    ('vr_etapa_linhas_total', 'counter', 'linhas', 'Linhas processadas pela etapa'),
+    ('vr_etapa_segundos_max', 'gauge', 'segundos_max', 'Chamada mais lenta da etapa (s)'),
+]
+
+
+def metricas_prometheus():
+    """`metricas()` no formato texto do Prometheus."""
+    dados = metricas()
+    linhas = []
+    for nome, tipo, campo, ajuda in _METRICAS_PROMETHEUS:
+        linhas += [f"# HELP {nome} {ajuda}", f"# TYPE {nome} {tipo}"]
+        for etapa, totais in dados['etapas'].items():
+            linhas.append(f'{nome}{{etapa="{_rotulo(etapa)}"}} {totais[campo]}')
+    for nome, campo, ajuda in [('vr_processo_rss_bytes', 'rss_mb', 'Memória residente do processo'),
+                               ('vr_processo_rss_pico_bytes', 'rss_pico_mb', 'Pico de memória residente do processo')]:
+        valor = dados['processo'][campo]
+        if valor is not None:
+            linhas += [f"# HELP {nome} {ajuda}", f"# TYPE {nome} gauge", f"{nome} {int(valor * 1024 * 1024)}"]
+    return '\n'.join(linhas) + '\n'
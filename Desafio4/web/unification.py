@@ -0,0 +1,81 @@
+import logging
+
+import pandas as pd
+
+logger = logging.getLogger("unification")
+
+
+def _unificar_em_sequencia(fontes, chave):
+    """
+    Junção externa encadeada (pd.merge), usada quando alguma fonte repete a chave:
+    nesse caso cada combinação de linhas com a mesma chave gera uma linha, como sempre
+    aconteceu na unificação.
+    """
+    unificado = fontes[0][1]
+    for _nome, df in fontes[1:]:
+        unificado = pd.merge(unificado, df, on=chave, how='outer', suffixes=('', '_dup'))
+        for dup_col in [c for c in unificado.columns if c.endswith('_dup')]:
+            unificado[dup_col[:-4]] = unificado[dup_col[:-4]].combine_first(unificado[dup_col])
+            unificado = unificado.drop(columns=[dup_col])
+    return unificado
+
+
+def unificar_por_chave(fontes, chave='MATRICULA'):
+    """
+    Unifica várias planilhas numa junção externa única pela `chave`.
+
+    `fontes` é uma lista de (nome, DataFrame) em ordem de prioridade: para cada
+    campo presente em mais de uma fonte vale o primeiro valor não vazio. Cada fonte
+    é indexada uma vez pela chave e alinhada ao conjunto ordenado de todas as chaves
+    (o mesmo resultado das junções externas encadeadas, sem copiar a base inteira a
+    cada planilha).
+
+    Retorna (DataFrame, estatísticas), com estatísticas por fonte:
+    'linhas', 'chaves' (distintas), 'duplicadas' (linhas que repetem uma chave da
+    própria fonte), 'novas' (chaves que não estavam em fontes anteriores), 'colisoes'
+    (chaves que já estavam em fontes anteriores) e 'valores_ignorados' (valores
+    preenchidos descartados porque uma fonte anterior já tinha valor no campo).
+    """
+    estatisticas = {}
+    chaves = None
+    for nome, df in fontes:
+        chaves_fonte = pd.Index(df[chave])
+        distintas = chaves_fonte.unique()
+        ja_vistas = int(distintas.isin(chaves).sum()) if chaves is not None else 0
+        estatisticas[nome] = {
+            'linhas': len(df),
+            'chaves': len(distintas),
+            'duplicadas': len(chaves_fonte) - len(distintas),
+            'novas': len(distintas) - ja_vistas,
+            'colisoes': ja_vistas,
+            'valores_ignorados': 0,
+        }
+        chaves = distintas if chaves is None else chaves.union(distintas)
+
+    if any(e['duplicadas'] for e in estatisticas.values()):
+        logger.warning("Chave '%s' repetida dentro de uma mesma planilha; usando junções encadeadas.", chave)
+        return _unificar_em_sequencia(fontes, chave), estatisticas
+
+    tipos = {df[chave].dtype for _nome, df in fontes}
+    if len(tipos) > 1 or chaves.hasnans or any(df.empty for _nome, df in fontes):
+        # Tipos diferentes, chaves vazias ou fontes vazias: só a coluna da chave passa
+        # pela junção do pandas, que define a ordem e o tipo da chave no resultado
+        uniao = fontes[0][1][[chave]]
+        for _nome, df in fontes[1:]:
+            uniao = pd.merge(uniao, df[[chave]], on=chave, how='outer')
+        chaves = pd.Index(uniao[chave])
+
+    campos = {}
+    for nome, df in fontes:
+        alinhado = df.set_index(chave).reindex(chaves)
+        for campo in alinhado.columns:
+            if campo not in campos:
+                campos[campo] = alinhado[campo]
+                continue
+            atual = campos[campo]
+            estatisticas[nome]['valores_ignorados'] += int((atual.notna() & alinhado[campo].notna()).sum())
+            campos[campo] = atual.combine_first(alinhado[campo])
+
+    unificado = pd.DataFrame(campos, index=chaves)
+    unificado.index.name = chave
+    return unificado.reset_index(), estatisticas
@@ -1,67 +1,326 @@
+import json
 import os
+import re
+import time
+
+import numpy as np
 import pandas as pd
 from flask import current_app as app
 
-def run_validation(INPUT_DIR, OUTPUT_DIR, base_csv_path=None):
+from excel_cache import read_excel_cached
+from incremental import INCREMENTAL_RECALCULATION, CacheDeEtapas, impressao_digital
+from intermediates import gravar_intermediario, ler_intermediario
+from profiling import anotar_linhas, medido
+
+# Arquivo JSON opcional com regras de exclusão específicas do cliente (ver README)
+VALIDATION_RULES_FILE = os.environ.get('VALIDATION_RULES_FILE', '')
+
+# Regras de exclusão declaradas como dados. Tipos:
+# - 'palavra': alguma das `palavras` aparece no texto (minúsculo) da `coluna`
+# - 'matricula': MATRICULA consta na `coluna_planilha` da `planilha` de entrada
+# - 'data': a data da `coluna` está entre `de` e `ate` (inclusive; qualquer um pode faltar)
+# `coluna` aceita os nomes lógicos 'cargo' e 'situacao' ou o nome exato de uma coluna.
+REGRAS_EXCLUSAO = [
+    {'nome': 'cargo', 'tipo': 'palavra', 'coluna': 'cargo',
+     'palavras': ['diretor', 'estagiário', 'estagiario', 'aprendiz'],
+     'descricao': 'Removendo por cargo'},
+    {'nome': 'afastamento', 'tipo': 'palavra', 'coluna': 'situacao',
+     'palavras': ['afast', 'licen'],
+     'descricao': 'Removendo por afastamento/licença'},
+    {'nome': 'exterior', 'tipo': 'palavra', 'coluna': 'cargo',
+     'palavras': ['exterior'],
+     'descricao': 'Removendo por atuação no exterior'},
+    {'nome': 'aprendiz_planilha', 'tipo': 'matricula', 'planilha': 'APRENDIZ.xlsx',
+     'coluna_planilha': 'MATRICULA',
+     'descricao': 'Removendo aprendizes (APRENDIZ.xlsx)'},
+    {'nome': 'estagio_planilha', 'tipo': 'matricula', 'planilha': 'ESTÁGIO.xlsx',
+     'coluna_planilha': 'MATRICULA',
+     'descricao': 'Removendo estagiários (ESTÁGIO.xlsx)'},
+    {'nome': 'exterior_planilha', 'tipo': 'matricula', 'planilha': 'EXTERIOR.xlsx',
+     'coluna_planilha': 'Cadastro',
+     'descricao': 'Removendo profissionais no exterior (EXTERIOR.xlsx)'},
+]
+
+_CAMPOS_OBRIGATORIOS = {
+    'palavra': ('coluna', 'palavras'),
+    'matricula': ('planilha', 'coluna_planilha'),
+    'data': ('coluna',),
+}
+
+
+def carregar_regras(path=None):
+    """
+    Regras padrão combinadas com as do arquivo JSON do cliente, se houver.
+
+    O arquivo contém uma lista de regras no mesmo formato de REGRAS_EXCLUSAO. Uma
+    regra com o mesmo `nome` de uma padrão a substitui; `"ativa": false` a desliga.
+    """
+    path = VALIDATION_RULES_FILE if path is None else path
+    regras = {regra['nome']: regra for regra in REGRAS_EXCLUSAO}
+    if path:
+        with open(path, 'r', encoding='utf-8') as f:
+            extras = json.load(f)
+        if not isinstance(extras, list):
+            raise ValueError(f"{path}: esperada uma lista de regras")
+        for regra in extras:
+            regras[regra.get('nome')] = regra
+    return list(regras.values())
+
+
+def _validar_regra(regra):
+    if not isinstance(regra, dict) or not regra.get('nome'):
+        raise ValueError(f"Regra de exclusão sem nome: {regra!r}")
+    tipo = regra.get('tipo')
+    if tipo not in _CAMPOS_OBRIGATORIOS:
+        raise ValueError(f"Regra '{regra['nome']}': tipo desconhecido {tipo!r}")
+    faltando = [campo for campo in _CAMPOS_OBRIGATORIOS[tipo] if not regra.get(campo)]
+    if faltando:
+        raise ValueError(f"Regra '{regra['nome']}': campos obrigatórios ausentes: {', '.join(faltando)}")
+
+
+def _chave_matricula(valor):
+    """Matrícula como texto comparável entre planilhas (34383, 34383.0 e ' 34383' coincidem)."""
+    texto = str(valor).strip()
+    try:
+        numero = float(texto)
+    except ValueError:
+        return texto
+    return str(int(numero)) if numero.is_integer() else texto
+
+
+def _matriculas_da_planilha(workspace, planilha, coluna):
+    """Conjunto de matrículas de uma planilha de entrada, ou None se ela não foi enviada."""
+    path = workspace.entrada(planilha)
+    if not os.path.exists(path):
+        return None
+    df = read_excel_cached(path, workspace.cache_dir)
+    df.columns = df.columns.astype(str).str.strip()
+    if coluna not in df.columns:
+        raise ValueError(f"{planilha}: coluna '{coluna}' não encontrada")
+    return {_chave_matricula(v) for v in df[coluna].dropna()}
+
+
+def compilar_regras(regras, workspace):
+    """
+    Transforma as regras declaradas em predicados vetorizados.
+
+    Cada regra compilada é (nome, tipo da chave, coluna, predicado, descrição), onde o
+    predicado recebe os valores distintos da coluna já normalizados (texto minúsculo,
+    matrícula ou data) e devolve um array booleano. Regras inativas são descartadas;
+    regras inválidas geram ValueError. Regras de matrícula cuja planilha não foi
+    enviada ficam com predicado None (não removem ninguém).
+    """
+    compiladas = []
+    for regra in regras:
+        _validar_regra(regra)
+        if not regra.get('ativa', True):
+            continue
+        tipo = regra['tipo']
+        descricao = regra.get('descricao') or f"Removendo pela regra {regra['nome']}"
+        if tipo == 'palavra':
+            padrao = '|'.join(re.escape(str(p).lower()) for p in regra['palavras'])
+            predicado = lambda valores, padrao=padrao: valores.str.contains(padrao, regex=True)
+            compiladas.append((regra['nome'], 'texto', regra['coluna'], predicado, descricao))
+        elif tipo == 'matricula':
+            matriculas = _matriculas_da_planilha(workspace, regra['planilha'], regra['coluna_planilha'])
+            predicado = None if matriculas is None else (lambda valores, m=matriculas: valores.isin(m))
+            compiladas.append((regra['nome'], 'matricula', regra.get('coluna', 'MATRICULA'), predicado, descricao))
+        else:
+            de = pd.Timestamp(regra['de']) if regra.get('de') else None
+            ate = pd.Timestamp(regra['ate']) if regra.get('ate') else None
+
+            def predicado(valores, de=de, ate=ate):
+                dentro = valores.notna()
+                if de is not None:
+                    dentro &= valores >= de
+                if ate is not None:
+                    dentro &= valores <= ate
+                return dentro
+            compiladas.append((regra['nome'], 'data', regra['coluna'], predicado, descricao))
+    return compiladas
+
+
+def _localizar_coluna(df, coluna):
+    """Resolve os nomes lógicos 'cargo' e 'situacao'; demais nomes devem existir no DataFrame."""
+    if coluna == 'cargo':
+        return 'Cargo' if 'Cargo' in df.columns else None
+    if coluna == 'situacao':
+        return next((col for col in df.columns if 'situacao' in col.lower()), None)
+    return coluna if coluna in df.columns else None
+
+
+def _normalizar_texto(serie):
     """
-    Realiza validações na base_unificada.csv e remove profissionais conforme regras:
+    Texto em minúsculas ('' para ausentes e valores não textuais) como categórico.
+
+    A conversão é feita uma vez por valor distinto; as regras são avaliadas sobre as
+    categorias e só depois projetadas nas linhas pelos códigos.
+    """
+    codigos, valores = pd.factorize(serie)
+    # O '' acrescentado ao final atende os ausentes (código -1 aponta para ele)
+    minusculas = np.array([v.lower() if isinstance(v, str) else '' for v in valores] + [''], dtype=object)
+    categorias, recodificados = np.unique(minusculas, return_inverse=True)
+    return pd.Categorical.from_codes(recodificados[codigos], categories=categorias)
+
+
+def _valores_distintos(serie, tipo):
+    """
+    (códigos por linha, valores distintos normalizados) de uma coluna.
+
+    Código -1 indica valor ausente, que nunca é selecionado — exceto no texto, em que
+    ausentes viram '' como qualquer outro valor.
+    """
+    if tipo == 'texto':
+        texto = _normalizar_texto(serie)
+        return texto.codes, pd.Index(texto.categories)
+    codigos, valores = pd.factorize(serie)
+    if tipo == 'matricula':
+        return codigos, pd.Index([_chave_matricula(v) for v in valores], dtype=object)
+    return codigos, pd.Index(_converter_datas(pd.Series(valores, dtype=serie.dtype)))
+
+
+def aplicar_regras(df, compiladas):
+    """
+    Avalia todas as regras compiladas numa única passada.
+
+    Cada coluna usada pelas regras é normalizada uma vez e os predicados rodam sobre
+    os valores distintos; as contagens por regra saem da frequência desses valores e
+    a máscara final é montada com um único acesso por coluna. Retorna (máscara,
+    {regra: {'removidos', 'tempo_ms'}}); as contagens não são exclusivas (uma linha
+    pode ser removida por mais de uma regra).
+    """
+    colunas = {}
+    por_coluna = {}
+    resultado = {}
+    for nome, tipo, coluna, predicado, _descricao in compiladas:
+        inicio = time.perf_counter()
+        removidos = 0
+        nome_coluna = _localizar_coluna(df, coluna)
+        if nome_coluna is not None and predicado is not None:
+            chave = (tipo, nome_coluna)
+            if chave not in colunas:
+                codigos, valores = _valores_distintos(df[nome_coluna], tipo)
+                frequencias = np.bincount(codigos[codigos >= 0], minlength=len(valores))
+                colunas[chave] = (codigos, valores, frequencias)
+            codigos, valores, frequencias = colunas[chave]
+            selecionados = np.asarray(predicado(valores), dtype=bool)
+            removidos = int(frequencias[selecionados].sum())
+            por_coluna[chave] = por_coluna[chave] | selecionados if chave in por_coluna else selecionados
+        resultado[nome] = {'removidos': removidos, 'tempo_ms': round((time.perf_counter() - inicio) * 1000, 3)}
+
+    excluir = np.zeros(len(df), dtype=bool)
+    for chave, selecionados in por_coluna.items():
+        # Posição extra (False) para o código -1 dos ausentes
+        excluir |= np.append(selecionados, False)[colunas[chave][0]]
+    return excluir, resultado
+
+
+def _converter_datas(serie):
+    """
+    Converte uma coluna de datas tentando ISO, depois dia/mês/ano e por fim número
+    serial do Excel.
+
+    As tentativas rodam sobre os valores distintos da coluna (a inferência de formato
+    do pandas acontece uma vez por coluna) e o resultado é projetado de volta nas linhas.
+    Colunas que já são datas (intermediários Parquet/Arrow) são mantidas.
+    """
+    if pd.api.types.is_datetime64_any_dtype(serie):
+        return serie
+    valores = pd.Series(pd.unique(serie), dtype=serie.dtype)
+    # 1) Tentativa com formato ISO
+    parsed = pd.to_datetime(valores, errors='coerce', format='%Y-%m-%d')
+    # 2) Para NaT, tenta com dayfirst
+    mask_nat = parsed.isna()
+    if mask_nat.any():
+        parsed2 = pd.to_datetime(valores[mask_nat], errors='coerce', dayfirst=True)
+        parsed.loc[mask_nat] = parsed2
+    # 3) Para ainda NaT, tenta números seriais do Excel
+    mask_nat2 = parsed.isna()
+    if mask_nat2.any():
+        nums = pd.to_numeric(valores[mask_nat2], errors='coerce')
+        parsed3 = pd.to_datetime(nums, unit='d', origin='1899-12-30', errors='coerce')
+        parsed.loc[mask_nat2] = parsed3
+    posicoes = pd.Index(valores).get_indexer(serie)
+    return pd.Series(parsed.array.take(posicoes), index=serie.index, name=serie.name)
+
+@medido('validacao')
+def run_validation(workspace, base_csv_path=None):
+    """
+    Realiza validações na base_unificada.csv e remove profissionais conforme regras
+    (REGRAS_EXCLUSAO, mais as do arquivo VALIDATION_RULES_FILE, se configurado):
     - Cargos: diretores, estagiários, aprendizes
     - Situação: afastados em geral (ex: licença maternidade)
     - Profissionais que atuam no exterior
+    - Matrículas listadas em APRENDIZ.xlsx, ESTÁGIO.xlsx e EXTERIOR.xlsx
     - Trata datas inconsistentes ou quebradas
     - Preenche campos faltantes
     - Corrige férias mal preenchidas
     - Aplica corretamente feriados estaduais e municipais
 
-    Agora aceita um caminho opcional `base_csv_path` que, se fornecido, será usado
-    como arquivo base a ser validado (ao invés de procurar em OUTPUT_DIR).
+    `workspace` (ver workspace.Workspace) indica onde estão as planilhas de entrada,
+    o cache e onde gravar o resultado. Aceita um caminho opcional `base_csv_path` que,
+    se fornecido, será usado como arquivo base a ser validado (ao invés do
+    base_unificada.csv do workspace).
 
     Retorna um dict: { 'success': bool, 'message': str, 'output_path': str or None }
+    e, em caso de sucesso, 'regras': { nome: { 'removidos': int, 'tempo_ms': float } }.
     """
     try:
         # Carrega a base unificada
         if base_csv_path:
             base_path = base_csv_path
         else:
-            base_path = os.path.join(OUTPUT_DIR, 'base_unificada.csv')
-        df = pd.read_csv(base_path, sep=';', encoding='utf-8-sig')
+            base_path = workspace.base_unificada
+        valid_output = workspace.base_validada
+
+        # Reaproveita a validação anterior se a base, as regras e as planilhas usadas não mudaram
+        regras_declaradas = carregar_regras()
+        etapas = CacheDeEtapas(workspace) if INCREMENTAL_RECALCULATION else None
+        if etapas:
+            planilhas = {r['planilha'] for r in regras_declaradas if r.get('tipo') == 'matricula' and r.get('planilha')}
+            planilhas.add('Base dias uteis.xlsx')
+            dependencias = {
+                'base': impressao_digital(base_path),
+                'regras': regras_declaradas,
+                'planilhas': {p: impressao_digital(workspace.entrada(p)) for p in sorted(planilhas)},
+                'formato': workspace.formato,
+            }
+            chave = etapas.chave('validacao', **dependencias)
+            anterior = etapas.obter_dados(chave)
+            if anterior is not None and etapas.obter_arquivos(chave, [valid_output]):
+                etapas.registrar('validacao', chave, dependencias, reaproveitada=True)
+                app.logger.info("Base e regras sem alterações; validação anterior reaproveitada.")
+                return {
+                    'success': True,
+                    'message': f"Validação concluída (sem alterações). Arquivo salvo em: {valid_output} (Total removidos: {anterior['total_removidos']})",
+                    'output_path': valid_output,
+                    'regras': anterior['regras'],
+                }
+
+        df = ler_intermediario(base_path)
+        anotar_linhas(df.shape[0])
         app.logger.info(f"Base carregada: {df.shape[0]} linhas.")
 
         # Carrega as bases auxiliares, se existirem
-        sindicato_path = os.path.join(INPUT_DIR, 'Base sindicato x valor.xlsx')
-        dias_uteis_path = os.path.join(INPUT_DIR, 'Base dias uteis.xlsx')
-        df_sindicato = pd.read_excel(sindicato_path) if os.path.exists(sindicato_path) else pd.DataFrame()
-        df_dias_uteis = pd.read_excel(dias_uteis_path) if os.path.exists(dias_uteis_path) else pd.DataFrame()
+        sindicato_path = workspace.entrada('Base sindicato x valor.xlsx')
+        dias_uteis_path = workspace.entrada('Base dias uteis.xlsx')
+        df_sindicato = read_excel_cached(sindicato_path, workspace.cache_dir) if os.path.exists(sindicato_path) else pd.DataFrame()
+        df_dias_uteis = read_excel_cached(dias_uteis_path, workspace.cache_dir) if os.path.exists(dias_uteis_path) else pd.DataFrame()
 
         # Normaliza colunas para evitar problemas de maiúsculas/minúsculas
         df.columns = df.columns.str.strip()
-        if 'Cargo' in df.columns:
-            cargos = df['Cargo'].str.lower().fillna('')
-        else:
-            cargos = pd.Series([''] * len(df))
-
-        # Critérios de exclusão
-        cargos_excluir = ['diretor', 'estagiário', 'estagiario', 'aprendiz']
-        mask_cargo = cargos.str.contains('|'.join(cargos_excluir), na=False)
-        app.logger.info(f"Removendo por cargo: {mask_cargo.sum()} linhas.")
-
-        # Situação de afastamento
-        situacao_col = next((col for col in df.columns if 'situacao' in col.lower()), None)
-        if situacao_col:
-            afastados = df[situacao_col].str.lower().fillna('').str.contains('afast', na=False) | \
-                        df[situacao_col].str.lower().fillna('').str.contains('licen', na=False)
-            app.logger.info(f"Removendo por afastamento/licença: {afastados.sum()} linhas.")
-        else:
-            afastados = pd.Series([False] * len(df))
+        if _localizar_coluna(df, 'situacao') is None:
             app.logger.info("Coluna de situação não encontrada.")
 
-        # Profissionais no exterior
-        exterior_mask = cargos.str.contains('exterior', na=False)
-        app.logger.info(f"Removendo por atuação no exterior: {exterior_mask.sum()} linhas.")
-
-        # Combina todas as máscaras de exclusão
-        excluir = mask_cargo | afastados | exterior_mask
-        total_removidos = excluir.sum()
+        # Critérios de exclusão (REGRAS_EXCLUSAO e regras do cliente), avaliados numa única passada
+        compiladas = compilar_regras(regras_declaradas, workspace)
+        excluir, regras = aplicar_regras(df, compiladas)
+        for nome, _tipo, _coluna, predicado, descricao in compiladas:
+            if predicado is None:
+                app.logger.info(f"{descricao}: planilha não enviada, regra ignorada.")
+            else:
+                app.logger.info(f"{descricao}: {regras[nome]['removidos']} linhas ({regras[nome]['tempo_ms']:.2f} ms).")
+        total_removidos = int(excluir.sum())
         app.logger.info(f"Total de linhas removidas: {total_removidos}")
 
         # Para log detalhado, mostra as matrículas removidas
@@ -77,22 +336,10 @@ def run_validation(INPUT_DIR, OUTPUT_DIR, base_csv_path=None):
         # Considera colunas que contenham 'data', 'admiss' ou sejam exatamente 'Admissão'
         date_cols = [col for col in df_validado.columns if ('data' in col.lower()) or ('admiss' in col.lower()) or (col.strip().lower() == 'admissão')]
         for col in date_cols:
-            # 1) Tentativa com formato ISO
-            parsed = pd.to_datetime(df_validado[col], errors='coerce', format='%Y-%m-%d')
-            # 2) Para NaT, tenta com dayfirst
-            mask_nat = parsed.isna()
-            if mask_nat.any():
-                parsed2 = pd.to_datetime(df_validado.loc[mask_nat, col], errors='coerce', dayfirst=True)
-                parsed.loc[mask_nat] = parsed2
-            # 3) Para ainda NaT, tenta números seriais do Excel
-            mask_nat2 = parsed.isna()
-            if mask_nat2.any():
-                nums = pd.to_numeric(df_validado.loc[mask_nat2, col], errors='coerce')
-                parsed3 = pd.to_datetime(nums, unit='d', origin='1899-12-30', errors='coerce')
-                parsed.loc[mask_nat2] = parsed3
-            df_validado[col] = parsed
+            inicio = time.perf_counter()
+            df_validado[col] = _converter_datas(df_validado[col])
             n_invalid = df_validado[col].isna().sum()
-            app.logger.info(f"Coluna {col}: {n_invalid} datas inválidas convertidas para NaT após tentativas múltiplas.")
+            app.logger.info(f"Coluna {col}: {n_invalid} datas inválidas convertidas para NaT após tentativas múltiplas ({(time.perf_counter() - inicio) * 1000:.2f} ms).")
 
         # --- Preenchimento de campos faltantes ---
         missing_cols = df_validado.columns[df_validado.isnull().any()].tolist()
@@ -127,26 +374,22 @@ def run_validation(INPUT_DIR, OUTPUT_DIR, base_csv_path=None):
             else:
                 app.logger.warning("Colunas 'UF' e/ou 'Município' não encontradas para aplicar feriados.")
 
-        # Antes de salvar, formata 'Admissão' como dd/mm/aaaa, se existir
-        if 'Admissão' in df_validado.columns:
-            try:
-                adm = pd.to_datetime(df_validado['Admissão'], errors='coerce', dayfirst=True)
-                # tenta serial para os que restarem NaT
-                mask_nat = adm.isna()
-                if mask_nat.any():
-                    nums = pd.to_numeric(df_validado.loc[mask_nat, 'Admissão'], errors='coerce')
-                    adm_serial = pd.to_datetime(nums, unit='d', origin='1899-12-30', errors='coerce')
-                    adm.loc[mask_nat] = adm_serial
+        # Antes de salvar, formata 'Admissão' como dd/mm/aaaa, se existir. A coluna já foi
+        # convertida na etapa de datas; com alguma data ausente ela é mantida como está
+        # (saída em ISO), como sempre aconteceu com a segunda conversão que havia aqui.
+        if 'Admissão' in df_validado.columns and pd.api.types.is_datetime64_any_dtype(df_validado['Admissão']):
+            adm = df_validado['Admissão']
+            if not adm.isna().any():
                 df_validado['Admissão'] = adm.dt.strftime('%d/%m/%Y')
-                df_validado['Admissão'] = df_validado['Admissão'].where(~adm.isna(), '')
-            except Exception:
-                pass
 
         # Salva resultado validado
-        valid_output = os.path.join(OUTPUT_DIR, 'base_unificada_validada.csv')
-        df_validado.to_csv(valid_output, index=False, sep=';', encoding='utf-8-sig')
+        gravar_intermediario(df_validado, valid_output)
+        if etapas:
+            etapas.guardar_arquivos(chave, [valid_output])
+            etapas.guardar_dados(chave, {'regras': regras, 'total_removidos': total_removidos})
+            etapas.registrar('validacao', chave, dependencias, reaproveitada=False)
 
-        return { 'success': True, 'message': f"Validação concluída. Arquivo salvo em: {valid_output} (Total removidos: {total_removidos})", 'output_path': valid_output }
+        return { 'success': True, 'message': f"Validação concluída. Arquivo salvo em: {valid_output} (Total removidos: {total_removidos})", 'output_path': valid_output, 'regras': regras }
     except Exception as e:
         app.logger.error(f"Erro na validação: {e}", exc_info=True)
         return { 'success': False, 'message': f"Erro na validação: {e}", 'output_path': None }
\ No newline at end of file
@@ -0,0 +1,110 @@
+import json
+import os
+import threading
+
+from excel_cache import cache_dir_for
+from intermediates import INTERMEDIATE_FORMAT, nome_intermediario, validar_formato
+
+BASE_FILENAME = 'base_unificada.csv'
+BASE_VALIDADA_FILENAME = 'base_unificada_validada.csv'
+COMPETENCIA_FILENAME = 'competencia.txt'
+JOB_FILENAME = 'job.json'
+
+
+class Workspace:
+    """
+    Diretórios e arquivos de uma execução do fluxo de VR.
+
+    Reúne o diretório das planilhas de entrada, o diretório de saída (onde ficam
+    base_unificada*, competencia.txt, RESULTADO_VR_MENSAL_*.csv e o XLSX) e o
+    cache de planilhas. Cada etapa recebe o workspace explicitamente, de modo que
+    execuções diferentes — inclusive em processos diferentes — nunca compartilham
+    arquivos de saída. O cache é endereçado por conteúdo e pode ser compartilhado.
+    `formato` é o formato dos intermediários (csv, parquet ou arrow; padrão
+    INTERMEDIATE_FORMAT).
+    """
+
+    def __init__(self, output_dir, input_dir=None, cache_dir=None, formato=None):
+        self.output_dir = output_dir
+        self.input_dir = input_dir or os.path.join(output_dir, 'files')
+        self.cache_dir = cache_dir or cache_dir_for(output_dir)
+        self.formato = validar_formato(formato or INTERMEDIATE_FORMAT)
+
+    @classmethod
+    def do_job(cls, base_dir, job_id, cache_dir=None):
+        """Workspace isolado de um job: `<base_dir>/<job_id>/` com as planilhas em `files/`."""
+        return cls(os.path.join(base_dir, job_id), cache_dir=cache_dir)
+
+    def __repr__(self):
+        return f"Workspace(output_dir={self.output_dir!r}, input_dir={self.input_dir!r})"
+
+    def criar(self):
+        os.makedirs(self.input_dir, exist_ok=True)
+        os.makedirs(self.output_dir, exist_ok=True)
+        return self
+
+    def existe(self) -> bool:
+        return os.path.isdir(self.output_dir)
+
+    def caminho(self, filename):
+        """Caminho de um arquivo de saída deste workspace."""
+        return os.path.join(self.output_dir, filename)
+
+    def entrada(self, filename):
+        """Caminho de uma planilha de entrada deste workspace."""
+        return os.path.join(self.input_dir, filename)
+
+    def intermediario(self, nome_csv):
+        """Caminho de um arquivo intermediário, com a extensão do formato do workspace."""
+        return self.caminho(nome_intermediario(nome_csv, self.formato))
+
+    @property
+    def base_unificada(self):
+        return self.intermediario(BASE_FILENAME)
+
+    @property
+    def base_validada(self):
+        return self.intermediario(BASE_VALIDADA_FILENAME)
+
+    @property
+    def job_file(self):
+        return self.caminho(JOB_FILENAME)
+
+    def base_para_calculo(self):
+        """base_unificada_validada se existir; senão base_unificada; senão None."""
+        for path in (self.base_validada, self.base_unificada):
+            if os.path.exists(path):
+                return path
+        return None
+
+    def salvar_competencia(self, competencia):
+        with open(self.caminho(COMPETENCIA_FILENAME), 'w', encoding='utf-8') as cf:
+            cf.write(competencia)
+
+    def ler_competencia(self):
+        """Competência salva no upload (texto MM/YYYY) ou None."""
+        path = self.caminho(COMPETENCIA_FILENAME)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as cf:
+            return cf.read().strip() or None
+
+    def workspace_base(self):
+        """Workspace do job anterior em que este se baseou (`base_job_id` do job.json), ou None."""
+        base_job_id = (self.ler_json(self.job_file) or {}).get('base_job_id')
+        if not base_job_id:
+            return None
+        return Workspace.do_job(os.path.dirname(self.output_dir), base_job_id, self.cache_dir)
+
+    def salvar_json(self, path, dados):
+        """Grava JSON de forma atômica (outros processos nunca leem um arquivo pela metade)."""
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(dados, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def ler_json(self, path):
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)